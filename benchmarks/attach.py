@@ -0,0 +1,61 @@
+"""
+Measures how long it takes to attach a shell on a backend, with a fresh SSH connection for every session
+(the previous behaviour) and through the BackendTransportPool.
+
+    python -m benchmarks.attach [sessions]
+"""
+import logging
+import statistics
+import sys
+import warnings
+from time import perf_counter
+
+import paramiko
+
+from benchmarks.stubs import StubSSHD
+from gateway.ssh.transports import BackendTransportPool
+
+
+def attach_fresh(port: int, key: paramiko.PKey):
+    client = paramiko.SSHClient()
+    client.load_system_host_keys()
+    client.set_missing_host_key_policy(paramiko.WarningPolicy())
+    client.connect(hostname="127.0.0.1", port=port, username="guest", pkey=key,
+                   look_for_keys=False, allow_agent=False)
+    channel = client.invoke_shell()
+    return channel, client
+
+
+def attach_pooled(pool: BackendTransportPool, port: int, key: paramiko.PKey):
+    channel = pool.open_session("127.0.0.1", port, "guest", key)
+    channel.get_pty()
+    channel.invoke_shell()
+    return channel, None
+
+
+def run(name: str, attach, sessions: int):
+    timings = []
+    for _ in range(sessions):
+        start = perf_counter()
+        channel, client = attach()
+        timings.append(perf_counter() - start)
+        channel.close()
+        if client:
+            client.close()
+    timings.sort()
+    print(f"{name}: min {timings[0] * 1000:.1f} ms, median {statistics.median(timings) * 1000:.1f} ms, "
+          f"p95 {timings[int(len(timings) * 0.95)] * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    logging.getLogger("gateway").setLevel(logging.ERROR)
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+    warnings.filterwarnings("ignore", category=UserWarning)
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    key = paramiko.RSAKey.generate(2048)
+    sshd = StubSSHD()
+    sshd.start()
+
+    run("fresh connection", lambda: attach_fresh(sshd.port, key), sessions)
+    pool = BackendTransportPool()
+    run("pooled transport", lambda: attach_pooled(pool, sshd.port, key), sessions)
@@ -0,0 +1,57 @@
+"""
+Measures full SSH handshakes (key exchange, host key signature and public key authentication, like the gateway does
+against a backend) for each host key type and key exchange, against a local paramiko server.
+CPU time covers both ends of the handshake, which run in this process.
+
+    python -m benchmarks.handshake [handshakes]
+"""
+import logging
+import socket
+import sys
+import warnings
+from time import perf_counter, process_time
+
+import paramiko
+
+from benchmarks.stubs import StubSSHD, generate_key
+from gateway.ssh.crypto import AlgorithmPreferences
+
+KEY_TYPES = ("ed25519", "ecdsa", "rsa")
+KEX = ("curve25519-sha256@libssh.org", "ecdh-sha2-nistp256", "diffie-hellman-group14-sha256")
+# The host key algorithm to ask for, for each key type
+SIGNATURE_ALGORITHMS = {"ed25519": "ssh-ed25519", "ecdsa": "ecdsa-sha2-nistp256", "rsa": "rsa-sha2-512"}
+
+
+def handshake(port: int, algorithms: AlgorithmPreferences, key: paramiko.PKey):
+    transport = paramiko.Transport(("127.0.0.1", port))
+    # As on the gateway's backend transports
+    transport.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        algorithms.apply(transport)
+        transport.start_client(timeout=30)
+        transport.auth_publickey("guest", key)
+    finally:
+        transport.close()
+
+
+def run(kind: str, kex: str, handshakes: int):
+    sshd = StubSSHD(host_key=generate_key(kind))
+    sshd.start()
+    key = generate_key(kind)
+    algorithms = AlgorithmPreferences(kex=[kex], key_types=[SIGNATURE_ALGORITHMS[kind]])
+    handshake(sshd.port, algorithms, key)
+
+    wall, cpu = perf_counter(), process_time()
+    for _ in range(handshakes):
+        handshake(sshd.port, algorithms, key)
+    wall, cpu = perf_counter() - wall, process_time() - cpu
+    print(f"{kind:8} {kex:30} {handshakes / wall:7.1f} handshakes/s, {cpu / handshakes * 1000:6.2f} ms CPU each")
+
+
+if __name__ == '__main__':
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+    warnings.filterwarnings("ignore")
+    handshakes = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    for kind in KEY_TYPES:
+        for kex in KEX:
+            run(kind, kex, handshakes)
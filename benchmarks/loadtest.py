@@ -0,0 +1,352 @@
+"""
+Load-tests the whole gateway without a cluster: run_ssh_server runs in its own process with a FakeKubeClient whose
+pods all point to a local StubSSHD. Concurrent paramiko clients log in as Team:challenge at the same moment,
+wait for their shell, type keystrokes and time their echo, then ask for a bulk output.
+
+Time to shell, echo latency, throughput and the gateway process's threads and memory are printed and written as JSON,
+along with the commit, so that runs can be compared across commits (see --baseline).
+The clients run as threads of this process, so their own cost is not counted in the gateway's figures.
+
+With --client-rtt-ms, clients wait that long before each channel request after authentication (opening the
+session, the pty, the shell), like players connecting from far away.
+
+With --terminals, each client then opens more terminals, as extra channels of its connection like ControlMaster or
+an IDE does, or with --terminal-connections over a new connection each, and times how long each takes to echo.
+
+    python -m benchmarks.loadtest [--clients 50] [--teams 10] [--failure-rate 0.05] [--output loadtest.json]
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+import warnings
+from datetime import datetime
+from time import perf_counter, sleep
+from typing import Dict, List, Optional
+
+import paramiko
+
+from benchmarks.stubs import FakeKubeClient, StubSSHD, generate_key
+from gateway.ssh import kube
+from gateway.ssh.ctf import CTF
+from gateway.ssh.provisioning import ProvisioningScheduler
+from gateway.ssh.server import run_ssh_server
+
+PASSWORD = "loadtest"
+
+
+def quiet():
+    logging.getLogger("gateway").setLevel(logging.CRITICAL)
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+    warnings.filterwarnings("ignore")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(args: argparse.Namespace, port: int, key_dir: str, sshd_port: int):
+    quiet()
+    CTF.teams.set_teams({f"Team{i}": PASSWORD for i in range(args.teams)})
+    CTF.pod_ssh_port = sshd_port
+    kube.KubeClient.INSTANCE = FakeKubeClient(time_scale=args.time_scale, api_latency_s=args.api_latency_s,
+                                              schedule_s=args.schedule_s, startup_s=args.startup_s,
+                                              failure_rate=args.failure_rate, pod_ip="127.0.0.1", seed=args.seed)
+    ProvisioningScheduler.INSTANCE = ProvisioningScheduler(args.provision_concurrency)
+    run_ssh_server("127.0.0.1", port, [os.path.join(key_dir, "host.key")], os.path.join(key_dir, "backend.key"),
+                   backlog=1024, handshake_workers=args.handshake_workers)
+
+
+def wait_for_port(port: int):
+    for _ in range(200):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            sleep(0.05)
+    raise RuntimeError(f"Gateway did not listen on port {port}")
+
+
+def process_status(pid: int) -> Dict[str, int]:
+    """
+    Threads, and current and peak resident memory in kB, from /proc.
+    """
+    status = {}
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            name, _, value = line.partition(":")
+            if name in ("Threads", "VmRSS", "VmHWM"):
+                status[name] = int(value.split()[0])
+    return status
+
+
+def read_until(channel: paramiko.Channel, marker: bytes) -> Optional[int]:
+    """
+    Bytes received up to and including the marker, or None if the channel closed first.
+    """
+    received = 0
+    tail = b""
+    while True:
+        data = channel.recv(65536)
+        if not data:
+            return None
+        received += len(data)
+        tail = (tail + data)[-len(marker) - 64:]
+        if marker in tail:
+            return received
+
+
+class Session:
+    def __init__(self, number: int, team: str, challenge: str):
+        self.number = number
+        self.team = team
+        self.challenge = challenge
+        self.time_to_shell: Optional[float] = None
+        self.extra_terminal_latencies: List[float] = []
+        self.echo_latencies: List[float] = []
+        self.bulk_bytes = 0
+        self.bulk_started: Optional[float] = None
+        self.bulk_finished: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def run(self, port: int, go: threading.Event, keystrokes: int, bulk_size: int, rtt_s: float = 0.0,
+            terminals: int = 1, terminal_connections: bool = False):
+        go.wait()
+        start = perf_counter()
+        transports: List[paramiko.Transport] = []
+        try:
+            transport = self._connect(port, transports)
+            channel = self._open_terminal(transport, f"ready{self.number}", rtt_s)
+            if not channel:
+                self.error = "no shell"
+                return
+            self.time_to_shell = perf_counter() - start
+
+            for terminal in range(1, terminals):
+                opened = perf_counter()
+                if terminal_connections:
+                    transport = self._connect(port, transports)
+                if not self._open_terminal(transport, f"ready{self.number}.{terminal}", rtt_s):
+                    self.error = "no extra terminal"
+                    return
+                self.extra_terminal_latencies.append(perf_counter() - opened)
+
+            for _ in range(keystrokes):
+                sent = perf_counter()
+                channel.sendall(b"a")
+                if not channel.recv(16):
+                    self.error = "closed during echo"
+                    return
+                self.echo_latencies.append(perf_counter() - sent)
+
+            self.bulk_started = perf_counter()
+            # Ends the line of keystrokes first
+            channel.sendall(f"\rbulk {bulk_size}\r".encode())
+            received = read_until(channel, b"DONE")
+            if received is None:
+                self.error = "closed during bulk output"
+                return
+            self.bulk_finished = perf_counter()
+            self.bulk_bytes = received
+        except Exception as e:
+            self.error = type(e).__name__
+        finally:
+            for transport in transports:
+                transport.close()
+
+    def _connect(self, port: int, transports: List[paramiko.Transport]) -> paramiko.Transport:
+        sock = socket.create_connection(("127.0.0.1", port), timeout=120)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport = paramiko.Transport(sock)
+        transports.append(transport)
+        transport.start_client(timeout=120)
+        transport.auth_password(f"{self.team}:{self.challenge}", PASSWORD)
+        return transport
+
+    @staticmethod
+    def _open_terminal(transport: paramiko.Transport, marker: str, rtt_s: float) -> Optional[paramiko.Channel]:
+        # Each request after authentication waits for the previous answer, one round trip of a remote client
+        sleep(rtt_s)
+        channel = transport.open_session(timeout=120)
+        channel.settimeout(120)
+        sleep(rtt_s)
+        channel.get_pty()
+        sleep(rtt_s)
+        channel.invoke_shell()
+        # Typed before the backend is ready, echoed once the relay runs
+        channel.sendall(f"{marker}\r".encode())
+        if read_until(channel, f"{marker}\r".encode()) is None:
+            return None
+        return channel
+
+
+def percentiles(values: List[float]) -> Optional[Dict[str, float]]:
+    # In milliseconds
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(p: float) -> float:
+        return round(values[min(len(values) - 1, int(len(values) * p))] * 1000, 2)
+
+    return {"p50": at(0.5), "p95": at(0.95), "p99": at(0.99), "max": round(values[-1] * 1000, 2)}
+
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run(args: argparse.Namespace) -> dict:
+    context = multiprocessing.get_context("fork")
+    sshd = StubSSHD(host_key=generate_key("ecdsa"))
+    sshd.start()
+    port = free_port()
+    with tempfile.TemporaryDirectory() as key_dir:
+        for name in ("host.key", "backend.key"):
+            generate_key(args.key_type).write_private_key_file(os.path.join(key_dir, name))
+        gateway = context.Process(target=serve, args=(args, port, key_dir, sshd.port), daemon=True)
+        gateway.start()
+        wait_for_port(port)
+
+    challenges = list(CTF.challenge_images)[:args.challenges]
+    sessions = [Session(i, f"Team{i % args.teams}", challenges[i // args.teams % len(challenges)])
+                for i in range(args.clients)]
+    go = threading.Event()
+    threads = [threading.Thread(target=session.run,
+                                args=(port, go, args.keystrokes, args.bulk_bytes, args.client_rtt_ms / 1000,
+                                      args.terminals, args.terminal_connections),
+                                daemon=True)
+               for session in sessions]
+    for thread in threads:
+        thread.start()
+
+    peak_threads = 0
+    sampling = threading.Event()
+
+    def sample():
+        nonlocal peak_threads
+        while not sampling.is_set():
+            try:
+                peak_threads = max(peak_threads, process_status(gateway.pid)["Threads"])
+            except OSError:
+                return
+            sleep(0.05)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = perf_counter()
+    go.set()
+    for thread in threads:
+        thread.join()
+    wall = perf_counter() - start
+    sampling.set()
+    sampler.join()
+    status = process_status(gateway.pid)
+    gateway.terminate()
+    gateway.join()
+
+    succeeded = [session for session in sessions if not session.error]
+    errors: Dict[str, int] = {}
+    for session in sessions:
+        if session.error:
+            errors[session.error] = errors.get(session.error, 0) + 1
+    # From the first bulk output asked to the last one received
+    bulk_seconds = max((session.bulk_finished for session in succeeded), default=0) \
+        - min((session.bulk_started for session in succeeded), default=0)
+    bulk_megabytes = sum(session.bulk_bytes for session in succeeded) / 1024 / 1024
+    return {
+        "commit": current_commit(),
+        "date": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        "config": vars(args),
+        "sessions": {"started": len(sessions), "succeeded": len(succeeded), "failed": errors},
+        "wall_s": round(wall, 2),
+        "time_to_shell_ms": percentiles([session.time_to_shell for session in sessions if session.time_to_shell]),
+        "extra_terminal_ms": percentiles([latency for session in sessions
+                                          for latency in session.extra_terminal_latencies]),
+        "echo_ms": percentiles([latency for session in succeeded for latency in session.echo_latencies]),
+        "bulk_throughput_mb_s": round(bulk_megabytes / bulk_seconds, 2) if bulk_seconds else None,
+        "gateway": {
+            "threads_peak": peak_threads,
+            "threads_end": status["Threads"],
+            "rss_mb": round(status["VmRSS"] / 1024, 1),
+            "rss_peak_mb": round(status["VmHWM"] / 1024, 1),
+        },
+    }
+
+
+def print_results(results: dict, baseline: dict = None):
+    def line(label: str, *path: str, unit: str = ""):
+        value, previous = results, baseline
+        for key in path:
+            value = value.get(key) if value else None
+            previous = previous.get(key) if previous else None
+        text = f"  {label:<22}{value}{unit}"
+        if isinstance(value, (int, float)) and isinstance(previous, (int, float)):
+            text += f"  (baseline {previous}{unit}, {value - previous:+.2f})"
+        print(text)
+
+    sessions = results["sessions"]
+    print(f"{sessions['succeeded']}/{sessions['started']} sessions reached a shell and finished in {results['wall_s']} s"
+          + (f", failures: {sessions['failed']}" if sessions["failed"] else ""))
+    for percentile in ("p50", "p95", "p99"):
+        line(f"time to shell {percentile}", "time_to_shell_ms", percentile, unit=" ms")
+    if results.get("extra_terminal_ms"):
+        for percentile in ("p50", "p95", "p99"):
+            line(f"extra terminal {percentile}", "extra_terminal_ms", percentile, unit=" ms")
+    for percentile in ("p50", "p95", "p99"):
+        line(f"echo {percentile}", "echo_ms", percentile, unit=" ms")
+    line("bulk throughput", "bulk_throughput_mb_s", unit=" MB/s")
+    line("gateway threads (peak)", "gateway", "threads_peak")
+    line("gateway RSS (peak)", "gateway", "rss_peak_mb", unit=" MB")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=50, help="concurrent clients")
+    parser.add_argument("--teams", type=int, default=10, help="teams the clients are spread across")
+    parser.add_argument("--challenges", type=int, default=2, help="challenges each team opens")
+    parser.add_argument("--keystrokes", type=int, default=50, help="keystrokes typed by each client")
+    parser.add_argument("--bulk-bytes", type=int, default=1024 * 1024, help="bulk output asked by each client")
+    parser.add_argument("--client-rtt-ms", type=float, default=0.0,
+                        help="delay before each channel request after authentication, as over a remote network")
+    parser.add_argument("--terminals", type=int, default=1, help="terminals each client opens")
+    parser.add_argument("--terminal-connections", action="store_true",
+                        help="open each extra terminal over a new connection instead of a channel")
+    parser.add_argument("--key-type", default="ecdsa", choices=("rsa", "ecdsa"), help="host and backend key type")
+    parser.add_argument("--handshake-workers", type=int, default=32)
+    parser.add_argument("--provision-concurrency", type=int, default=16)
+    parser.add_argument("--time-scale", type=float, default=0.05,
+                        help="real seconds per simulated second of Kubernetes latency")
+    parser.add_argument("--api-latency-s", type=float, default=0.2, help="simulated Kubernetes API call latency")
+    parser.add_argument("--schedule-s", type=float, default=2.0, help="simulated time until a pod has an IP")
+    parser.add_argument("--startup-s", type=float, default=8.0, help="simulated time until a pod's SSH port is up")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of pod creations that fail")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default="loadtest.json", help="where the results are written")
+    parser.add_argument("--baseline", help="results of a previous run to compare with")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    quiet()
+    args = parse_args()
+    results = run(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {args.output}")
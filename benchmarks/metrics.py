@@ -0,0 +1,58 @@
+"""
+Measures the cost of one metrics update, from one thread and from several at once,
+against a counter protected by a lock, and the cost of a scrape.
+
+    python -m benchmarks.metrics [updates per thread] [threads]
+"""
+import sys
+import threading
+from time import perf_counter
+
+from gateway.ssh.metrics import Registry, render
+
+
+class LockedCounter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+def measure(update, updates: int, threads: int) -> float:
+    def run():
+        for _ in range(updates):
+            update()
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    start = perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (perf_counter() - start) / (updates * threads) * 1e9
+
+
+if __name__ == '__main__':
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    registry = Registry()
+    counter = registry.counter("bench_counter", "A counter")
+    child = registry.counter("bench_labelled", "A labelled counter", labels=("direction",)).labels("up")
+    histogram = registry.histogram("bench_histogram", "A histogram")
+    locked = LockedCounter()
+
+    for name, update in (("noop", lambda: None),
+                         ("locked counter inc", locked.inc),
+                         ("counter inc", counter.inc),
+                         ("labelled counter inc", lambda: child.inc(1024)),
+                         ("histogram observe", lambda: histogram.observe(0.03))):
+        single = measure(update, updates, 1)
+        contended = measure(update, updates // threads, threads)
+        print(f"{name:22} {single:6.0f} ns/update in 1 thread, {contended:6.0f} ns/update across {threads} threads")
+
+    start = perf_counter()
+    text = render(registry.collect())
+    print(f"scrape: {(perf_counter() - start) * 1000:.2f} ms for {len(text.splitlines())} lines")
@@ -0,0 +1,117 @@
+"""
+Compares the shared PortProber with the previous thread-per-pod polling loop.
+
+Each simulated pod is a local listener that starts late, and half of them accept connections
+some time before sending their SSH banner, like a pod whose sshd is still starting.
+
+    python -m benchmarks.probe [pods]
+"""
+import random
+import socket
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+
+from gateway.ssh.probe import PortProber
+
+
+class LateListener(threading.Thread):
+    def __init__(self, listen_delay_s: float, banner_delay_s: float):
+        super().__init__(daemon=True)
+        self.listen_delay_s = listen_delay_s
+        self.banner_delay_s = banner_delay_s
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.ready_at = None
+
+    def run(self):
+        start = monotonic()
+        self.ready_at = start + self.listen_delay_s + self.banner_delay_s
+        sleep(self.listen_delay_s)
+        self.sock.listen(128)
+        while True:
+            client, _ = self.sock.accept()
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client: socket.socket):
+        delay = self.ready_at - monotonic()
+        if delay > 0:
+            sleep(delay)
+        try:
+            client.sendall(b"SSH-2.0-Bench\r\n")
+            client.recv(1)
+        except OSError:
+            pass
+        finally:
+            client.close()
+
+
+def legacy_wait(port: int, timeout_s: float) -> bool:
+    # The previous KubeClient.wait_until_pod_port_available loop, including the leaked sockets
+    max_time = monotonic() + timeout_s
+    while True:
+        if max_time < monotonic():
+            return False
+        sleep(0.25)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if sock.connect_ex(("127.0.0.1", port)) == 0:
+            return True
+
+
+def start_listeners(count: int, seed: int):
+    rng = random.Random(seed)
+    listeners = []
+    for i in range(count):
+        banner_delay = rng.uniform(0.1, 0.5) if i % 2 else 0.0
+        listener = LateListener(rng.uniform(0.1, 2.0), banner_delay)
+        listener.start()
+        listeners.append(listener)
+    return listeners
+
+
+def report(name: str, listeners, detected_at, elapsed: float, threads: int):
+    # The legacy loop only checks for a TCP accept, so it can report a pod ready before its banner
+    lags = sorted(detected_at[i] - listener.ready_at for i, listener in enumerate(listeners))
+    early = sum(1 for lag in lags if lag < 0)
+    print(f"{name}:")
+    print(f"  wall time            {elapsed:.2f}s")
+    print(f"  threads used         {threads}")
+    print(f"  detected before ssh  {early}/{len(lags)}")
+    print(f"  lag p50 / p95 / max  {lags[len(lags) // 2] * 1000:.0f} / {lags[int(len(lags) * 0.95)] * 1000:.0f} / "
+          f"{lags[-1] * 1000:.0f} ms")
+
+
+def bench_legacy(count: int):
+    listeners = start_listeners(count, seed=1)
+    detected_at = [0.0] * count
+    start = monotonic()
+
+    def wait(i):
+        legacy_wait(listeners[i].port, 10.0)
+        detected_at[i] = monotonic()
+
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        list(executor.map(wait, range(count)))
+    report("legacy polling", listeners, detected_at, monotonic() - start, count)
+
+
+def bench_prober(count: int):
+    listeners = start_listeners(count, seed=1)
+    prober = PortProber()
+    prober.start()
+    detected_at = [0.0] * count
+    start = monotonic()
+    futures = [prober.probe("127.0.0.1", listener.port, 10.0) for listener in listeners]
+    for i, future in enumerate(futures):
+        future.add_done_callback(lambda _, i=i: detected_at.__setitem__(i, monotonic()))
+    for future in futures:
+        assert future.result()
+    report("shared prober", listeners, detected_at, monotonic() - start, 1)
+
+
+if __name__ == '__main__':
+    pods = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    bench_legacy(pods)
+    bench_prober(pods)
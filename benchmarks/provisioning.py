@@ -0,0 +1,80 @@
+"""
+Simulates every team connecting at once against a FakeKubeClient, with several members of each team opening
+each challenge at the same moment, and one team opening many challenges. Pods are provisioned:
+- unbounded: directly by each session (the previous behaviour)
+- scheduled: through the ProvisioningScheduler
+- single-flight: through the scheduler, with sessions for the same pod sharing one provisioning
+Times are in simulated seconds; sessions whose pod is not up within the usual timeouts fail.
+
+    python -m benchmarks.provisioning [teams] [challenges per team] [members per team]
+"""
+import logging
+import sys
+import threading
+import uuid
+from time import perf_counter
+from types import SimpleNamespace
+
+from benchmarks.stubs import FakeKubeClient
+from gateway.ssh import backend, kube
+from gateway.ssh.provisioning import ProvisioningScheduler
+from gateway.ssh.trace import SessionTrace
+
+GREEDY_TEAM_CHALLENGES = 12
+
+
+def run(name: str, teams: int, challenges: int, members: int, scheduler: ProvisioningScheduler = None,
+        single_flight: bool = False):
+    kube_client = FakeKubeClient()
+    kube.KubeClient.INSTANCE = kube_client
+    ProvisioningScheduler.INSTANCE = scheduler
+    ready_at, failed = {}, []
+    lock = threading.Lock()
+    start = perf_counter()
+
+    def session(team: str, challenge: str):
+        if single_flight:
+            connection = SimpleNamespace(server=SimpleNamespace(username=team), challenge=challenge,
+                                         id=str(uuid.uuid4()), trace=SessionTrace())
+            result = backend.get_pod_backend(connection, None)
+        else:
+            result = backend.find_or_start_pod(kube_client, team, challenge, None)
+        with lock:
+            if result:
+                ready_at.setdefault(team, []).append((perf_counter() - start) / kube_client.time_scale)
+            else:
+                failed.append((team, challenge))
+
+    threads = []
+    for team_number in range(teams):
+        team = f"team{team_number}"
+        for challenge_number in range(GREEDY_TEAM_CHALLENGES if team_number == 0 else challenges):
+            for _ in range(members):
+                threads.append(threading.Thread(target=session, args=(team, f"catwalk{challenge_number}")))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    times = sorted(t for team_times in ready_at.values() for t in team_times)
+    print(f"{name}: {len(times)} sessions up, {len(failed)} failed; {kube_client.creates} creates "
+          f"({kube_client.conflicts} conflicts), max {kube_client.max_concurrent_creates} at once, "
+          f"{kube_client.api_calls} API calls")
+    if times:
+        print(f"  ready after p50 {times[len(times) // 2]:.1f} s, p90 {times[int(len(times) * 0.9)]:.1f} s, "
+              f"max {times[-1]:.1f} s; slowest first pod of a team "
+              f"{max(min(team_times) for team_times in ready_at.values()):.1f} s")
+
+
+if __name__ == '__main__':
+    logging.getLogger("gateway").setLevel(logging.CRITICAL)
+    teams = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    challenges = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    members = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    # Every challenge needs an image
+    for challenge_number in range(GREEDY_TEAM_CHALLENGES):
+        backend.CTF.challenge_images.setdefault(f"catwalk{challenge_number}", "image")
+    run("unbounded", teams, challenges, members)
+    run("scheduled", teams, challenges, members, ProvisioningScheduler(max_in_flight=16, max_in_flight_per_team=2))
+    run("single-flight", teams, challenges, members, ProvisioningScheduler(max_in_flight=16, max_in_flight_per_team=2),
+        single_flight=True)
@@ -0,0 +1,176 @@
+"""
+Compares the threaded relay with the selector relay.
+
+Every session is a paramiko client talking to a paramiko server channel (the gateway side), which is relayed
+to a shell on a local stub sshd. Each session asks the stub for a bulk output and waits for all of it,
+then types single keystrokes and waits for their echo.
+
+The "legacy" mode is the original relay (fixed 1024 byte reads, unchecked sends) for comparison. A "+record"
+or "+gzip" suffix (e.g. "selector+record") records every session to a temporary directory while relaying.
+
+    python -m benchmarks.relay [sessions] [bytes per session] [legacy|threaded|selector[+record|+gzip] ...]
+"""
+import argparse
+import logging
+import tempfile
+import threading
+import uuid
+import warnings
+from datetime import datetime
+from time import perf_counter, process_time
+
+import paramiko
+
+from benchmarks.stubs import StubSSHD, client_channel_pair
+from gateway.ssh.connection import ServerConnection
+from gateway.ssh.recording import SessionRecorder
+from gateway.ssh.relay import SelectorRelay, ThreadedRelay
+from gateway.ssh.transports import BackendTransportPool
+
+
+def read_until(channel: paramiko.Channel, marker: bytes) -> int:
+    received = 0
+    tail = b""
+    while True:
+        data = channel.recv(65536)
+        if not data:
+            return received
+        received += len(data)
+        tail = (tail + data)[-len(marker) - 64:]
+        if marker in tail:
+            return received
+
+
+class LegacyRelay:
+    def relay(self, connection: ServerConnection):
+        def forward():
+            while not connection.backend.closed:
+                try:
+                    connection.channel.send(connection.backend.recv(1024))
+                except Exception:
+                    break
+
+        threading.Thread(target=forward, name="forward-legacy", daemon=True).start()
+        while connection.is_alive():
+            try:
+                connection.backend.send(connection.channel.recv(1024))
+            except Exception:
+                break
+        connection.kill()
+
+
+def echo_latencies(channel: paramiko.Channel, keystrokes: int):
+    latencies = []
+    for _ in range(keystrokes):
+        start = perf_counter()
+        channel.sendall(b"a")
+        if not channel.recv(16):
+            break
+        latencies.append(perf_counter() - start)
+    return latencies
+
+
+def run(mode: str, sessions: int, size: int, sshd: StubSSHD, key: paramiko.PKey):
+    relay_mode, _, record = mode.partition("+")
+    recorder = None
+    if record:
+        recorder = SessionRecorder(tempfile.mkdtemp(prefix="recordings-"), compress=record == "gzip",
+                                   min_free_bytes=0)
+        recorder.start()
+    pool = BackendTransportPool()
+    relay = {
+        "legacy": LegacyRelay,
+        "threaded": lambda: ThreadedRelay(coalesce_s=0.002),
+        "selector": lambda: SelectorRelay(coalesce_s=0.002),
+    }[relay_mode]()
+    server_key = paramiko.RSAKey.generate(2048)
+
+    clients = []
+    for _ in range(sessions):
+        client_channel, server_channel, server_transport = client_channel_pair(server_key)
+        backend = pool.open_session("127.0.0.1", sshd.port, "guest", key)
+        backend.get_pty()
+        backend.invoke_shell()
+        connection = ServerConnection(channel=server_channel, transport=server_transport, backend=backend,
+                                      last_active=datetime.utcnow(), id=str(uuid.uuid4()))
+        if recorder:
+            connection.recording = recorder.record(connection)
+        if relay_mode == "selector":
+            relay.relay(connection)
+        else:
+            # Stands in for the ConnectionThread, which runs the client to backend side of the threaded relay
+            threading.Thread(target=relay.relay, args=(connection,), name="connection", daemon=True).start()
+        clients.append(client_channel)
+
+    relay_threads = len([t for t in threading.enumerate() if t.name.startswith(("connection", "forward-", "relay-"))])
+
+    received = [0] * sessions
+
+    def drive(i):
+        clients[i].sendall(f"bulk {size}\r".encode())
+        received[i] = read_until(clients[i], b"DONE")
+
+    cpu_start, start = process_time(), perf_counter()
+    drivers = [threading.Thread(target=drive, args=(i,)) for i in range(sessions)]
+    for driver in drivers:
+        driver.start()
+    for driver in drivers:
+        driver.join()
+    elapsed, cpu = perf_counter() - start, process_time() - cpu_start
+
+    latencies = []
+    echo_drivers = [threading.Thread(target=lambda c=c: latencies.extend(echo_latencies(c, 50))) for c in clients]
+    for driver in echo_drivers:
+        driver.start()
+    for driver in echo_drivers:
+        driver.join()
+    latencies.sort()
+
+    megabytes = sum(received) / 1024 / 1024
+    print(f"{mode}:")
+    print(f"  sessions relayed     {sum(1 for r in received if r >= size)}/{sessions}")
+    print(f"  relay threads        {relay_threads}")
+    print(f"  process threads      {threading.active_count()}")
+    print(f"  relayed              {megabytes:.1f} MB in {elapsed:.2f}s ({megabytes / elapsed:.1f} MB/s)")
+    # Process CPU includes both benchmark endpoints, which cost the same in every mode
+    print(f"  process CPU per MB   {cpu / megabytes * 1000:.1f} ms")
+    print(f"  echo p50 / p99       {latencies[len(latencies) // 2] * 1000:.2f} / "
+          f"{latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms")
+    if recorder:
+        recorder.flush()
+        stats = recorder.stats()
+        print(f"  recorded / dropped   {stats['bytes_written'] / 1024 / 1024:.1f} / "
+              f"{stats['bytes_dropped'] / 1024 / 1024:.1f} MB")
+
+    for client in clients:
+        client.close()
+
+
+def relay_mode(mode: str) -> str:
+    relay, _, record = mode.partition("+")
+    if relay not in ("legacy", "threaded", "selector") or record not in ("", "record", "gzip"):
+        raise argparse.ArgumentTypeError(f"unknown mode: {mode}")
+    return mode
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sessions", type=int, nargs="?", default=20, help="concurrent sessions")
+    parser.add_argument("size", type=int, nargs="?", default=1024 * 1024, help="bytes of bulk output per session")
+    parser.add_argument("modes", type=relay_mode, nargs="*", help="relays to compare (default: all of them, "
+                        "and the threaded and selector relays while recording)",
+                        default=["legacy", "threaded", "selector", "threaded+record", "selector+record"])
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.getLogger("gateway").setLevel(logging.ERROR)
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+    warnings.filterwarnings("ignore", category=UserWarning)
+    args = parse_args()
+
+    sshd = StubSSHD()
+    sshd.start()
+    backend_key = paramiko.RSAKey.generate(2048)
+    for mode in args.modes:
+        run(mode, args.sessions, args.size, sshd, backend_key)
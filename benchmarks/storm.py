@@ -0,0 +1,145 @@
+"""
+Opens a burst of simultaneous logins against a local gateway and measures the time from connect to successful
+password authentication, with:
+- serial: one handshake at a time and a backlog of 20 (the previous accept loop)
+- pooled: handshakes on the handshake workers, in one process
+- workers: several gateway processes sharing the port with SO_REUSEPORT
+
+    python -m benchmarks.storm [logins] [gateway workers]
+"""
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import warnings
+from time import perf_counter, sleep
+
+import paramiko
+
+from gateway.ssh.ctf import CTF
+from gateway.ssh.server import run_ssh_server
+
+CLIENT_PROCESSES = 4
+TEAM, PASSWORD = "Bench", "storm"
+
+
+def quiet():
+    logging.getLogger("gateway").setLevel(logging.CRITICAL)
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+    warnings.filterwarnings("ignore")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(port: int, key_dir: str, backlog: int, reuse_port: bool, handshake_workers: int):
+    quiet()
+    CTF.teams.set_teams({TEAM: PASSWORD})
+    run_ssh_server("127.0.0.1", port, [os.path.join(key_dir, "host.key")], os.path.join(key_dir, "backend.key"),
+                   backlog=backlog, reuse_port=reuse_port, handshake_workers=handshake_workers)
+
+
+def login(port: int) -> float:
+    start = perf_counter()
+    sock = socket.create_connection(("127.0.0.1", port), timeout=60)
+    transport = paramiko.Transport(sock)
+    try:
+        transport.start_client(timeout=60)
+        transport.auth_password(f"{TEAM}:catwalk", PASSWORD)
+        return perf_counter() - start
+    finally:
+        transport.close()
+
+
+def storm_client(port: int, logins: int, go, results):
+    quiet()
+    timings, failures = [], 0
+    lock = threading.Lock()
+
+    def run():
+        nonlocal failures
+        go.wait()
+        try:
+            elapsed = login(port)
+            with lock:
+                timings.append(elapsed)
+        except Exception:
+            with lock:
+                failures += 1
+
+    threads = [threading.Thread(target=run) for _ in range(logins)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((timings, failures))
+
+
+def wait_for_port(port: int):
+    for _ in range(200):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            sleep(0.05)
+    raise RuntimeError(f"Gateway did not listen on port {port}")
+
+
+def percentile(timings, p: float) -> float:
+    return timings[min(len(timings) - 1, int(len(timings) * p))] * 1000
+
+
+def run(name: str, key_dir: str, logins: int, processes: int, backlog: int, handshake_workers: int):
+    context = multiprocessing.get_context("fork")
+    port = free_port()
+    gateways = [context.Process(target=serve, args=(port, key_dir, backlog, processes > 1, handshake_workers),
+                                daemon=True) for _ in range(processes)]
+    for gateway in gateways:
+        gateway.start()
+    wait_for_port(port)
+    # Let every gateway process reach accept()
+    sleep(0.5)
+
+    go, results = context.Event(), context.Queue()
+    clients = [context.Process(target=storm_client, args=(port, logins // CLIENT_PROCESSES, go, results))
+               for _ in range(CLIENT_PROCESSES)]
+    for client in clients:
+        client.start()
+    sleep(1.0)
+    start = perf_counter()
+    go.set()
+    timings, failures = [], 0
+    for _ in clients:
+        client_timings, client_failures = results.get()
+        timings += client_timings
+        failures += client_failures
+    wall = perf_counter() - start
+    for process in clients + gateways:
+        process.terminate()
+        process.join()
+
+    timings.sort()
+    if not timings:
+        print(f"{name}: every login failed")
+        return
+    print(f"{name}: {len(timings)} logins in {wall:.2f} s, {failures} failed, "
+          f"p50 {percentile(timings, 0.5):.0f} ms, p90 {percentile(timings, 0.9):.0f} ms, "
+          f"p99 {percentile(timings, 0.99):.0f} ms, max {timings[-1] * 1000:.0f} ms")
+
+
+if __name__ == '__main__':
+    quiet()
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    with tempfile.TemporaryDirectory() as key_dir:
+        for name in ("host.key", "backend.key"):
+            paramiko.RSAKey.generate(2048).write_private_key_file(os.path.join(key_dir, name))
+        run("serial", key_dir, logins, processes=1, backlog=20, handshake_workers=1)
+        run("pooled", key_dir, logins, processes=1, backlog=1024, handshake_workers=32)
+        run(f"{workers} workers", key_dir, logins, processes=workers, backlog=1024, handshake_workers=32)
@@ -0,0 +1,366 @@
+"""
+Local stand-ins for the challenge pods, used by the benchmarks.
+"""
+import io
+import os
+import random
+import socket
+import threading
+
+import paramiko
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+
+def generate_key(kind: str) -> paramiko.PKey:
+    """
+    A new "rsa" (2048 bits), "ecdsa" (P-256) or "ed25519" key.
+    """
+    if kind == "rsa":
+        return paramiko.RSAKey.generate(2048)
+    if kind == "ecdsa":
+        return paramiko.ECDSAKey.generate()
+    if kind == "ed25519":
+        # paramiko cannot generate Ed25519 keys, but reads them in the OpenSSH format
+        pem = ed25519.Ed25519PrivateKey.generate().private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH, serialization.NoEncryption())
+        return paramiko.Ed25519Key(file_obj=io.StringIO(pem.decode()))
+    raise ValueError(f"Unknown key type {kind}")
+
+
+class StubShellServer(paramiko.ServerInterface):
+    def __init__(self):
+        self.shell_requested = threading.Event()
+
+    def get_allowed_auths(self, username):
+        return "publickey,password"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_window_change_request(self, channel, width, height, pixelwidth, pixelheight):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        threading.Thread(target=echo_shell, args=(channel,), daemon=True).start()
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=run_command, args=(channel, command), daemon=True).start()
+        return True
+
+
+def run_command(channel: paramiko.Channel, command: bytes):
+    """
+    Runs an exec request: "bulk N" outputs N bytes, "sink" reads its input until EOF and outputs how much it read,
+    "cat" echoes its input until EOF. Anything else fails with exit status 127.
+    """
+    try:
+        status = _run_command(channel, command)
+        channel.send_exit_status(status)
+        # The client closes the channel: closing it here may beat paramiko's reply to the exec request,
+        # which the client then reports as a failure
+        channel.shutdown_write()
+    except OSError:
+        # The client went away
+        channel.close()
+
+
+def _run_command(channel: paramiko.Channel, command: bytes) -> int:
+    name, _, argument = command.decode().partition(" ")
+    status = 0
+    if name == "bulk":
+        remaining = int(argument)
+        chunk = b"x" * 32768
+        while remaining > 0:
+            channel.sendall(chunk[:remaining])
+            remaining -= len(chunk)
+    elif name in ("sink", "cat"):
+        received = 0
+        while True:
+            data = channel.recv(32768)
+            if not data:
+                break
+            received += len(data)
+            if name == "cat":
+                channel.sendall(data)
+        if name == "sink":
+            channel.sendall(f"{received}\n".encode())
+    else:
+        channel.sendall_stderr(f"{name}: command not found\n".encode())
+        status = 127
+    return status
+
+
+class _StubSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat((self.readfile or self.writefile).fileno()))
+
+
+class StubSFTPServer(paramiko.SFTPServerInterface):
+    """
+    Serves the files of a local directory over SFTP, enough for transfers.
+    """
+
+    def __init__(self, server, root: str, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = root
+
+    def _path(self, path: str) -> str:
+        return os.path.join(self.root, os.path.normpath("/" + path).lstrip("/"))
+
+    def open(self, path, flags, attr):
+        mode = "r+b" if flags & os.O_RDWR else "wb" if flags & os.O_WRONLY else "rb"
+        try:
+            file = open(self._path(path), mode)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = _StubSFTPHandle(flags)
+        handle.filename = path
+        if "r" in mode or "+" in mode:
+            handle.readfile = file
+        if "w" in mode or "+" in mode:
+            handle.writefile = file
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def list_folder(self, path):
+        try:
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(self._path(path), name)), name)
+                    for name in os.listdir(self._path(path))]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+def echo_shell(channel: paramiko.Channel):
+    """
+    Echoes input back, except for lines starting with "bulk N" which answer with N bytes of output.
+    """
+    line = b""
+    while True:
+        data = channel.recv(32768)
+        if not data:
+            break
+        channel.sendall(data)
+        line += data
+        while b"\r" in line:
+            command, line = line.split(b"\r", 1)
+            if command.startswith(b"bulk "):
+                remaining = int(command.split()[1])
+                chunk = b"x" * 32768
+                while remaining > 0:
+                    channel.sendall(chunk[:remaining])
+                    remaining -= len(chunk)
+                channel.sendall(b"\r\nDONE\r\n")
+    channel.close()
+
+
+class StubSSHD(threading.Thread):
+    """
+    A paramiko SSH server on localhost that accepts any credentials and serves `echo_shell`, `run_command`,
+    and with `sftp_root`, the files of that directory over SFTP.
+    """
+
+    def __init__(self, host_key: paramiko.PKey = None, server_factory=StubShellServer, sftp_root: str = None):
+        super().__init__(daemon=True)
+        self.host_key = host_key or paramiko.RSAKey.generate(2048)
+        self.server_factory = server_factory
+        self.sftp_root = sftp_root
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(1024)
+        self.port = self.sock.getsockname()[1]
+        self.handshakes = 0
+
+    def run(self):
+        while True:
+            client, _ = self.sock.accept()
+            self.handshakes += 1
+            # Like OpenSSH, answer small channel requests without waiting on Nagle's algorithm
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            if self.sftp_root:
+                transport.set_subsystem_handler("sftp", paramiko.SFTPServer, StubSFTPServer, self.sftp_root)
+            transport.start_server(server=self.server_factory())
+
+
+class AcceptingServer(paramiko.ServerInterface):
+    """
+    Plays the gateway's side of a client connection: accepts any password, a pty, and a shell, a command or
+    the SFTP subsystem.
+    """
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        return True
+
+    def check_channel_subsystem_request(self, channel, name):
+        return name == "sftp"
+
+
+def client_channel_pair(server_key: paramiko.PKey, command: bytes = None, subsystem: str = None):
+    """
+    Connects a paramiko client to a paramiko server over a socket pair,
+    and returns (client channel, server channel, server transport) for one shell session,
+    or without a pty, for one `command` or `subsystem` session.
+    """
+    server_sock, client_sock = socket.socketpair()
+    server_transport = paramiko.Transport(server_sock)
+    server_transport.add_server_key(server_key)
+    server_transport.start_server(event=threading.Event(), server=AcceptingServer())
+    client_transport = paramiko.Transport(client_sock)
+    client_transport.start_client()
+    client_transport.auth_password("bench", "bench")
+    client_channel = client_transport.open_session()
+    if command:
+        client_channel.exec_command(command)
+    elif subsystem:
+        client_channel.invoke_subsystem(subsystem)
+    else:
+        client_channel.get_pty()
+        client_channel.invoke_shell()
+    server_channel = server_transport.accept(10)
+    return client_channel, server_channel, server_transport
+
+
+class FakeKubeClient:
+    """
+    Stands in for KubeClient with simulated latencies, given in seconds of simulated time; `time_scale` is how many
+    real seconds one simulated second takes, and also scales the timeouts callers pass in.
+
+    API calls slow down as more of them run at once, and pods only start `node_capacity` at a time,
+    like images starting on a busy node. A `failure_rate` share of pod creations fail.
+    With `pod_ip`, every pod gets that address, such as the one of a local StubSSHD.
+    """
+
+    def __init__(self, time_scale: float = 0.05, api_latency_s: float = 0.2, api_capacity: int = 10,
+                 schedule_s: float = 2.0, startup_s: float = 8.0, node_capacity: int = 16,
+                 failure_rate: float = 0.0, pod_ip: str = None, seed: int = None):
+        self.time_scale = time_scale
+        self.api_latency_s = api_latency_s
+        self.api_capacity = api_capacity
+        self.schedule_s = schedule_s
+        self.startup_s = startup_s
+        self.failure_rate = failure_rate
+        self.pod_ip = pod_ip
+        self.pods = {}
+        self.api_calls = 0
+        self.creates = 0
+        self.conflicts = 0
+        self.failures = 0
+        self.max_concurrent_creates = 0
+        self._concurrent_api_calls = 0
+        self._concurrent_creates = 0
+        self._ready = {}
+        self._has_ip = {}
+        self._node = threading.Semaphore(node_capacity)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _sleep(self, simulated_s: float):
+        threading.Event().wait(simulated_s * self.time_scale)
+
+    def _api_call(self):
+        with self._lock:
+            self.api_calls += 1
+            self._concurrent_api_calls += 1
+            concurrent = self._concurrent_api_calls
+        self._sleep(self.api_latency_s * (1 + concurrent / self.api_capacity))
+        with self._lock:
+            self._concurrent_api_calls -= 1
+
+    def get_pod(self, team: str, challenge: str):
+        self._api_call()
+        return self.pods.get((team.lower(), challenge.lower()))
+
+    def create_pod(self, name: str, image: str, team: str, challenge: str):
+        from kubernetes.client import V1ObjectMeta, V1Pod, V1PodStatus
+        with self._lock:
+            self.creates += 1
+            self._concurrent_creates += 1
+            self.max_concurrent_creates = max(self.max_concurrent_creates, self._concurrent_creates)
+        try:
+            self._api_call()
+            if (team.lower(), challenge.lower()) in self.pods:
+                # The API server would answer 409 Conflict
+                self.conflicts += 1
+                return self.pods[(team.lower(), challenge.lower())]
+            with self._lock:
+                failed = self._random.random() < self.failure_rate
+                self.failures += failed
+            if failed:
+                return None
+            pod = V1Pod(metadata=V1ObjectMeta(name=name, labels={"ctf_team": team, "ctf_challenge": challenge}),
+                        status=V1PodStatus(phase="Pending"))
+            self.pods[(team.lower(), challenge.lower())] = pod
+            self._has_ip[name] = threading.Event()
+            self._ready[name] = threading.Event()
+            threading.Thread(target=self._start, args=(pod,), daemon=True).start()
+            return pod
+        finally:
+            with self._lock:
+                self._concurrent_creates -= 1
+
+    def _start(self, pod):
+        self._sleep(self.schedule_s)
+        pod.status.pod_ip = self.pod_ip or f"10.0.{len(self._has_ip) // 250}.{len(self._has_ip) % 250}"
+        self._has_ip[pod.metadata.name].set()
+        with self._node:
+            self._sleep(self.startup_s)
+        pod.status.phase = "Running"
+        self._ready[pod.metadata.name].set()
+
+    def wait_until_pod_has_ip(self, pod, timeout: float):
+        if self._has_ip[pod.metadata.name].wait(timeout * self.time_scale):
+            return pod.status.pod_ip
+        return None
+
+    def wait_until_pod_port_available(self, pod, ip: str, port: int, timeout: float) -> bool:
+        return self._ready[pod.metadata.name].wait(timeout * self.time_scale)
+
+    def list_pods(self):
+        return list(self.pods.values())
+
+    def list_warm_pods(self):
+        return []
@@ -0,0 +1,139 @@
+"""
+Measures file transfers through the gateway's relay against a local stub sshd.
+
+Each transfer is a paramiko client talking to a paramiko server channel (the gateway side), whose backend channel
+is opened with the same request as the client's and relayed to the stub:
+
+- "base64": what players did before exec and SFTP were relayed, printing the file base64-encoded in a shell
+  (4/3 of its size) through the terminal relay
+- "exec-get" / "exec-put": a command whose output or input is the file, like `cat` or scp
+- "sftp-get" / "sftp-put": SFTP downloads and uploads
+
+    python -m benchmarks.transfer [megabytes] [repeats] [base64|exec-get|exec-put|sftp-get|sftp-put ...]
+"""
+import logging
+import os
+import sys
+import tempfile
+import threading
+import uuid
+import warnings
+from datetime import datetime
+from time import perf_counter
+
+import paramiko
+
+from benchmarks.relay import read_until
+from benchmarks.stubs import StubSSHD, client_channel_pair
+from gateway.ssh.backend import BackendResource
+from gateway.ssh.connection import ServerConnection
+from gateway.ssh.proxy import create_proxy_to_backend
+from gateway.ssh.pty import PtyDimensions
+from gateway.ssh.relay import ThreadedRelay, passthrough
+from gateway.ssh.transports import BackendTransportPool
+
+CHUNK = 32768
+
+
+def open_session(sshd: StubSSHD, key: paramiko.PKey, server_key: paramiko.PKey, command: bytes = None,
+                 subsystem: str = None) -> paramiko.Channel:
+    client, server_channel, server_transport = client_channel_pair(server_key, command, subsystem)
+    connection = ServerConnection(channel=server_channel, transport=server_transport, last_active=datetime.utcnow(),
+                                  id=str(uuid.uuid4()), challenge="bench")
+    if command:
+        connection.session_type, connection.command = "exec", command
+    elif subsystem:
+        connection.session_type = subsystem
+    else:
+        connection.pty_dimensions = PtyDimensions(term="xterm", width=80, height=24, width_pixels=0, height_pixels=0)
+    connection.backend = create_proxy_to_backend(BackendResource("bench", "127.0.0.1", sshd.port, key), connection)
+    relay = passthrough if connection.session_type != "shell" else ThreadedRelay(coalesce_s=0.002)
+    threading.Thread(target=relay.relay, args=(connection,), daemon=True).start()
+    return client
+
+
+def drain(channel: paramiko.Channel) -> int:
+    received = 0
+    while True:
+        data = channel.recv(262144)
+        if not data:
+            return received
+        received += len(data)
+
+
+def transfer(mode: str, size: int, sshd: StubSSHD, key: paramiko.PKey, server_key: paramiko.PKey) -> int:
+    """
+    Runs one transfer of `size` bytes, and returns how many bytes went through the relay.
+    """
+    if mode == "base64":
+        client = open_session(sshd, key, server_key)
+        encoded = size * 4 // 3
+        client.sendall(f"bulk {encoded}\r".encode())
+        received = read_until(client, b"DONE")
+        client.close()
+        return received
+    if mode == "exec-get":
+        client = open_session(sshd, key, server_key, command=f"bulk {size}".encode())
+        received = drain(client)
+        assert client.recv_exit_status() == 0 and received == size, (received, size)
+        return received
+    if mode == "exec-put":
+        client = open_session(sshd, key, server_key, command=b"sink")
+        chunk = b"x" * CHUNK
+        for offset in range(0, size, CHUNK):
+            client.sendall(chunk[:size - offset])
+        client.shutdown_write()
+        answer = client.makefile().read()
+        assert client.recv_exit_status() == 0 and int(answer) == size, answer
+        return size
+    client = open_session(sshd, key, server_key, subsystem="sftp")
+    sftp = paramiko.SFTPClient(client)
+    local = os.path.join(sshd.sftp_root, "local.bin")
+    try:
+        if mode == "sftp-get":
+            with open(local, "wb") as file:
+                sftp.getfo("remote.bin", file)
+        elif mode == "sftp-put":
+            with open(local, "rb") as file:
+                sftp.putfo(file, "upload.bin", file_size=size)
+        else:
+            raise ValueError(f"Unknown mode {mode}")
+    finally:
+        sftp.close()
+    return size
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    modes = sys.argv[3:] or ["base64", "exec-get", "exec-put", "sftp-get", "sftp-put"]
+    size = megabytes * 1024 * 1024
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+    warnings.filterwarnings("ignore")
+
+    root = tempfile.mkdtemp(prefix="transfer-")
+    for name in ("remote.bin", "local.bin"):
+        with open(os.path.join(root, name), "wb") as file:
+            file.write(os.urandom(size))
+    sshd = StubSSHD(sftp_root=root)
+    sshd.start()
+    BackendTransportPool.INSTANCE = BackendTransportPool()
+    key = paramiko.RSAKey.generate(2048)
+    server_key = paramiko.RSAKey.generate(2048)
+
+    print(f"{megabytes} MB file, best of {repeats}")
+    print(f"{'mode':>10} {'seconds':>8} {'MB/s':>8} {'relayed MB':>11}")
+    for mode in modes:
+        best, relayed = None, 0
+        for _ in range(repeats):
+            start = perf_counter()
+            relayed = transfer(mode, size, sshd, key, server_key)
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{mode:>10} {best:8.2f} {size / best / 1e6:8.1f} {relayed / 1e6:11.1f}")
+
+
+if __name__ == "__main__":
+    main()
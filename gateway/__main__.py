@@ -1,13 +1,27 @@
 import logging
+import multiprocessing
 import os
+import socket
 import threading
 import warnings
+from typing import Optional
 
 from cryptography.utils import CryptographyDeprecationWarning
 
-from gateway.ssh import kube
+from gateway.ssh import kube, metrics
+from gateway.ssh.backend import provisioning_stats
+from gateway.ssh.cluster import ProvisioningLeases, ReplicaSessionState, SQLiteSessionStore
+from gateway.ssh.crypto import AlgorithmPreferences
 from gateway.ssh.ctf import CTF
+from gateway.ssh.detach import ParkedSessions
+from gateway.ssh.events import event_bus, publish_pod_change
+from gateway.ssh.pool import WarmPodPool
+from gateway.ssh.provisioning import ProvisioningScheduler
+from gateway.ssh.reaper import Reaper
+from gateway.ssh.recording import SessionRecorder
+from gateway.ssh.registry import connections
 from gateway.ssh.server import run_ssh_server
+from gateway.ssh.state import LocalSessionState, ProcessSessionState, SessionState
 from gateway.web.server import run_web_server
 
 logging.basicConfig(format='%(asctime)s - [%(levelname)s] %(name)s: %(message)s')
@@ -58,15 +72,173 @@ logger.setLevel(logging.DEBUG)
 # print(api.list_namespaced_pod(namespace="ssh-challenges"))
 
 
+def challenge_map_from_env(name: str, cast=int) -> dict:
+    """
+    Parses per-challenge settings from an environment variable, e.g. "catwalk=2,sweep=4"
+    """
+    values = {}
+    for item in os.getenv(name, "").split(","):
+        if "=" in item:
+            challenge, value = item.split("=", 1)
+            values[challenge.strip().lower()] = cast(value.strip())
+    return values
+
+
 class SSHGatewayServer(threading.Thread):
+    def __init__(self, reuse_port: bool = False):
+        super().__init__()
+        self.reuse_port = reuse_port
+        self.client_algorithms = AlgorithmPreferences.from_env("SSH")
+        self.backend_algorithms = AlgorithmPreferences.from_env("BACKEND")
+
     def run(self):
         run_ssh_server(ip_address=os.getenv("SSH_HOST", ""),
-                       port=2200, host_key_file="host.key", backend_key_file="backend.key")
+                       port=2200, host_key_files=os.getenv("SSH_HOST_KEYS", "host.key").split(","),
+                       backend_key_file=os.getenv("BACKEND_KEY", "backend.key"),
+                       backlog=int(os.getenv("SSH_BACKLOG", 128)), reuse_port=self.reuse_port,
+                       handshake_workers=int(os.getenv("SSH_HANDSHAKE_WORKERS", 32)),
+                       max_channels=max(1, int(os.getenv("SSH_MAX_CHANNELS", 10))),
+                       client_algorithms=self.client_algorithms, backend_algorithms=self.backend_algorithms)
+
+
+def register_process_gauges():
+    """
+    Gauges every gateway process reports, the main process and the SSH workers alike.
+    """
+    metrics.registry.gauge("gateway_threads", "Live threads in the process", threading.active_count)
+
+
+def register_gauges(kube_client: kube.KubeClient = None):
+    def pods_by_challenge():
+        pods = {}
+        for pod in kube_client.list_pods():
+            labels = pod.metadata.labels or {}
+            if "ctf_challenge" not in labels:
+                continue
+            key = (labels["ctf_challenge"].lower(), "assigned" if labels.get("ctf_team") else labels.get("ctf_pool"))
+            pods[key] = pods.get(key, 0) + 1
+        return pods
+
+    def active_sessions():
+        state = SessionState.get()
+        # Other replicas report their own sessions
+        if isinstance(state, ReplicaSessionState):
+            state = state.local
+        return len(state.list_sessions())
+
+    register_process_gauges()
+    metrics.registry.gauge("gateway_ssh_active_sessions", "Live SSH sessions, in every process of this replica",
+                           active_sessions)
+    metrics.registry.gauge("gateway_event_stream_subscribers", "Clients following the event stream",
+                           event_bus.subscribers)
+    if kube_client:
+        metrics.registry.gauge("gateway_pods", "Challenge pods, by challenge and state (assigned, warming or ready)",
+                               pods_by_challenge, labels=("challenge", "state"))
+
+
+def create_provisioning_scheduler(kube_client: kube.KubeClient) -> ProvisioningScheduler:
+    return ProvisioningScheduler(max_in_flight=int(os.getenv("PROVISION_CONCURRENCY", 16)),
+                                 max_in_flight_per_team=int(os.getenv("PROVISION_TEAM_CONCURRENCY", 2)),
+                                 max_pods_per_team=int(os.getenv("TEAM_MAX_PODS", 0)),
+                                 team_pods=kube_client.watcher.team_pods)
+
+
+def follow_pod_changes(kube_client: kube.KubeClient, publish: bool):
+    def on_change(change: str, pod):
+        if publish:
+            publish_pod_change(change, pod)
+        scheduler: ProvisioningScheduler = ProvisioningScheduler.get()
+        if scheduler and change == "deleted":
+            scheduler.pod_released()
+
+    kube_client.watcher.on_change = on_change
+
+
+def replica_name() -> str:
+    return os.getenv("GATEWAY_REPLICA") or socket.gethostname()
+
+
+def create_session_store() -> Optional[SQLiteSessionStore]:
+    """
+    The store shared with the other gateway replicas, if SESSION_STORE is set.
+    """
+    path = os.getenv("SESSION_STORE")
+    if not path:
+        return None
+    return SQLiteSessionStore(path)
+
+
+def start_parked_sessions():
+    """
+    Keeps the backends of disconnected sessions if DETACH_GRACE_PERIOD is set.
+    """
+    if CTF.detach_grace_period_s <= 0:
+        return
+    parked = ParkedSessions(CTF.detach_grace_period_s, max_sessions=int(os.getenv("DETACH_MAX_SESSIONS", 100)),
+                            scrollback_bytes=int(os.getenv("DETACH_SCROLLBACK_KB", 64)) * 1024)
+    ParkedSessions.INSTANCE = parked
+    parked.start()
+    metrics.registry.gauge("gateway_parked_sessions", "Backends kept for clients that may reconnect",
+                           lambda: parked.stats()["parked_now"])
+    metrics.registry.gauge("gateway_parked_scrollback_bytes", "Output buffered for parked sessions",
+                           lambda: parked.stats()["scrollback_bytes"])
+
+
+def start_recorder():
+    """
+    Records sessions if RECORDING_DIR is set.
+    """
+    directory = os.getenv("RECORDING_DIR")
+    if not directory:
+        return
+    SessionRecorder.INSTANCE = SessionRecorder(
+        directory,
+        compress=os.getenv("RECORDING_COMPRESS", "0") == "1",
+        buffer_size=int(os.getenv("RECORDING_BUFFER_KB", 512)) * 1024,
+        min_free_bytes=int(os.getenv("RECORDING_MIN_FREE_MB", 512)) * 1024 * 1024,
+        record_input=os.getenv("RECORDING_INPUT", "1") == "1",
+    )
+    SessionRecorder.INSTANCE.start()
 
 
 class WebServer(threading.Thread):
     def run(self):
-        run_web_server(os.getenv("WEB_HOST", "127.0.0.1"), 2201)
+        run_web_server(os.getenv("WEB_HOST", "127.0.0.1"), 2201, threads=int(os.getenv("WEB_THREADS", "4")),
+                       cache_ttl_s=float(os.getenv("WEB_CACHE_TTL", "1.0")),
+                       event_streams=int(os.getenv("WEB_EVENT_STREAMS", "2")))
+
+
+def run_ssh_worker(worker: int, state: ProcessSessionState):
+    """
+    A gateway worker process: it accepts SSH clients on the shared port and claims warm pods,
+    while the main process serves the web API, refills the warm pool and collects unused pods.
+    """
+    SessionState.INSTANCE = state
+    CTF.teams.start()
+    register_process_gauges()
+    kube_client = kube.connect_to_kube()
+    if kube_client:
+        kube_client.replica = replica_name()
+        follow_pod_changes(kube_client, publish=False)
+        WarmPodPool.INSTANCE = WarmPodPool(kube_client, refill=False)
+        ProvisioningScheduler.INSTANCE = create_provisioning_scheduler(kube_client)
+    start_recorder()
+    start_parked_sessions()
+    Reaper.INSTANCE = Reaper(None, connections, state)
+    Reaper.INSTANCE.start()
+
+    def stats():
+        return {
+            "sessions_closed": Reaper.INSTANCE.sessions_closed,
+            "pool": WarmPodPool.INSTANCE.counters() if WarmPodPool.INSTANCE else {},
+            "provisioning": provisioning_stats(),
+            "recording": SessionRecorder.INSTANCE.stats() if SessionRecorder.INSTANCE else {},
+            "parked": ParkedSessions.INSTANCE.stats() if ParkedSessions.INSTANCE else {},
+            "metrics": metrics.registry.collect(),
+        }
+
+    state.start_publisher(worker, connections, stats)
+    SSHGatewayServer(reuse_port=True).run()
 
 
 if __name__ == '__main__':
@@ -75,6 +247,54 @@ if __name__ == '__main__':
         category=CryptographyDeprecationWarning
     )
     CTF.load_teams()
-    kube.connect_to_kube()
+    CTF.default_warm_pool_size = int(os.getenv("WARM_POOL_SIZE", CTF.default_warm_pool_size))
+    CTF.warm_pool_sizes.update(challenge_map_from_env("WARM_POOL_SIZES"))
+    CTF.default_idle_timeout_s = float(os.getenv("SESSION_IDLE_TIMEOUT", CTF.default_idle_timeout_s))
+    CTF.idle_timeouts_s.update(challenge_map_from_env("SESSION_IDLE_TIMEOUTS", float))
+    CTF.default_pod_grace_period_s = float(os.getenv("POD_GRACE_PERIOD", CTF.default_pod_grace_period_s))
+    CTF.pod_grace_periods_s.update(challenge_map_from_env("POD_GRACE_PERIODS", float))
+    CTF.detach_grace_period_s = float(os.getenv("DETACH_GRACE_PERIOD", 0))
+    workers = int(os.getenv("SSH_WORKERS", 1))
+    store = create_session_store()
+    if store:
+        # Set before forking, so that the workers take leases too
+        ProvisioningLeases.INSTANCE = ProvisioningLeases(store, replica_name())
+    if workers > 1:
+        # The workers are forked, with the settings above, before this process starts any thread
+        context = multiprocessing.get_context("fork")
+        local_state = ProcessSessionState(context.Manager(), workers)
+        for worker in range(workers):
+            context.Process(target=run_ssh_worker, args=(worker, local_state),
+                            name=f"ssh-worker-{worker}", daemon=True).start()
+    else:
+        local_state = LocalSessionState(connections)
+    SessionState.INSTANCE = local_state
+    if store:
+        SessionState.INSTANCE = ReplicaSessionState(local_state, store, replica_name(),
+                                                    replica_timeout_s=float(os.getenv("REPLICA_TIMEOUT", 5.0)))
+        SessionState.INSTANCE.start()
+
+    CTF.teams.start()
+    if workers > 1:
+        local_state.start_event_relay(event_bus)
+    kube_client = kube.connect_to_kube()
+    register_gauges(kube_client)
+    if kube_client:
+        kube_client.replica = replica_name()
+        # Pod events are published by this process only, the workers have their own pod watchers
+        follow_pod_changes(kube_client, publish=True)
+        WarmPodPool.INSTANCE = WarmPodPool(kube_client)
+        WarmPodPool.INSTANCE.start()
+        if workers == 1:
+            ProvisioningScheduler.INSTANCE = create_provisioning_scheduler(kube_client)
+    if workers == 1:
+        start_recorder()
+        start_parked_sessions()
+    Reaper.INSTANCE = Reaper(kube_client, connections, SessionState.INSTANCE)
+    Reaper.INSTANCE.start()
     WebServer().start()
-    SSHGatewayServer().start()
+    if workers > 1:
+        for process in multiprocessing.active_children():
+            process.join()
+    else:
+        SSHGatewayServer().start()
@@ -1,11 +1,23 @@
+import logging
+import threading
+from concurrent.futures import CancelledError, Future
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Optional
+from time import monotonic
+from typing import Dict, Hashable, Optional, Set
 
 import paramiko
+from kubernetes.client import V1Pod
 
-from gateway.ssh import kube
+from gateway.ssh import kube, metrics
+from gateway.ssh.cluster import ProvisioningLeases
 from gateway.ssh.connection import ServerConnection
 from gateway.ssh.ctf import CTF
+from gateway.ssh.pool import WarmPodPool
+from gateway.ssh.provisioning import PositionCallback, ProvisioningScheduler, SingleFlight
+from gateway.ssh.trace import SessionTrace
+
+logger = logging.getLogger("gateway.backend")
 
 
 @dataclass
@@ -17,18 +29,80 @@ class BackendResource:
 
 
 def is_username_known(username: str) -> bool:
-    return username.lower() in CTF.team_names_lowercase()
+    return CTF.teams.is_known(username)
 
 
 def is_challenge_known(challenge: str) -> bool:
     return challenge.lower() in CTF.challenge_images.keys()
 
 
-def get_pod_backend(connection: ServerConnection, key: paramiko.PKey) -> Optional[BackendResource]:
+# Sessions of the same team for the same challenge share one lookup and one provisioning
+pod_provisioning = SingleFlight()
+
+
+class _Waiters:
+    """
+    The connections waiting for each team's pod. When every one of them is abandoned (their client went away)
+    before the pod's provisioning job leaves the scheduler's queue, the job is dropped.
+    """
+
+    def __init__(self):
+        self._waiting: Dict[Hashable, Set[str]] = {}
+        self._abandoned: Set[Hashable] = set()
+        self._jobs: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def join(self, key: Hashable, conn_id: str):
+        with self._lock:
+            self._waiting.setdefault(key, set()).add(conn_id)
+            self._abandoned.discard(key)
+
+    def leave(self, key: Hashable, conn_id: str, abandon: bool = False):
+        with self._lock:
+            waiting = self._waiting.get(key, set())
+            if conn_id not in waiting:
+                return
+            waiting.discard(conn_id)
+            if waiting:
+                return
+            del self._waiting[key]
+            if not abandon:
+                return
+            self._abandoned.add(key)
+            job = self._jobs.get(key)
+        if job and job.cancel():
+            logger.debug("Dropped the queued provisioning of %s, nobody is waiting for it anymore", key)
+
+    def queued(self, key: Hashable, job: Future):
+        with self._lock:
+            self._jobs[key] = job
+            abandoned = key in self._abandoned
+        if abandoned:
+            job.cancel()
+
+    def done(self, key: Hashable):
+        with self._lock:
+            self._jobs.pop(key, None)
+            self._abandoned.discard(key)
+
+
+pod_waiters = _Waiters()
+
+
+def provisioning_stats() -> dict:
+    scheduler: ProvisioningScheduler = ProvisioningScheduler.get()
+    stats = scheduler.stats() if scheduler else {}
+    stats.update(pod_provisioning.stats())
+    return stats
+
+
+def get_pod_backend(connection: ServerConnection, key: paramiko.PKey,
+                    on_position: PositionCallback = None) -> Optional[BackendResource]:
+    """
+    Finds or creates the pod of the connection's team for its challenge. New pods go through the provisioning
+    scheduler, which reports the session's position in its queue to `on_position`.
+    """
     kube_client: kube.KubeClient = kube.KubeClient.INSTANCE
-    challenge = connection.challenge.lower()
-    team_name = connection.server.username.lower()
-    challenge_image = CTF.challenge_images[connection.challenge.lower()]
 
     if not kube_client:
         # For testing purposes: outside of cluster
@@ -39,22 +113,156 @@ def get_pod_backend(connection: ServerConnection, key: paramiko.PKey) -> Optiona
             ssh_key=None
         )
 
-    pod_name = "chal-{}-{}".format(challenge.replace("_", ""), team_name)
-    pod = kube_client.create_pod(pod_name, challenge_image, CTF.capitalize_team_name(team_name), challenge.upper())
+    team = CTF.capitalize_team_name(connection.server.username)
+    challenge = connection.challenge.lower()
+    # Sessions joining another session's provisioning only see it in their trace as one "provisioning" span
+    pod_waiters.join((team.lower(), challenge), connection.id)
+    try:
+        return pod_provisioning.do((team.lower(), challenge),
+                                   lambda report_position: find_or_start_pod(kube_client, team, challenge, key,
+                                                                             report_position, connection.trace),
+                                   on_position)
+    finally:
+        pod_waiters.leave((team.lower(), challenge), connection.id)
+
+
+def start_provisioning(connection: ServerConnection, key: paramiko.PKey,
+                       on_position: PositionCallback = None) -> Future:
+    """
+    Runs get_pod_backend in the background, so that it overlaps with the client setting up its channel.
+    The future resolves to the backend, or to None if provisioning failed or was abandoned.
+    """
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(get_pod_backend(connection, key, on_position))
+        except CancelledError:
+            future.set_result(None)
+        except Exception as e:
+            future.set_exception(e)
 
+    threading.Thread(target=run, name=f"provisioning-{connection.id}", daemon=True).start()
+    return future
+
+
+def abandon_provisioning(connection: ServerConnection):
+    """
+    Called when a client whose provisioning was started goes away: its pod is no longer created if it is still
+    waiting in the scheduler's queue and no other session waits for it. A pod already being created is kept,
+    in case the client reconnects.
+    """
+    team = CTF.capitalize_team_name(connection.server.username)
+    pod_waiters.leave((team.lower(), connection.challenge.lower()), connection.id, abandon=True)
+
+
+@contextmanager
+def _phase(trace: Optional[SessionTrace], metric_phase: str, trace_phase: str):
+    start = monotonic()
+    try:
+        yield
+    finally:
+        end = monotonic()
+        metrics.provisioning_seconds.labels(metric_phase).observe(end - start)
+        if trace:
+            trace.add_span(trace_phase, start, end)
+
+
+def find_or_start_pod(kube_client: kube.KubeClient, team: str, challenge: str, key: paramiko.PKey,
+                      on_position: PositionCallback = None,
+                      trace: SessionTrace = None) -> Optional[BackendResource]:
+    with _phase(trace, "lookup", "pod_lookup"):
+        pod = kube_client.get_pod(team=team, challenge=challenge)
+    if pod:
+        return wait_for_pod(kube_client, pod, key, trace)
+
+    leases: ProvisioningLeases = ProvisioningLeases.get()
+    if not leases:
+        return provision_pod(kube_client, team, challenge, key, on_position, trace)
+    # With several replicas, only one of them claims or creates the team's pod
+    with _phase(trace, "lease", "provisioning_lease"):
+        acquired = leases.acquire(team, challenge)
+    if not acquired:
+        return None
+    try:
+        # The replica that held the lease before may have provisioned the pod
+        pod = kube_client.get_pod(team=team, challenge=challenge)
+        if pod:
+            return wait_for_pod(kube_client, pod, key, trace)
+        return provision_pod(kube_client, team, challenge, key, on_position, trace)
+    finally:
+        leases.release(team, challenge)
+
+
+def provision_pod(kube_client: kube.KubeClient, team: str, challenge: str, key: paramiko.PKey,
+                  on_position: PositionCallback = None,
+                  trace: SessionTrace = None) -> Optional[BackendResource]:
+    """
+    Claims a warm pod for the team, or creates one if the pool is empty.
+    A team that has as many pods as it may have waits in the scheduler's queue instead of claiming one.
+    """
+    pod_name = "chal-{}-{}".format(challenge.replace("_", ""), team.lower())
+    scheduler: ProvisioningScheduler = ProvisioningScheduler.get()
+    pool: WarmPodPool = WarmPodPool.get()
+    if pool and not (scheduler and scheduler.at_pod_limit(team, pod_name)):
+        with _phase(trace, "claim", "pool_claim"):
+            pod = pool.claim(challenge, team)
+        if pod:
+            # Warm pods are only handed out once their SSH port is available
+            return BackendResource(
+                ssh_hostname=pod.status.pod_ip,
+                ssh_port=CTF.pod_ssh_port,
+                ssh_username="guest",
+                ssh_key=key
+            )
+
+    challenge_image = CTF.challenge_images[challenge]
+    if not scheduler:
+        return start_pod(kube_client, pod_name, challenge_image, team, challenge, key, trace)
+
+    queued_at = monotonic()
+
+    def provision():
+        if trace:
+            trace.add_span("provisioning_queue", queued_at)
+        return start_pod(kube_client, pod_name, challenge_image, team, challenge, key, trace)
+
+    job = scheduler.submit(team, provision, on_position, pod_name)
+    pod_waiters.queued((team.lower(), challenge), job)
+    try:
+        return job.result()
+    finally:
+        pod_waiters.done((team.lower(), challenge))
+
+
+def start_pod(kube_client: kube.KubeClient, pod_name: str, image: str, team: str, challenge: str,
+              key: paramiko.PKey, trace: SessionTrace = None) -> Optional[BackendResource]:
+    """
+    Creates the team's pod and waits until its SSH port is available.
+    """
+    with _phase(trace, "create", "pod_create"):
+        pod = kube_client.create_pod(pod_name, image, team, challenge.upper())
     if not pod:
         return None
+    return wait_for_pod(kube_client, pod, key, trace)
 
-    pod_ip = kube_client.wait_until_pod_has_ip(pod, 30.0)
+
+def wait_for_pod(kube_client: kube.KubeClient, pod: V1Pod, key: paramiko.PKey,
+                 trace: SessionTrace = None) -> Optional[BackendResource]:
+    with _phase(trace, "ip", "pod_ip"):
+        pod_ip = kube_client.wait_until_pod_has_ip(pod, 30.0)
     if not pod_ip:
         return None
 
-    if not kube_client.wait_until_pod_port_available(pod, pod_ip, 22, 15.0):
-        return None
+    with _phase(trace, "port", "port_ready"):
+        if not kube_client.wait_until_pod_port_available(pod, pod_ip, CTF.pod_ssh_port, 15.0):
+            return None
 
     return BackendResource(
         ssh_hostname=pod_ip,
-        ssh_port=22,
+        ssh_port=CTF.pod_ssh_port,
         ssh_username="guest",
         ssh_key=key
     )
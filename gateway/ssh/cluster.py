@@ -0,0 +1,342 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from time import monotonic, sleep, time
+from typing import Dict, List, Optional, Set
+
+from gateway.ssh.state import SessionState, session_matches
+
+logger = logging.getLogger("gateway.cluster")
+
+
+class SessionStore:
+    """
+    Where gateway replicas share their sessions: every replica publishes a snapshot of its sessions with a
+    heartbeat, and reads the other replicas' snapshots. Replicas also send each other requests (kills, traces)
+    through the store, and take leases so that only one of them provisions a team's pod at a time.
+    """
+
+    def publish(self, replica: str, snapshot: dict):
+        raise NotImplementedError
+
+    def replicas(self, max_age_s: float) -> Dict[str, dict]:
+        """
+        The latest snapshot of every replica whose heartbeat is less than `max_age_s` old.
+        """
+        raise NotImplementedError
+
+    def send(self, replica: str, request: dict):
+        raise NotImplementedError
+
+    def receive(self, replica: str) -> List[dict]:
+        """
+        Takes the requests sent to the replica.
+        """
+        raise NotImplementedError
+
+    def reply(self, request_id: str, replica: str, value):
+        raise NotImplementedError
+
+    def replies(self, request_id: str) -> Dict[str, object]:
+        """
+        The replies to a request so far, by replica. Taking them forgets them.
+        """
+        raise NotImplementedError
+
+    def acquire(self, name: str, owner: str, ttl_s: float) -> bool:
+        """
+        Takes the lease `name` for `ttl_s` seconds, unless another owner holds it.
+        """
+        raise NotImplementedError
+
+    def release(self, name: str, owner: str):
+        raise NotImplementedError
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    A session store in an SQLite database, for replicas on the same host. The database must be on a local
+    filesystem: its write-ahead log relies on shared memory, which network filesystems do not provide.
+    """
+
+    def __init__(self, path: str, timeout_s: float = 5.0):
+        self.path = path
+        self.timeout_s = timeout_s
+        self._local = threading.local()
+        self._db().executescript("""
+            CREATE TABLE IF NOT EXISTS replicas (replica TEXT PRIMARY KEY, heartbeat REAL, snapshot TEXT);
+            CREATE TABLE IF NOT EXISTS requests (id INTEGER PRIMARY KEY AUTOINCREMENT, replica TEXT,
+                                                 request TEXT);
+            CREATE TABLE IF NOT EXISTS replies (request_id TEXT, replica TEXT, reply TEXT, created REAL,
+                                                PRIMARY KEY (request_id, replica));
+            CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires REAL);
+        """)
+
+    def _db(self) -> sqlite3.Connection:
+        # One connection per thread, and a new one in forked processes
+        db = getattr(self._local, "db", None)
+        if not db or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=self.timeout_s, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def publish(self, replica: str, snapshot: dict):
+        self._db().execute("INSERT OR REPLACE INTO replicas VALUES (?, ?, ?)",
+                           (replica, time(), json.dumps(snapshot)))
+
+    def replicas(self, max_age_s: float) -> Dict[str, dict]:
+        rows = self._db().execute("SELECT replica, heartbeat, snapshot FROM replicas WHERE heartbeat >= ?",
+                                  (time() - max_age_s,))
+        return {replica: dict(json.loads(snapshot), heartbeat=heartbeat) for replica, heartbeat, snapshot in rows}
+
+    def send(self, replica: str, request: dict):
+        self._db().execute("INSERT INTO requests (replica, request) VALUES (?, ?)", (replica, json.dumps(request)))
+
+    def receive(self, replica: str) -> List[dict]:
+        with self._transaction() as db:
+            rows = db.execute("SELECT id, request FROM requests WHERE replica = ? ORDER BY id", (replica,)).fetchall()
+            if rows:
+                db.execute("DELETE FROM requests WHERE replica = ? AND id <= ?", (replica, rows[-1][0]))
+        return [json.loads(request) for _, request in rows]
+
+    def reply(self, request_id: str, replica: str, value):
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?)",
+                       (request_id, replica, json.dumps(value), time()))
+            # Replies nobody took, e.g. to a request that timed out
+            db.execute("DELETE FROM replies WHERE created < ?", (time() - 60,))
+
+    def replies(self, request_id: str) -> Dict[str, object]:
+        with self._transaction() as db:
+            rows = db.execute("SELECT replica, reply FROM replies WHERE request_id = ?", (request_id,)).fetchall()
+            db.execute("DELETE FROM replies WHERE request_id = ?", (request_id,))
+        return {replica: json.loads(reply) for replica, reply in rows}
+
+    def acquire(self, name: str, owner: str, ttl_s: float) -> bool:
+        with self._transaction() as db:
+            row = db.execute("SELECT owner, expires FROM leases WHERE name = ?", (name,)).fetchone()
+            if row and row[0] != owner and row[1] > time():
+                return False
+            db.execute("INSERT OR REPLACE INTO leases VALUES (?, ?, ?)", (name, owner, time() + ttl_s))
+            return True
+
+    def release(self, name: str, owner: str):
+        self._db().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+
+class ReplicaSessionState(SessionState):
+    """
+    Session state of a gateway running as one of several replicas behind a load balancer.
+
+    The replica's own sessions come from its local session state (a single process or its workers). They are
+    published to the shared store every `heartbeat_interval_s`, and replicas whose heartbeat is older than
+    `replica_timeout_s` are considered gone. Listings cover every live replica, and kills and trace lookups for
+    another replica's sessions are sent to it through the store.
+    """
+
+    def __init__(self, local: SessionState, store: SessionStore, replica: str, heartbeat_interval_s: float = 1.0,
+                 replica_timeout_s: float = 5.0, request_timeout_s: float = 2.0):
+        self.local = local
+        self.store = store
+        self.replica = replica
+        self.heartbeat_interval_s = heartbeat_interval_s
+        self.replica_timeout_s = replica_timeout_s
+        self.request_timeout_s = request_timeout_s
+
+    def start(self):
+        threading.Thread(target=self._run, name="replica-heartbeat", daemon=True).start()
+
+    def list_sessions(self, team: str = None, challenge: str = None, client: str = None) -> List[dict]:
+        sessions = [dict(session, replica=self.replica)
+                    for session in self.local.list_sessions(team=team, challenge=challenge, client=client)]
+        for replica, snapshot in self._others().items():
+            sessions.extend(dict(session, replica=replica) for session in snapshot["sessions"]
+                            if session_matches(session, team, challenge, client))
+        return sessions
+
+    def get_session(self, conn_id: str) -> Optional[dict]:
+        session = self.local.get_session(conn_id)
+        if session:
+            return dict(session, replica=self.replica)
+        replica, session = self._find(conn_id)
+        return dict(session, replica=replica) if session else None
+
+    def kill(self, conn_id: str) -> bool:
+        if self.local.kill(conn_id):
+            return True
+        replica, _ = self._find(conn_id)
+        if not replica:
+            return False
+        self.store.send(replica, {"type": "kill", "id": conn_id})
+        return True
+
+    def get_trace(self, conn_id: str) -> Optional[dict]:
+        found = self.local.get_trace(conn_id)
+        if found:
+            return found
+        # Closed connections are not in the snapshots, so every live replica is asked
+        replicas = set(self._others())
+        if not replicas:
+            return None
+        request_id = uuid.uuid4().hex
+        for replica in replicas:
+            self.store.send(replica, {"type": "trace", "id": conn_id, "request_id": request_id})
+        replies = {}
+        deadline = monotonic() + self.request_timeout_s
+        while monotonic() < deadline:
+            replies.update(self.store.replies(request_id))
+            found = next((reply for reply in replies.values() if reply), None)
+            if found or replicas <= set(replies):
+                return found
+            sleep(0.05)
+        return None
+
+    def worker_stats(self) -> List[dict]:
+        return self.local.worker_stats()
+
+    def replicas(self) -> List[dict]:
+        now = time()
+        return [{
+            "replica": replica,
+            "self": replica == self.replica,
+            "pid": snapshot.get("pid"),
+            "sessions": len(snapshot["sessions"]),
+            "heartbeat_age_s": now - snapshot["heartbeat"],
+        } for replica, snapshot in sorted(self.store.replicas(self.replica_timeout_s).items())]
+
+    def _others(self) -> Dict[str, dict]:
+        try:
+            replicas = self.store.replicas(self.replica_timeout_s)
+        except Exception:
+            # The replica keeps serving its own sessions when the store is unavailable
+            logger.error("Could not read the other replicas' sessions", exc_info=1)
+            return {}
+        replicas.pop(self.replica, None)
+        return replicas
+
+    def _find(self, conn_id: str):
+        for replica, snapshot in self._others().items():
+            for session in snapshot["sessions"]:
+                if session["id"] == conn_id:
+                    return replica, session
+        return None, None
+
+    def _run(self):
+        next_heartbeat = 0.0
+        while True:
+            try:
+                if monotonic() >= next_heartbeat:
+                    self.store.publish(self.replica, {"pid": os.getpid(), "sessions": self.local.list_sessions()})
+                    next_heartbeat = monotonic() + self.heartbeat_interval_s
+                for request in self.store.receive(self.replica):
+                    self._handle(request)
+            except Exception:
+                logger.error("An error occurred while sharing sessions with the other replicas", exc_info=1)
+                sleep(self.heartbeat_interval_s)
+            # Requests are picked up more often than heartbeats are sent, so remote kills take effect quickly
+            sleep(min(0.1, self.heartbeat_interval_s))
+
+    def _handle(self, request: dict):
+        if request["type"] == "kill":
+            self.local.kill(request["id"])
+        elif request["type"] == "trace":
+            self.store.reply(request["request_id"], self.replica, self.local.get_trace(request["id"]))
+
+
+class ProvisioningLeases:
+    """
+    Leases in the shared store that make sure only one replica at a time claims or creates a team's pod for
+    a challenge. Other replicas wait for the lease, then find the pod its holder provisioned.
+    Held leases are renewed until they are released, however long provisioning waits in the scheduler's queue.
+    """
+    INSTANCE = None
+
+    def __init__(self, store: SessionStore, replica: str, ttl_s: float = 120.0, wait_s: float = 90.0,
+                 poll_interval_s: float = 0.25):
+        """
+        A lease expires after `ttl_s` without being renewed, in case its replica went away while provisioning.
+        """
+        self.store = store
+        self.replica = replica
+        self.ttl_s = ttl_s
+        self.wait_s = wait_s
+        self.poll_interval_s = poll_interval_s
+        self._held: Set[str] = set()
+        # Held while renewing, so that a lease is never renewed after it was released
+        self._lock = threading.Lock()
+        self._renewer_pid: Optional[int] = None
+
+    @staticmethod
+    def get():
+        return ProvisioningLeases.INSTANCE
+
+    @property
+    def owner(self) -> str:
+        # The workers of a replica provision independently of each other too
+        return f"{self.replica}:{os.getpid()}"
+
+    def acquire(self, team: str, challenge: str) -> bool:
+        """
+        Waits up to `wait_s` for the lease of the team's pod. Returns False if it could not be taken.
+        """
+        name = self._name(team, challenge)
+        deadline = monotonic() + self.wait_s
+        while True:
+            try:
+                if self.store.acquire(name, self.owner, self.ttl_s):
+                    self._hold(name)
+                    return True
+            except Exception:
+                logger.error("Could not take the provisioning lease %s", name, exc_info=1)
+            if monotonic() >= deadline:
+                return False
+            sleep(self.poll_interval_s)
+
+    def release(self, team: str, challenge: str):
+        name = self._name(team, challenge)
+        with self._lock:
+            self._held.discard(name)
+            try:
+                self.store.release(name, self.owner)
+            except Exception:
+                logger.error("Could not release the provisioning lease of %s for %s", team, challenge, exc_info=1)
+
+    def _hold(self, name: str):
+        with self._lock:
+            self._held.add(name)
+            # Started in the process that holds leases, the workers being forked before any of them is taken
+            if self._renewer_pid != os.getpid():
+                self._renewer_pid = os.getpid()
+                threading.Thread(target=self._renew, name="lease-renewer", daemon=True).start()
+
+    def _renew(self):
+        while True:
+            sleep(self.ttl_s / 3)
+            with self._lock:
+                for name in list(self._held):
+                    try:
+                        if not self.store.acquire(name, self.owner, self.ttl_s):
+                            logger.warning("The provisioning lease %s expired and was taken by another replica", name)
+                    except Exception:
+                        logger.error("Could not renew the provisioning lease %s", name, exc_info=1)
+
+    @staticmethod
+    def _name(team: str, challenge: str) -> str:
+        return f"pod/{team.lower()}/{challenge.lower()}"
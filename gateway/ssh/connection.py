@@ -1,12 +1,15 @@
 import logging
 import socket
-from dataclasses import dataclass
+import threading
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Any, Tuple
+from typing import Any, Dict, Optional, Tuple
 
 import paramiko
 
-from gateway.ssh import pty
+from gateway.ssh import pty, registry
+from gateway.ssh.recording import Recording
+from gateway.ssh.trace import SessionTrace
 
 logger = logging.getLogger("gateway.ssh")
 
@@ -23,17 +26,43 @@ class ServerConnection:
     addr: Tuple[str, int] = None
     challenge: str = None
     id: str = None
+    trace: SessionTrace = field(default_factory=SessionTrace)
+    recording: Optional[Recording] = None
+    # "shell", "exec" (which scp uses) or "sftp", with the command of exec sessions, set once requested
+    session_type: str = "shell"
+    command: Optional[bytes] = None
+    requested: threading.Event = field(default_factory=threading.Event)
+    # The sessions on the other channels of the client's transport
+    channels: Optional["ClientChannels"] = None
+    # Whether the backend may be parked when the client goes away, and whether the relay is handing it over
+    detachable: bool = False
+    detaching: bool = False
 
     def kill(self):
-        logger.debug("Connection with %s is closing", self.id)
-
+        self.close_client()
         if self.backend and not self.backend.closed:
             self.backend.close()
+
+    def close_client(self):
+        """
+        Closes the client side of the session, leaving the backend channel open. The client's transport is closed
+        with its last session.
+        """
+        logger.debug("Connection with %s is closing", self.id)
+        self.trace.close()
+        if self.recording:
+            self.recording.close()
+        registry.connections.remove(self)
+        remaining = self.channels.close(self) if self.channels is not None else 0
+
         if self.channel and not self.channel.closed:
             self.channel.close()
-        if self.transport and self.transport.active:
+        if not remaining and self.transport and self.transport.active:
             self.transport.close()
 
+    def shares_transport(self) -> bool:
+        return self.channels is not None and len(self.channels) > 1
+
     def is_alive(self) -> bool:
         if self.backend and self.backend.closed:
             return False
@@ -43,11 +72,65 @@ class ServerConnection:
             return False
         return True
 
+    def client_alive(self) -> bool:
+        # A client that only sent EOF, like `ssh host < script`, is still there to get the output and exit status
+        if self.channel and self.channel.closed:
+            return False
+        return bool(self.transport and self.transport.active)
+
+    def send_notice(self, text: str):
+        """
+        Shows a message from the gateway to the client: in the terminal of a shell, or on the standard error of
+        exec and SFTP sessions, whose output is data that the message must not corrupt.
+        """
+        if self.session_type == "shell":
+            self.channel.send(text)
+        else:
+            self.channel.send_stderr(text)
+
     def resize_backend(self):
-        if self.is_alive() and self.backend:
+        if self.is_alive() and self.backend and self.pty_dimensions:
             self.backend.resize_pty(
                 width=self.pty_dimensions.width,
                 height=self.pty_dimensions.height,
                 width_pixels=self.pty_dimensions.width_pixels,
                 height_pixels=self.pty_dimensions.height_pixels,
             )
+
+
+class ClientChannels:
+    """
+    The session channels open on a client's transport, each relayed as its own session, up to `max_channels`.
+    """
+
+    def __init__(self, max_channels: int):
+        self.max_channels = max_channels
+        self.opened = 0
+        self._sessions: Dict[int, ServerConnection] = {}
+        self._lock = threading.Lock()
+
+    def open(self, chanid: int, connection: ServerConnection) -> bool:
+        with self._lock:
+            if len(self._sessions) >= self.max_channels:
+                return False
+            self._sessions[chanid] = connection
+            self.opened += 1
+            return True
+
+    def get(self, chanid: int) -> Optional[ServerConnection]:
+        with self._lock:
+            return self._sessions.get(chanid)
+
+    def close(self, connection: ServerConnection) -> int:
+        """
+        Forgets the session, and returns how many are still open.
+        """
+        with self._lock:
+            for chanid, session in list(self._sessions.items()):
+                if session is connection:
+                    del self._sessions[chanid]
+            return len(self._sessions)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
@@ -0,0 +1,86 @@
+import logging
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import paramiko
+
+logger = logging.getLogger("gateway.ssh")
+
+
+# Tried in turn, as paramiko only detects the type of a key file itself from version 3.2 on
+KEY_TYPES = (paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey)
+
+
+def load_key(filename: str) -> paramiko.PKey:
+    """
+    Loads an Ed25519, ECDSA or RSA private key, whichever type the file holds.
+    """
+    errors = []
+    for key_type in KEY_TYPES:
+        try:
+            key = key_type.from_private_key_file(filename)
+        except (paramiko.SSHException, ValueError) as e:
+            errors.append(f"{key_type.__name__}: {e}")
+            continue
+        logger.debug("Loaded %s key from %s (%s)", key.get_name(), filename, key.get_fingerprint().hex())
+        return key
+    raise paramiko.SSHException(f"Could not load a private key from {filename} ({'; '.join(errors)})")
+
+
+def load_keys(filenames: Sequence[str]) -> List[paramiko.PKey]:
+    return [load_key(filename) for filename in filenames]
+
+
+def _parse_list(value: Optional[str]) -> Optional[Tuple[str, ...]]:
+    if not value:
+        return None
+    return tuple(item.strip() for item in value.split(",") if item.strip())
+
+
+class AlgorithmPreferences:
+    """
+    Cipher, key exchange, MAC and host key type preference lists for a paramiko Transport, most preferred first.
+    Lists left to None keep paramiko's defaults.
+    """
+
+    def __init__(self, ciphers: Sequence[str] = None, kex: Sequence[str] = None, macs: Sequence[str] = None,
+                 key_types: Sequence[str] = None):
+        self.ciphers = tuple(ciphers) if ciphers else None
+        self.kex = tuple(kex) if kex else None
+        self.macs = tuple(macs) if macs else None
+        self.key_types = tuple(key_types) if key_types else None
+        # Fail at startup rather than on the first handshake
+        for name, chosen, supported in (
+                ("cipher", self.ciphers, paramiko.Transport._preferred_ciphers),
+                ("key exchange", self.kex, paramiko.Transport._preferred_kex),
+                ("MAC", self.macs, paramiko.Transport._preferred_macs),
+                ("host key type", self.key_types, paramiko.Transport._preferred_keys)):
+            unknown = [algorithm for algorithm in chosen or () if algorithm not in supported]
+            if unknown:
+                raise ValueError(f"Unsupported {name} algorithms: {', '.join(unknown)}")
+
+    @staticmethod
+    def from_env(prefix: str) -> "AlgorithmPreferences":
+        """
+        Reads comma-separated lists from <prefix>_CIPHERS, <prefix>_KEX, <prefix>_MACS and <prefix>_HOST_KEY_TYPES.
+        """
+        return AlgorithmPreferences(
+            ciphers=_parse_list(os.getenv(f"{prefix}_CIPHERS")),
+            kex=_parse_list(os.getenv(f"{prefix}_KEX")),
+            macs=_parse_list(os.getenv(f"{prefix}_MACS")),
+            key_types=_parse_list(os.getenv(f"{prefix}_HOST_KEY_TYPES")),
+        )
+
+    def apply(self, transport: paramiko.Transport):
+        """
+        Must be called before the transport is started.
+        """
+        options = transport.get_security_options()
+        if self.ciphers:
+            options.ciphers = self.ciphers
+        if self.kex:
+            options.kex = self.kex
+        if self.macs:
+            options.digests = self.macs
+        if self.key_types:
+            options.key_types = self.key_types
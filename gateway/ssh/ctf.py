@@ -21,21 +21,17 @@ It should probably be moved to a non-version controlled configuration file later
 #     "RuthlessDetectives",
 #     "CrimsonAstronauts"
 # )
-import json
-from pathlib import Path
 from typing import Tuple, Dict
 
+from gateway.ssh.teams import TeamDirectory
+
 
 class CTF:
-    _teams: Dict[str, str] = {}
+    teams = TeamDirectory("teams.json")
 
     @staticmethod
     def team_names() -> Tuple[str]:
-        return tuple(CTF._teams.keys())
-
-    @staticmethod
-    def team_names_lowercase() -> Tuple[str]:
-        return tuple(team.lower() for team in CTF._teams.keys())
+        return CTF.teams.team_names()
 
     challenge_images = {
         "catwalk": "momothereal/ctf-linux-linux-cat",
@@ -54,17 +50,46 @@ class CTF:
         "tcp_madness": "momothereal/ctf-reverse-tcp-madness"
     }
 
+    # Port of the SSH server in the challenge pods
+    pod_ssh_port = 22
+
+    # Number of unassigned pods kept ready for each challenge. Challenges not listed use the default.
+    default_warm_pool_size = 1
+    warm_pool_sizes: Dict[str, int] = {}
+
+    @staticmethod
+    def warm_pool_size(challenge: str) -> int:
+        return CTF.warm_pool_sizes.get(challenge.lower(), CTF.default_warm_pool_size)
+
+    # Seconds without input after which a session is closed
+    default_idle_timeout_s = 3600.0
+    idle_timeouts_s: Dict[str, float] = {}
+
+    @staticmethod
+    def idle_timeout_s(challenge: str) -> float:
+        return CTF.idle_timeouts_s.get(challenge.lower(), CTF.default_idle_timeout_s)
+
+    # Seconds a team's pod is kept without any session attached to it
+    default_pod_grace_period_s = 1800.0
+    pod_grace_periods_s: Dict[str, float] = {}
+
+    # Seconds the shell of a disconnected client is kept for it to reattach
+    detach_grace_period_s = 0.0
+
+    @staticmethod
+    def pod_grace_period_s(challenge: str) -> float:
+        # Parked shells are not listed as sessions, so their pod is kept at least as long as they are
+        return max(CTF.pod_grace_periods_s.get(challenge.lower(), CTF.default_pod_grace_period_s),
+                   CTF.detach_grace_period_s)
+
     @staticmethod
     def capitalize_team_name(team_name: str):
-        for team in CTF._teams:
-            if team.lower() == team_name.lower():
-                return team
-        return team_name
+        return CTF.teams.canonical_name(team_name) or team_name
 
     @staticmethod
     def load_teams() -> None:
-        CTF._teams = json.loads(Path("teams.json").read_text())
+        CTF.teams.load()
 
     @staticmethod
     def check_password(team: str, password: str):
-        return CTF._teams.get(CTF.capitalize_team_name(team)) == password
+        return CTF.teams.authenticate(team, password) is not None
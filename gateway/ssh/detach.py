@@ -0,0 +1,220 @@
+import logging
+import selectors
+import socket
+import threading
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+import paramiko
+
+from gateway.ssh import metrics
+from gateway.ssh.connection import ServerConnection
+from gateway.ssh.events import event_bus
+
+logger = logging.getLogger("gateway.detach")
+
+_parked = metrics.registry.counter("gateway_sessions_parked", "Sessions whose backend was kept after the client left")
+_reattached = metrics.registry.counter("gateway_sessions_reattached", "Parked sessions a reconnecting client resumed")
+
+
+class ParkedSession:
+    """
+    The backend channel of a session whose client went away, and the output it produced since.
+    """
+
+    def __init__(self, connection: ServerConnection, scrollback_bytes: int, unsent: bytes = b""):
+        self.id = connection.id
+        self.team = connection.server.username
+        self.challenge = connection.challenge
+        self.backend: paramiko.Channel = connection.backend
+        self.parked_at = monotonic()
+        self.scrollback_bytes = scrollback_bytes
+        self.scrollback = bytearray()
+        self.append(unsent)
+        self.fd: Optional[int] = None
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return self.team.lower(), self.challenge.lower()
+
+    def append(self, data: bytes):
+        self.scrollback += data
+        if len(self.scrollback) > self.scrollback_bytes:
+            # The oldest output is dropped
+            del self.scrollback[:len(self.scrollback) - self.scrollback_bytes]
+
+
+class ParkedSessions:
+    """
+    Keeps the backend shells of sessions whose client disconnected for `grace_period_s`, so that a reconnect
+    with the same team and challenge resumes the shell instead of starting a new one.
+
+    A single thread reads the output of every parked backend into its scrollback buffer, keeping at most
+    `scrollback_bytes` of it, which is replayed to the client that reattaches. At most `max_sessions` are parked
+    at once, so memory stays under `max_sessions * scrollback_bytes`; sessions beyond that are closed as before.
+    """
+    INSTANCE = None
+
+    def __init__(self, grace_period_s: float = 300.0, max_sessions: int = 100, scrollback_bytes: int = 64 * 1024):
+        self.grace_period_s = grace_period_s
+        self.max_sessions = max_sessions
+        self.scrollback_bytes = scrollback_bytes
+        self.parked = 0
+        self.reattached = 0
+        self.expired = 0
+        self.rejected = 0
+        self.selector = selectors.DefaultSelector()
+        self._sessions: Dict[str, ParkedSession] = {}
+        # Registered and unregistered by the parking thread only
+        self._registering: List[ParkedSession] = []
+        self._unregistering: List[ParkedSession] = []
+        self._lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ)
+
+    @staticmethod
+    def get():
+        return ParkedSessions.INSTANCE
+
+    def start(self):
+        threading.Thread(target=self._run, name="parked-sessions", daemon=True).start()
+
+    def park(self, connection: ServerConnection, unsent: bytes = b"") -> bool:
+        """
+        Takes over the connection's backend channel, and closes its client side. `unsent` is output that was read
+        from the backend but never reached the client. Returns False if no more sessions can be parked.
+        """
+        with self._lock:
+            if len(self._sessions) >= self.max_sessions:
+                self.rejected += 1
+                return False
+            session = ParkedSession(connection, self.scrollback_bytes, unsent)
+            self._sessions[session.id] = session
+            self._registering.append(session)
+            self.parked += 1
+        _parked.inc()
+        self._wakeup()
+        connection.close_client()
+        logger.info("Parked the backend of %s for %ss", connection.id, self.grace_period_s)
+        event_bus.publish("session_parked", id=connection.id, team=session.team, challenge=session.challenge,
+                          grace_period_s=self.grace_period_s)
+        return True
+
+    def reattach(self, team: str, challenge: str) -> Optional[ParkedSession]:
+        """
+        Hands over the most recently parked session of the team for the challenge, if its backend is still open.
+        """
+        key = (team.lower(), challenge.lower())
+        with self._lock:
+            candidates = [session for session in self._sessions.values()
+                          if session.key == key and not session.backend.closed]
+            if not candidates:
+                return None
+            session = max(candidates, key=lambda candidate: candidate.parked_at)
+            self._release(session)
+            self.reattached += 1
+        _reattached.inc()
+        self._wakeup()
+        event_bus.publish("session_reattached", id=session.id, team=session.team, challenge=session.challenge,
+                          parked_s=monotonic() - session.parked_at)
+        return session
+
+    def stats(self) -> dict:
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            "parked_now": len(sessions),
+            "scrollback_bytes": sum(len(session.scrollback) for session in sessions),
+            "max_sessions": self.max_sessions,
+            "max_scrollback_bytes": self.max_sessions * self.scrollback_bytes,
+            "parked": self.parked,
+            "reattached": self.reattached,
+            "expired": self.expired,
+            "rejected": self.rejected,
+        }
+
+    def _release(self, session: ParkedSession):
+        # Called with the lock held
+        del self._sessions[session.id]
+        if session in self._registering:
+            self._registering.remove(session)
+        else:
+            self._unregistering.append(session)
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _run(self):
+        while True:
+            try:
+                self._step()
+            except Exception:
+                logger.error("An error occurred while reading parked sessions", exc_info=1)
+
+    def _step(self):
+        with self._lock:
+            registering, self._registering = self._registering, []
+            unregistering, self._unregistering = self._unregistering, []
+        for session in unregistering:
+            try:
+                self.selector.unregister(session.fd)
+            except (KeyError, ValueError):
+                pass
+        for session in registering:
+            session.fd = session.backend.fileno()
+            self.selector.register(session.fd, selectors.EVENT_READ, session)
+
+        closed = []
+        for key, _ in self.selector.select(1.0):
+            if key.fileobj is self._wakeup_r:
+                try:
+                    while self._wakeup_r.recv(512):
+                        pass
+                except (BlockingIOError, InterruptedError):
+                    pass
+                continue
+            session = key.data
+            # Held while reading, so that a reattaching client gets everything that was read
+            with self._lock:
+                if session.id not in self._sessions:
+                    continue
+                try:
+                    data = session.backend.recv(65536)
+                except Exception:
+                    data = b""
+                if data:
+                    session.append(data)
+                else:
+                    self._release(session)
+                    closed.append(session)
+
+        now = monotonic()
+        with self._lock:
+            expired = [session for session in self._sessions.values()
+                       if now - session.parked_at >= self.grace_period_s]
+            for session in expired:
+                self._release(session)
+            self.expired += len(expired)
+        for session in expired:
+            logger.info("Closing the parked backend of %s, nobody reattached within %ss", session.id,
+                        self.grace_period_s)
+        for session in closed + expired:
+            session.backend.close()
+
+
+def finish(connection: ServerConnection, unsent: bytes = b""):
+    """
+    Ends a relayed session: its backend is parked if the client went away while the shell was still running,
+    otherwise the whole session is closed.
+    """
+    parked: ParkedSessions = ParkedSessions.get()
+    backend = connection.backend
+    if parked and connection.detachable and backend and not backend.closed and not backend.eof_received \
+            and not connection.client_alive() and parked.park(connection, unsent):
+        return
+    connection.kill()
@@ -0,0 +1,111 @@
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Deque, List, Optional, Sequence
+
+logger = logging.getLogger("gateway.events")
+
+
+class Subscription:
+    """
+    The events waiting to be sent to one subscriber. When more than `max_queued` are waiting, the subscriber
+    is too slow: it is dropped, and the events already queued are its last ones.
+    """
+
+    def __init__(self, max_queued: int, types: Optional[Sequence[str]] = None):
+        self.max_queued = max_queued
+        self.types = frozenset(types) if types else None
+        self.dropped = False
+        self._queue: Deque[dict] = deque()
+        self._condition = threading.Condition()
+
+    def push(self, event: dict) -> bool:
+        """
+        Queues the event, unless the subscriber already has too many waiting. Returns False if it was dropped.
+        """
+        if self.types and event["type"] not in self.types:
+            return True
+        with self._condition:
+            if self.dropped:
+                return False
+            if len(self._queue) >= self.max_queued:
+                self.dropped = True
+                self._condition.notify()
+                return False
+            self._queue.append(event)
+            self._condition.notify()
+            return True
+
+    def get(self, timeout_s: float) -> Optional[dict]:
+        """
+        The next event, or None if there was none within the timeout or the subscriber was dropped.
+        """
+        with self._condition:
+            if not self._queue and not self.dropped:
+                self._condition.wait(timeout_s)
+            return self._queue.popleft() if self._queue else None
+
+
+class EventBus:
+    """
+    Publishes what happens in the gateway (sessions opening and closing, pods starting, provisioning failures)
+    to the subscribers of the web server's event stream. Publishing never blocks: subscribers that fall behind
+    are dropped. The latest events are kept, so that a subscriber reconnecting can resume where it stopped.
+    """
+
+    def __init__(self, history_size: int = 256):
+        self.published = 0
+        self.dropped_subscribers = 0
+        self._subscriptions: List[Subscription] = []
+        self._history: Deque[dict] = deque(maxlen=history_size)
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def publish(self, type: str, **data):
+        # Queuing is a few list operations per subscriber, so it happens under the lock to keep events in order
+        with self._lock:
+            event = {"id": self._next_id, "type": type, "time": datetime.utcnow().timestamp(), "data": data}
+            self._next_id += 1
+            self.published += 1
+            self._history.append(event)
+            dropped = [subscription for subscription in self._subscriptions if not subscription.push(event)]
+            if dropped:
+                self.dropped_subscribers += len(dropped)
+                self._subscriptions = [subscription for subscription in self._subscriptions
+                                       if subscription not in dropped]
+        if dropped:
+            logger.info("Dropped %s event stream subscribers that were falling behind", len(dropped))
+
+    def subscribe(self, max_queued: int = 1000, types: Sequence[str] = None, after_id: int = None) -> Subscription:
+        """
+        Events published from now on, preceded by the kept events that came after `after_id` if it is given.
+        """
+        subscription = Subscription(max_queued, types)
+        with self._lock:
+            if after_id is not None:
+                for event in self._history:
+                    if event["id"] > after_id:
+                        subscription.push(event)
+            self._subscriptions = self._subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions = [other for other in self._subscriptions if other is not subscription]
+
+    def subscribers(self) -> int:
+        return len(self._subscriptions)
+
+
+event_bus = EventBus()
+
+
+def publish_pod_change(change: str, pod):
+    """
+    A PodWatcher.on_change callback publishing pod_created, pod_ready and pod_deleted events.
+    """
+    labels = pod.metadata.labels or {}
+    event_bus.publish(f"pod_{change}", name=pod.metadata.name, team=labels.get("ctf_team"),
+                      challenge=labels.get("ctf_challenge"), pool=labels.get("ctf_pool"),
+                      ip=pod.status.pod_ip if pod.status else None)
@@ -1,88 +1,226 @@
 import logging
-import socket
+import uuid
+from concurrent.futures import TimeoutError
 from datetime import datetime
-from time import sleep
-from typing import Optional
+from typing import Optional, List
 
 from kubernetes import client, config
+from kubernetes.client.rest import ApiException
+
+from gateway.ssh import metrics
+from gateway.ssh.ctf import CTF
+from gateway.ssh.probe import PortProber
+from gateway.ssh.watch import PodWatcher, PodTerminated
 
 logger = logging.getLogger("gateway.kube")
 
 
+class _TimedApi:
+    """
+    Wraps the Kubernetes API so that every call is recorded in the API latency histogram, by method name.
+    """
+
+    def __init__(self, api: client.CoreV1Api):
+        self._api = api
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._api, name)
+        if not callable(attribute):
+            return attribute
+        latency = metrics.kube_api_seconds.labels(name)
+
+        def timed(*args, **kwargs):
+            with latency.time():
+                return attribute(*args, **kwargs)
+
+        return timed
+
+
 class KubeClient:
     INSTANCE = None
 
-    def __init__(self, api: client.CoreV1Api):
-        self.api = api
+    def __init__(self, api: client.CoreV1Api, watcher: PodWatcher, prober: PortProber):
+        self.api = _TimedApi(api)
+        self.watcher = watcher
+        self.prober = prober
+        # The gateway replica recorded as the owner of the team pods this process provisions
+        self.replica: Optional[str] = None
 
     @staticmethod
     def get():
         return KubeClient.INSTANCE
 
     def create_pod(self, name: str, image: str, team: str, challenge: str) -> Optional[client.V1Pod]:
+        pod = self.get_pod(team=team, challenge=challenge)
+        if pod:
+            return pod
+
         try:
-            pod = self.api.read_namespaced_pod(name=f"{name}-p", namespace="ctf")
-            if pod:
-                return pod
-        except:
-            pass
+            return self._create_pod(name, image, labels={
+                "ctf_team": team,
+                "ctf_challenge": challenge
+            }, annotations=self._ownership())
+        except ApiException as e:
+            if e.status == 409:
+                return self._existing_pod(f"{name}-p")
+            logger.error(f"Error while creating pod {name}", exc_info=e)
+            return None
+        except Exception as e:
+            logger.error(f"Error while creating pod {name}", exc_info=e)
+            return None
 
+    def _existing_pod(self, name: str) -> Optional[client.V1Pod]:
+        """
+        The pod that another session or replica created in the meantime, from the pod index once it has seen it.
+        """
+        pod = self.watcher.get(name)
+        if pod:
+            return pod
         try:
-            container = client.V1Container(
-                name=f"{name}-c",
-                image=image,
-                image_pull_policy="Never"
-            )
-            spec = client.V1PodSpec(containers=[container])
-            metadata = client.V1ObjectMeta(
-                name=f"{name}-p",
-                labels={
+            return self.api.read_namespaced_pod(name=name, namespace="ctf")
+        except Exception as e:
+            logger.error(f"Error while reading pod {name}, which already exists", exc_info=e)
+            return None
+
+    def create_warm_pod(self, image: str, challenge: str) -> Optional[client.V1Pod]:
+        """
+        Creates a pod for the given challenge that is not yet assigned to a team.
+        It can later be handed to a team with `claim_pod`.
+        """
+        name = "warm-{}-{}".format(challenge.replace("_", "").lower(), uuid.uuid4().hex[:8])
+        try:
+            return self._create_pod(name, image, labels={
+                "ctf_challenge": challenge,
+                "ctf_pool": "warming"
+            })
+        except Exception as e:
+            logger.error(f"Error while creating warm pod {name}", exc_info=e)
+            return None
+
+    def claim_pod(self, pod: client.V1Pod, team: str, challenge: str) -> Optional[client.V1Pod]:
+        """
+        Assigns a warm pod to a team by relabelling it.
+        The patch is conditional on the pod's resource version, so a pod can only be claimed once.
+        """
+        body = {
+            "metadata": {
+                "resourceVersion": pod.metadata.resource_version,
+                "labels": {
                     "ctf_team": team,
-                    "ctf_challenge": challenge
-                }
-            )
-            pod = client.V1Pod(metadata=metadata, spec=spec)
-            return self.api.create_namespaced_pod(namespace="ctf", body=pod)
+                    "ctf_challenge": challenge,
+                    "ctf_pool": None
+                },
+                "annotations": self._ownership()
+            }
+        }
+        try:
+            return self.api.patch_namespaced_pod(name=pod.metadata.name, namespace="ctf", body=body)
         except Exception as e:
-            logger.error(f"Error while creating pod {name}", exc_info=e)
+            logger.warning("Failed to claim warm pod %s for %s", pod.metadata.name, team, exc_info=e)
+            return None
+
+    def read_pod(self, pod: client.V1Pod) -> Optional[client.V1Pod]:
+        """
+        The current version of the pod, or None if it is gone or could not be read.
+        """
+        try:
+            return self.api.read_namespaced_pod(name=pod.metadata.name, namespace="ctf")
+        except Exception as e:
+            logger.debug("Could not read pod %s", pod.metadata.name, exc_info=e)
             return None
 
+    def list_pods(self) -> List[client.V1Pod]:
+        if self.watcher.is_synced():
+            return self.watcher.list()
+        return self.api.list_namespaced_pod(namespace="ctf").items
+
+    def mark_warm_pod_ready(self, pod: client.V1Pod) -> Optional[client.V1Pod]:
+        body = {"metadata": {"labels": {"ctf_pool": "ready"}}}
+        try:
+            return self.api.patch_namespaced_pod(name=pod.metadata.name, namespace="ctf", body=body)
+        except Exception as e:
+            logger.warning("Failed to mark warm pod %s as ready", pod.metadata.name, exc_info=e)
+            return None
+
+    def list_warm_pods(self) -> List[client.V1Pod]:
+        if self.watcher.is_synced():
+            return [pod for pod in self.watcher.list() if (pod.metadata.labels or {}).get("ctf_pool")]
+        try:
+            return self.api.list_namespaced_pod(namespace="ctf", label_selector="ctf_pool").items
+        except Exception as e:
+            logger.error("Error while listing warm pods", exc_info=e)
+            return []
+
+    def delete_pod(self, pod: client.V1Pod) -> bool:
+        try:
+            self.api.delete_namespaced_pod(name=pod.metadata.name, namespace=pod.metadata.namespace,
+                                           grace_period_seconds=0)
+            return True
+        except Exception as e:
+            logger.warning("Failed to delete pod %s", pod.metadata.name, exc_info=e)
+            return False
+
+    def _ownership(self) -> dict:
+        """
+        Annotations recording which replica provisioned a team pod, and when. They are for operators only:
+        replicas are kept from provisioning the same pod by the provisioning leases, and pod names for creations.
+        """
+        if not self.replica:
+            return {}
+        return {"ctf_owner": self.replica, "ctf_provisioned_at": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")}
+
+    def _create_pod(self, name: str, image: str, labels: dict, annotations: dict = None) -> client.V1Pod:
+        container = client.V1Container(
+            name=f"{name}-c",
+            image=image,
+            image_pull_policy="Never"
+        )
+        spec = client.V1PodSpec(containers=[container])
+        metadata = client.V1ObjectMeta(
+            name=f"{name}-p",
+            labels=labels,
+            annotations=annotations or None
+        )
+        pod = client.V1Pod(metadata=metadata, spec=spec)
+        return self.api.create_namespaced_pod(namespace="ctf", body=pod)
+
     def wait_until_pod_has_ip(self, pod: client.V1Pod, timeout_s: float) -> Optional[str]:
-        max_time = datetime.now().timestamp() + timeout_s
+        if pod.status and pod.status.pod_ip:
+            return pod.status.pod_ip
         logger.debug("Waiting for pod %s to be available", pod.metadata.name)
+        future = self.watcher.wait_for_ip(pod.metadata.name)
         try:
-            while True:
-                if max_time < datetime.now().timestamp():
-                    return None
-                sleep(0.5)
-                status = self.api.read_namespaced_pod_status(
-                    name=pod.metadata.name, namespace=pod.metadata.namespace).status
-                if str(status.pod_ip) != "None":
-                    return status.pod_ip
+            return future.result(timeout_s)
+        except TimeoutError:
+            logger.debug("Timed out waiting for pod %s", pod.metadata.name)
+            return None
+        except PodTerminated as e:
+            logger.warning("Pod %s will never be available: %s", pod.metadata.name, e)
+            return None
         except Exception as e:
             logger.error(f"Error while waiting for pod {pod.metadata.name}", exc_info=e)
             return None
+        finally:
+            self.watcher.unsubscribe(pod.metadata.name, future)
 
     def wait_until_pod_port_available(self, pod: client.V1Pod, pod_ip: str, port: int, timeout_s: float) -> bool:
-        max_time = datetime.now().timestamp() + timeout_s
         logger.debug("Waiting for port %s:%s on %s to be available", pod_ip, port, pod.metadata.name)
         try:
-            while True:
-                if max_time < datetime.now().timestamp():
-                    return False
-                sleep(0.25)
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                if sock.connect_ex((pod_ip, port)) == 0:
-                    return True
+            # The prober enforces the timeout itself, the extra second only guards against a stuck prober
+            return self.prober.probe(pod_ip, port, timeout_s).result(timeout_s + 1.0)
         except Exception as e:
             logger.error(f"Error while waiting for pod port {pod.metadata.name} -> {port}", exc_info=e)
             return False
 
-    def get_pod(self, team: str = None, challenge: str = None) -> client.V1Pod:
-        pod_name = "chal-{}-{}-p".format(challenge.replace("_", ""), team).lower()
-        namespace = "ctf"
+    def get_pod(self, team: str = None, challenge: str = None) -> Optional[client.V1Pod]:
+        if self.watcher.is_synced():
+            return self.watcher.find(team, challenge)
+
+        # Created and claimed pods carry the same labels, so a single list finds either
+        selector = "ctf_team={},ctf_challenge={}".format(CTF.capitalize_team_name(team), challenge.upper())
         try:
-            return self.api.read_namespaced_pod(pod_name, namespace)
+            pods = self.api.list_namespaced_pod("ctf", label_selector=selector).items
+            return pods[0] if pods else None
         except:
             return None
 
@@ -100,5 +238,9 @@ def connect_to_kube() -> Optional[KubeClient]:
         logger.info("Connected via kubectl instead of in-cluster. Dev mode?")
 
     api = client.CoreV1Api()
-    KubeClient.INSTANCE = KubeClient(api)
+    watcher = PodWatcher.for_api(api)
+    watcher.start()
+    prober = PortProber()
+    prober.start()
+    KubeClient.INSTANCE = KubeClient(api, watcher, prober)
     return KubeClient.INSTANCE
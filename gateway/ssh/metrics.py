@@ -0,0 +1,310 @@
+"""
+In-process metrics, exposed in the Prometheus text format on the admin web server's /metrics route.
+
+Counters and histograms are updated without locks: each thread updates its own cell, and a scrape sums the cells.
+Cells of threads that have ended are folded into a base value on the next scrape.
+"""
+import math
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import monotonic
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# A metric family, as sent between processes: (name, type, help, [(suffix, labels, value)])
+Family = Tuple[str, str, str, List[Tuple[str, Dict[str, str], float]]]
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Cells:
+    """
+    Per-thread cells of `size` values, summed on demand.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        # Updaters read their cell from `local.cell` directly, and call cell() if it does not exist yet
+        self.local = threading.local()
+        self._cells: List[Tuple[threading.Thread, List[float]]] = []
+        self._base = [0.0] * size
+        self._lock = threading.Lock()
+
+    def cell(self) -> List[float]:
+        try:
+            return self.local.cell
+        except AttributeError:
+            cell = self.local.cell = [0.0] * self.size
+            with self._lock:
+                self._cells.append((threading.current_thread(), cell))
+            return cell
+
+    def sum(self) -> List[float]:
+        with self._lock:
+            alive = []
+            for thread, cell in self._cells:
+                if thread.is_alive():
+                    alive.append((thread, cell))
+                else:
+                    # The thread will not write to its cell anymore
+                    for i in range(self.size):
+                        self._base[i] += cell[i]
+            self._cells = alive
+            total = list(self._base)
+            for _, cell in alive:
+                for i in range(self.size):
+                    total[i] += cell[i]
+            return total
+
+
+class CounterChild:
+    __slots__ = ("_cells", "_local")
+
+    def __init__(self):
+        self._cells = _Cells(1)
+        self._local = self._cells.local
+
+    def inc(self, amount: float = 1):
+        try:
+            self._local.cell[0] += amount
+        except AttributeError:
+            self._cells.cell()[0] += amount
+
+    def value(self) -> float:
+        return self._cells.sum()[0]
+
+
+class HistogramChild:
+    __slots__ = ("buckets", "_cells", "_local")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        # One count per bucket, the +Inf bucket, then the sum
+        self._cells = _Cells(len(self.buckets) + 2)
+        self._local = self._cells.local
+
+    def observe(self, value: float):
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._cells.cell()
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    @contextmanager
+    def time(self):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start)
+
+    def values(self) -> Tuple[List[float], float]:
+        """
+        Cumulative bucket counts (the last one being +Inf, the total count), and the sum of observed values.
+        """
+        summed = self._cells.sum()
+        cumulative, count = [], 0.0
+        for bucket_count in summed[:-1]:
+            count += bucket_count
+            cumulative.append(count)
+        return cumulative, summed[-1]
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.label_names:
+            self._unlabelled = self._children[()] = self._new_child()
+            self._bind(self._unlabelled)
+
+    def labels(self, *values: str):
+        """
+        The metric for these label values. Hot paths should keep the result rather than call this on every update.
+        """
+        child = self._children.get(values)
+        if child is None:
+            child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _bind(self, child):
+        # Updates of metrics without labels go straight to their only child
+        pass
+
+    def _samples(self, labels: Dict[str, str], child) -> List[Tuple[str, Dict[str, str], float]]:
+        raise NotImplementedError
+
+    def collect(self) -> Family:
+        samples = []
+        for values, child in list(self._children.items()):
+            samples += self._samples(dict(zip(self.label_names, values)), child)
+        return self.name, self.type, self.help, samples
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1):
+        self._unlabelled.inc(amount)
+
+    def _bind(self, child: "CounterChild"):
+        self.inc = child.inc
+
+    def _new_child(self):
+        return CounterChild()
+
+    def _samples(self, labels, child: CounterChild):
+        return [("_total", labels, child.value())]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labels)
+
+    def observe(self, value: float):
+        self._unlabelled.observe(value)
+
+    def time(self):
+        return self._unlabelled.time()
+
+    def _bind(self, child: "HistogramChild"):
+        self.observe = child.observe
+        self.time = child.time
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def _samples(self, labels, child: HistogramChild):
+        cumulative, total = child.values()
+        samples = [("_bucket", dict(labels, le=_format_value(bound)), count)
+                   for bound, count in zip(self.buckets + (math.inf,), cumulative)]
+        samples.append(("_sum", labels, total))
+        samples.append(("_count", labels, cumulative[-1]))
+        return samples
+
+
+class Gauge:
+    """
+    A value read when metrics are collected. `read` returns either a number,
+    or a dict from label values (tuples) to numbers.
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, read: Callable, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.label_names = tuple(labels)
+
+    def collect(self) -> Family:
+        value = self.read()
+        if not isinstance(value, dict):
+            value = {(): value}
+        samples = [("", dict(zip(self.label_names, values)), number) for values, number in value.items()]
+        return self.name, self.type, self.help, samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name: str):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, read: Callable, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, read, labels))
+
+    def collect(self) -> List[Family]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        families = []
+        for metric in metrics:
+            try:
+                families.append(metric.collect())
+            except Exception:
+                # A gauge whose source is unavailable is left out
+                pass
+        return families
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render(families: List[Family]) -> str:
+    """
+    Formats families in the Prometheus text exposition format. Families with the same name,
+    such as the same metric from several worker processes, are written together.
+    """
+    by_name: Dict[str, Family] = {}
+    for name, type, help, samples in families:
+        if name in by_name:
+            by_name[name][3].extend(samples)
+        else:
+            by_name[name] = (name, type, help, list(samples))
+    lines = []
+    for name, type, help, samples in by_name.values():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+        for suffix, labels, value in samples:
+            label_text = ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items())
+            lines.append(f"{name}{suffix}{{{label_text}}} {_format_value(value)}" if label_text
+                         else f"{name}{suffix} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def with_labels(families: List[Family], labels: Dict[str, str]) -> List[Family]:
+    return [(name, type, help, [(suffix, dict(sample_labels, **labels), value)
+                                for suffix, sample_labels, value in samples])
+            for name, type, help, samples in families]
+
+
+registry = Registry()
+
+connections_accepted = registry.counter("gateway_ssh_connections_accepted", "SSH connections accepted")
+handshake_seconds = registry.histogram("gateway_ssh_handshake_seconds",
+                                       "Time from accepting a connection to the end of the key exchange")
+auth_failures = registry.counter("gateway_ssh_auth_failures", "Failed SSH password authentications")
+channels_opened = registry.counter("gateway_ssh_channels_opened", "Session channels opened by clients")
+channels_refused = registry.counter("gateway_ssh_channels_refused",
+                                    "Session channels refused because the client had too many open")
+provisioning_seconds = registry.histogram("gateway_provisioning_phase_seconds",
+                                          "Duration of each phase of getting a session a backend",
+                                          labels=("phase",))
+bytes_relayed = registry.counter("gateway_relay_bytes", "Bytes relayed between clients and backends",
+                                 labels=("direction",))
+kube_api_seconds = registry.histogram("gateway_kube_api_seconds", "Latency of Kubernetes API calls",
+                                      labels=("operation",))
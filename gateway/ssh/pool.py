@@ -0,0 +1,167 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from typing import Dict, List, Optional
+
+from kubernetes.client import V1Pod
+
+from gateway.ssh.ctf import CTF
+from gateway.ssh.kube import KubeClient
+
+logger = logging.getLogger("gateway.pool")
+
+# How long a pod this process warmed is still counted if the pod index has not caught up with it yet
+INDEX_LAG_S = 10.0
+
+
+class WarmPodPool:
+    """
+    Keeps a number of unassigned, ready pods for every challenge so that logins do not wait for pod scheduling.
+
+    The state of the pool lives in the pods' `ctf_pool` label ("warming", then "ready" once sshd answers),
+    so any gateway process can claim a ready pod, by relabelling it for a team.
+    Only processes created with `refill` create new pods.
+    """
+    INSTANCE = None
+
+    def __init__(self, kube_client: KubeClient, refill: bool = True, refill_interval_s: float = 5.0,
+                 max_warming: int = 8):
+        self.kube_client = kube_client
+        self.refill = refill
+        self.refill_interval_s = refill_interval_s
+        self._hits: Dict[str, int] = {challenge: 0 for challenge in CTF.challenge_images}
+        self._misses: Dict[str, int] = {challenge: 0 for challenge in CTF.challenge_images}
+        # Pods created by this process, with the time until which they are counted even if missing from the index
+        self._pending: Dict[str, Dict[str, float]] = {challenge: {} for challenge in CTF.challenge_images}
+        self._creating: Dict[str, int] = {challenge: 0 for challenge in CTF.challenge_images}
+        self._lock = threading.Lock()
+        self._refill_needed = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=max_warming, thread_name_prefix="warm-pool")
+
+    @staticmethod
+    def get():
+        return WarmPodPool.INSTANCE
+
+    def start(self):
+        if not self.refill:
+            return
+        self._adopt_existing_pods()
+        threading.Thread(target=self._refill_loop, name="warm-pool-refill", daemon=True).start()
+
+    def claim(self, challenge: str, team: str) -> Optional[V1Pod]:
+        """
+        Hands a ready pod to the team, or returns None if the pool for this challenge is empty.
+        """
+        challenge = challenge.lower()
+        for pod in self._pods(challenge, "ready"):
+            # Fails if another process claimed the pod first
+            claimed = self.kube_client.claim_pod(pod, team, challenge.upper())
+            if not claimed:
+                # Or if the index has an outdated version of the pod: a pod nobody claimed is claimed at its
+                # current version, rather than left in the pool until the index catches up
+                current = self.kube_client.read_pod(pod)
+                if current and (current.metadata.labels or {}).get("ctf_pool") == "ready":
+                    claimed = self.kube_client.claim_pod(current, team, challenge.upper())
+            if claimed:
+                with self._lock:
+                    self._hits[challenge] += 1
+                logger.debug("Claimed warm pod %s for %s", pod.metadata.name, team)
+                self._refill_needed.set()
+                return claimed
+        with self._lock:
+            self._misses[challenge] = self._misses.get(challenge, 0) + 1
+        self._refill_needed.set()
+        return None
+
+    def counters(self) -> Dict[str, dict]:
+        with self._lock:
+            return {challenge: {"hits": self._hits[challenge], "misses": self._misses[challenge]}
+                    for challenge in self._hits}
+
+    def stats(self) -> Dict[str, dict]:
+        counters = self.counters()
+        return {
+            challenge: {
+                "size": CTF.warm_pool_size(challenge),
+                "ready": len(self._pods(challenge, "ready")),
+                "warming": len(self._pods(challenge, "warming")),
+                "hits": counters[challenge]["hits"],
+                "misses": counters[challenge]["misses"],
+            }
+            for challenge in CTF.challenge_images
+        }
+
+    def _pods(self, challenge: str, state: str) -> List[V1Pod]:
+        return [pod for pod in self.kube_client.list_warm_pods()
+                if (pod.metadata.labels or {}).get("ctf_challenge", "").lower() == challenge
+                and pod.metadata.labels.get("ctf_pool") == state]
+
+    def _adopt_existing_pods(self):
+        # Pods left warming by a previous gateway are finished by this one
+        for pod in self.kube_client.list_warm_pods():
+            labels = pod.metadata.labels or {}
+            challenge = labels.get("ctf_challenge", "").lower()
+            if labels.get("ctf_pool") != "warming" or challenge not in self._pending:
+                continue
+            logger.debug("Adopting warm pod %s", pod.metadata.name)
+            with self._lock:
+                self._pending[challenge][pod.metadata.name] = float("inf")
+            self._executor.submit(self._warm, challenge, pod)
+
+    def _refill_loop(self):
+        while True:
+            try:
+                self._refill()
+            except Exception:
+                logger.error("An error occurred while refilling the warm pool", exc_info=1)
+            self._refill_needed.wait(self.refill_interval_s)
+            self._refill_needed.clear()
+
+    def _refill(self):
+        now = monotonic()
+        warm_pods = self.kube_client.list_warm_pods()
+        for challenge in CTF.challenge_images:
+            indexed = set(pod.metadata.name for pod in warm_pods
+                          if (pod.metadata.labels or {}).get("ctf_challenge", "").lower() == challenge)
+            with self._lock:
+                pending = self._pending[challenge]
+                for name in [name for name, until in pending.items() if until < now]:
+                    del pending[name]
+                present = len(indexed | set(pending)) + self._creating[challenge]
+                missing = CTF.warm_pool_size(challenge) - present
+                if missing <= 0:
+                    continue
+                self._creating[challenge] += missing
+            for _ in range(missing):
+                self._executor.submit(self._warm, challenge)
+
+    def _warm(self, challenge: str, pod: V1Pod = None):
+        created = pod is None
+        try:
+            if created:
+                pod = self.kube_client.create_warm_pod(CTF.challenge_images[challenge], challenge.upper())
+                with self._lock:
+                    self._creating[challenge] -= 1
+                    if pod:
+                        self._pending[challenge][pod.metadata.name] = float("inf")
+                if not pod:
+                    return
+            name = pod.metadata.name
+            pod_ip = self.kube_client.wait_until_pod_has_ip(pod, 60.0)
+            if not pod_ip \
+                    or not self.kube_client.wait_until_pod_port_available(pod, pod_ip, CTF.pod_ssh_port, 30.0) \
+                    or not self.kube_client.mark_warm_pod_ready(pod):
+                logger.warning("Warm pod %s never came up, deleting it", name)
+                self.kube_client.delete_pod(pod)
+                with self._lock:
+                    self._pending[challenge].pop(name, None)
+                return
+            with self._lock:
+                self._pending[challenge][name] = monotonic() + INDEX_LAG_S
+            logger.debug("Warm pod %s is ready at %s", name, pod_ip)
+        except Exception:
+            logger.error("An error occurred while warming a pod for %s", challenge, exc_info=1)
+            if pod:
+                with self._lock:
+                    self._pending[challenge].pop(pod.metadata.name, None)
@@ -0,0 +1,166 @@
+import errno
+import logging
+import selectors
+import socket
+import threading
+from concurrent.futures import Future
+from time import monotonic
+from typing import List, Optional
+
+logger = logging.getLogger("gateway.probe")
+
+
+class _Probe:
+    def __init__(self, host: str, port: int, deadline: float, future: Future, delay_s: float):
+        self.host = host
+        self.port = port
+        self.deadline = deadline
+        self.future = future
+        self.delay_s = delay_s
+        self.next_attempt = 0.0
+        self.attempt_deadline = 0.0
+        self.sock: Optional[socket.socket] = None
+        self.banner = b""
+
+
+class PortProber:
+    """
+    Waits for SSH servers to come up, probing any number of hosts from a single thread.
+
+    Each attempt is a non-blocking connect followed by a read of the server's identification banner,
+    since a pod can accept connections before sshd is ready. Failed attempts are retried with exponential backoff.
+    """
+
+    def __init__(self, initial_delay_s: float = 0.02, max_delay_s: float = 0.25, attempt_timeout_s: float = 2.0):
+        self.initial_delay_s = initial_delay_s
+        self.max_delay_s = max_delay_s
+        self.attempt_timeout_s = attempt_timeout_s
+        self._selector = selectors.DefaultSelector()
+        self._probes: List[_Probe] = []
+        self._new_probes: List[_Probe] = []
+        self._lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+
+    def start(self):
+        threading.Thread(target=self._run, name="port-prober", daemon=True).start()
+
+    def probe(self, host: str, port: int, timeout_s: float) -> Future:
+        """
+        Returns a future that resolves to True once an SSH banner is received from the host,
+        or to False if the timeout expires first.
+        """
+        future = Future()
+        with self._lock:
+            self._new_probes.append(_Probe(host, port, monotonic() + timeout_s, future, self.initial_delay_s))
+        self._wakeup()
+        return future
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _run(self):
+        while True:
+            try:
+                self._step()
+            except Exception:
+                logger.error("An error occurred in the port prober", exc_info=1)
+
+    def _step(self):
+        with self._lock:
+            self._probes.extend(self._new_probes)
+            self._new_probes.clear()
+
+        now = monotonic()
+        timeout = None
+        for probe in list(self._probes):
+            if now >= probe.deadline:
+                self._finish(probe, False)
+                continue
+            if probe.sock is None and now >= probe.next_attempt:
+                self._connect(probe, now)
+            elif probe.sock is not None and now >= probe.attempt_deadline:
+                self._retry(probe, now)
+            if probe.sock is None:
+                wake_at = min(probe.next_attempt, probe.deadline)
+            else:
+                wake_at = min(probe.attempt_deadline, probe.deadline)
+            timeout = wake_at - now if timeout is None else min(timeout, wake_at - now)
+
+        for key, mask in self._selector.select(None if timeout is None else max(timeout, 0)):
+            if key.fileobj is self._wakeup_r:
+                try:
+                    while self._wakeup_r.recv(512):
+                        pass
+                except (BlockingIOError, InterruptedError):
+                    pass
+                continue
+            probe: _Probe = key.data
+            if probe.sock is None or probe.future.done():
+                continue
+            if mask & selectors.EVENT_WRITE:
+                self._on_connected(probe)
+            else:
+                self._on_readable(probe)
+
+    def _connect(self, probe: _Probe, now: float):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex((probe.host, probe.port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            sock.close()
+            self._schedule_retry(probe, now)
+            return
+        probe.sock = sock
+        probe.banner = b""
+        probe.attempt_deadline = now + self.attempt_timeout_s
+        self._selector.register(sock, selectors.EVENT_WRITE, probe)
+
+    def _on_connected(self, probe: _Probe):
+        err = probe.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self._retry(probe, monotonic())
+            return
+        self._selector.modify(probe.sock, selectors.EVENT_READ, probe)
+
+    def _on_readable(self, probe: _Probe):
+        try:
+            data = probe.sock.recv(256)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._retry(probe, monotonic())
+            return
+        probe.banner += data
+        # Servers may send other lines before their identification string (RFC 4253, section 4.2)
+        if any(line.startswith(b"SSH-") for line in probe.banner.split(b"\n")):
+            self._finish(probe, True)
+        elif len(probe.banner) > 4096:
+            self._retry(probe, monotonic())
+
+    def _close(self, probe: _Probe):
+        if probe.sock is not None:
+            self._selector.unregister(probe.sock)
+            probe.sock.close()
+            probe.sock = None
+
+    def _retry(self, probe: _Probe, now: float):
+        self._close(probe)
+        self._schedule_retry(probe, now)
+
+    def _schedule_retry(self, probe: _Probe, now: float):
+        probe.next_attempt = now + probe.delay_s
+        probe.delay_s = min(probe.delay_s * 2, self.max_delay_s)
+
+    def _finish(self, probe: _Probe, result: bool):
+        self._close(probe)
+        self._probes.remove(probe)
+        if not probe.future.done():
+            probe.future.set_result(result)
@@ -0,0 +1,284 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Hashable, List, Optional, Set
+
+logger = logging.getLogger("gateway.provisioning")
+
+PositionCallback = Callable[[int], None]
+
+
+class _Job:
+    __slots__ = ("team", "pod_name", "work", "future", "on_position", "position")
+
+    def __init__(self, team: str, pod_name: Optional[str], work: Callable, on_position: Optional[PositionCallback]):
+        self.team = team
+        self.pod_name = pod_name
+        self.work = work
+        self.future = Future()
+        self.on_position = on_position
+        self.position = None
+
+
+class ProvisioningScheduler:
+    """
+    Runs pod provisioning (creating a pod and waiting until its SSH port answers) with a global limit on how many
+    run at once, and a limit per team. Waiting jobs are served round-robin across teams, so a team opening many
+    challenges at once does not delay the others.
+
+    With `max_pods_per_team`, a team's jobs also wait while the team has that many pods, counting the pods returned
+    by `team_pods(team)` and the ones being provisioned. They are served again when `pod_released` is called.
+
+    Waiting jobs are told their position in the queue whenever it changes; position 0 means the job is running.
+    """
+    INSTANCE = None
+
+    def __init__(self, max_in_flight: int = 16, max_in_flight_per_team: int = 2, max_pods_per_team: int = 0,
+                 team_pods: Callable[[str], Set[str]] = None):
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_team = max_in_flight_per_team
+        self.max_pods_per_team = max_pods_per_team
+        self._team_pods = team_pods
+        self.completed = 0
+        self.failed = 0
+        self._queues: Dict[str, Deque[_Job]] = {}
+        # Teams with waiting jobs, in the order they will be served
+        self._rotation: Deque[str] = deque()
+        self._in_flight = 0
+        self._in_flight_by_team: Dict[str, int] = {}
+        self._pods_in_flight: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="provisioning")
+
+    @staticmethod
+    def get():
+        return ProvisioningScheduler.INSTANCE
+
+    def submit(self, team: str, work: Callable, on_position: PositionCallback = None,
+               pod_name: str = None) -> Future:
+        """
+        Queues `work` for the team. The returned future resolves to what `work` returns, or fails with what it raises.
+        Cancelling the future while the job waits removes it from the queue.
+        `pod_name` is the pod the job provisions, so that it is not counted twice against the team's pods.
+        """
+        team = team.lower()
+        job = _Job(team, pod_name, work, on_position)
+        job.future.add_done_callback(lambda future: future.cancelled() and self._withdraw(job))
+        with self._lock:
+            queue = self._queues.setdefault(team, deque())
+            if not queue:
+                self._rotation.append(team)
+            queue.append(job)
+        self._dispatch()
+        return job.future
+
+    def at_pod_limit(self, team: str, pod_name: str = None) -> bool:
+        """
+        Whether the team cannot have another pod, besides `pod_name`, until one of its pods goes away.
+        """
+        with self._lock:
+            return self._at_pod_limit(team.lower(), pod_name)
+
+    def pod_released(self):
+        """
+        Serves the jobs that were waiting for their team to have fewer pods.
+        """
+        if self.max_pods_per_team:
+            self._dispatch()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "waiting": sum(len(queue) for queue in self._queues.values()),
+                "teams_waiting": len(self._rotation),
+                "completed": self.completed,
+                "failed": self.failed,
+            }
+
+    def _withdraw(self, job: _Job):
+        # Cancelled jobs leave the queue at once, rather than when their turn comes: a job waiting for its team
+        # to have fewer pods may never get its turn, and would still count as waiting
+        with self._lock:
+            queue = self._queues.get(job.team)
+            if not queue or job not in queue:
+                return
+            queue.remove(job)
+            if not queue:
+                del self._queues[job.team]
+                self._rotation.remove(job.team)
+        self._dispatch()
+
+    def _dispatch(self):
+        with self._lock:
+            started = []
+            while self._in_flight < self.max_in_flight:
+                job = self._next_job()
+                if not job:
+                    break
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+                self._in_flight += 1
+                self._in_flight_by_team[job.team] = self._in_flight_by_team.get(job.team, 0) + 1
+                if job.pod_name:
+                    self._pods_in_flight.setdefault(job.team, set()).add(job.pod_name)
+                started.append(job)
+            for job in started:
+                self._executor.submit(self._run, job)
+            updates = self._positions_changed(started)
+        for job, position in updates:
+            try:
+                job.on_position(position)
+            except Exception:
+                logger.debug("Could not report the queue position of a provisioning job", exc_info=1)
+
+    def _next_job(self) -> Optional[_Job]:
+        # The first team in the rotation that is under its limits is served, and goes to the back of the rotation
+        for _ in range(len(self._rotation)):
+            team = self._rotation.popleft()
+            queue = self._queues[team]
+            if (self._in_flight_by_team.get(team, 0) >= self.max_in_flight_per_team
+                    or self._at_pod_limit(team, queue[0].pod_name)):
+                self._rotation.append(team)
+                continue
+            job = queue.popleft()
+            if queue:
+                self._rotation.append(team)
+            else:
+                del self._queues[team]
+            return job
+        return None
+
+    def _at_pod_limit(self, team: str, pod_name: Optional[str]) -> bool:
+        if not self.max_pods_per_team or not self._team_pods:
+            return False
+        pods = self._team_pods(team) | self._pods_in_flight.get(team, set())
+        if pod_name in pods:
+            return False
+        return len(pods) >= self.max_pods_per_team
+
+    def _waiting_order(self) -> List[_Job]:
+        # The order in which waiting jobs would start if every team stayed under its limit
+        order = []
+        depth = 0
+        while True:
+            level = [self._queues[team][depth] for team in self._rotation if len(self._queues[team]) > depth]
+            if not level:
+                return [job for job in order if not job.future.cancelled()]
+            order += level
+            depth += 1
+
+    def _positions_changed(self, started: List[_Job]) -> list:
+        updates = []
+        for job in started:
+            job.position = 0
+            if job.on_position:
+                updates.append((job, 0))
+        for position, job in enumerate(self._waiting_order(), start=1):
+            if job.position != position:
+                job.position = position
+                if job.on_position:
+                    updates.append((job, position))
+        return updates
+
+    def _run(self, job: _Job):
+        try:
+            result = job.work()
+            job.future.set_result(result)
+            succeeded = result is not None
+        except Exception as e:
+            logger.error("An error occurred while provisioning for %s", job.team, exc_info=1)
+            job.future.set_exception(e)
+            succeeded = False
+        with self._lock:
+            self._in_flight -= 1
+            self._in_flight_by_team[job.team] -= 1
+            if not self._in_flight_by_team[job.team]:
+                del self._in_flight_by_team[job.team]
+            pods = self._pods_in_flight.get(job.team)
+            if pods is not None:
+                pods.discard(job.pod_name)
+                if not pods:
+                    del self._pods_in_flight[job.team]
+            if succeeded:
+                self.completed += 1
+            else:
+                self.failed += 1
+        self._dispatch()
+
+
+class _Flight:
+    __slots__ = ("future", "listeners", "position", "joined")
+
+    def __init__(self):
+        self.future = Future()
+        self.listeners: List[PositionCallback] = []
+        self.position = None
+        self.joined = 0
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time: callers arriving while a call for their key is running wait for it
+    and share its result, or its exception.
+    Positions reported by the running call are passed on to every caller waiting on it.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.joined = 0
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, work: Callable[[PositionCallback], object], on_position: PositionCallback = None):
+        """
+        Calls `work(report_position)` unless a call for the key is already running, then returns its result.
+        A call cancelled by its caller (raising CancelledError) is run again for the callers that joined it.
+        """
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+                    self.calls += 1
+                else:
+                    flight.joined += 1
+                    self.joined += 1
+                if on_position:
+                    flight.listeners.append(on_position)
+                position = flight.position
+            if leader:
+                break
+            if on_position and position is not None:
+                on_position(position)
+            try:
+                return flight.future.result()
+            except CancelledError:
+                logger.debug("A shared call for %s was cancelled, running it again", key)
+
+        def report_position(position: int):
+            with self._lock:
+                flight.position = position
+                listeners = list(flight.listeners)
+            for listener in listeners:
+                try:
+                    listener(position)
+                except Exception:
+                    logger.debug("Could not report a queue position", exc_info=1)
+
+        try:
+            result = work(report_position)
+            flight.future.set_result(result)
+            return result
+        except BaseException as e:
+            flight.future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"flights": len(self._flights), "unique_calls": self.calls, "joined_calls": self.joined}
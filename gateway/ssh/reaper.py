@@ -0,0 +1,133 @@
+import logging
+import threading
+from datetime import datetime
+from time import monotonic, sleep
+from typing import Dict, Optional, Set, Tuple
+
+from kubernetes.client import V1Pod
+
+from gateway.ssh.ctf import CTF
+from gateway.ssh.events import event_bus
+from gateway.ssh.kube import KubeClient
+from gateway.ssh.registry import ConnectionRegistry
+from gateway.ssh.state import SessionState
+
+logger = logging.getLogger("gateway.reaper")
+
+
+class Reaper:
+    """
+    Closes sessions that have been idle for too long, and deletes team pods that no session has used for a while.
+    Pod deletes are limited to a batch per pass and spaced out, so a mass cleanup cannot flood the API server.
+    """
+    INSTANCE = None
+
+    def __init__(self, kube_client: Optional[KubeClient], registry: ConnectionRegistry, state: SessionState,
+                 interval_s: float = 30.0, batch_size: int = 10, deletes_per_s: float = 2.0):
+        """
+        Idle sessions are looked up in the local registry, and pod usage in the session state, which covers every
+        gateway process. Without a kube client, only idle sessions are reaped.
+        """
+        self.kube_client = kube_client
+        self.registry = registry
+        self.state = state
+        self.interval_s = interval_s
+        self.batch_size = batch_size
+        self.deletes_per_s = deletes_per_s
+        self.sessions_closed = 0
+        self.pods_reclaimed: Dict[str, int] = {}
+        self._unattached_since: Dict[str, float] = {}
+
+    @staticmethod
+    def get():
+        return Reaper.INSTANCE
+
+    def start(self):
+        threading.Thread(target=self._run, name="reaper", daemon=True).start()
+
+    def stats(self) -> dict:
+        return {
+            "sessions_closed": self.sessions_closed,
+            "pods_reclaimed": sum(self.pods_reclaimed.values()),
+            "pods_reclaimed_by_challenge": dict(self.pods_reclaimed),
+            "pods_unattached": len(self._unattached_since),
+        }
+
+    def _run(self):
+        while True:
+            sleep(self.interval_s)
+            try:
+                self.reap_sessions()
+            except Exception:
+                logger.error("An error occurred while reaping idle sessions", exc_info=1)
+            if self.kube_client:
+                try:
+                    self.collect_pods()
+                except Exception:
+                    logger.error("An error occurred while collecting unused pods", exc_info=1)
+
+    def reap_sessions(self):
+        now = datetime.utcnow()
+        for connection in self.registry.snapshot():
+            if not connection.challenge or not connection.last_active:
+                continue
+            timeout_s = CTF.idle_timeout_s(connection.challenge)
+            if (now - connection.last_active).total_seconds() < timeout_s:
+                continue
+            logger.info("Client %s has been idle for more than %ss, closing", connection.id, timeout_s)
+            event_bus.publish("session_idle", id=connection.id,
+                              team=connection.server.username if connection.server else None,
+                              challenge=connection.challenge, idle_timeout_s=timeout_s)
+            try:
+                connection.send_notice("\r\n*********\r\n"
+                                       f"  Your session was closed after {int(timeout_s // 60)} minutes "
+                                       "of inactivity.\r\n"
+                                       "*********\r\n")
+            except Exception:
+                pass
+            connection.kill()
+            self.sessions_closed += 1
+
+    def collect_pods(self):
+        now = monotonic()
+        expired = []
+        seen = set()
+        attached = self._attached()
+        for pod in self.kube_client.list_pods():
+            labels = pod.metadata.labels or {}
+            team, challenge = labels.get("ctf_team"), labels.get("ctf_challenge")
+            if not team or not challenge:
+                # Warm pods are managed by the pool
+                continue
+            name = pod.metadata.name
+            seen.add(name)
+            if (team.lower(), challenge.lower()) in attached:
+                self._unattached_since.pop(name, None)
+                continue
+            since = self._unattached_since.setdefault(name, now)
+            if now - since >= CTF.pod_grace_period_s(challenge):
+                expired.append(pod)
+
+        for name in list(self._unattached_since):
+            if name not in seen:
+                del self._unattached_since[name]
+
+        for pod in expired[:self.batch_size]:
+            labels = pod.metadata.labels
+            # The team may have reconnected while earlier deletes were being spaced out
+            if self.state.list_sessions(team=labels["ctf_team"], challenge=labels["ctf_challenge"]):
+                continue
+            self._delete(pod)
+            sleep(1.0 / self.deletes_per_s)
+
+    def _attached(self) -> Set[Tuple[str, str]]:
+        return set(((session["team"] or "").lower(), (session["challenge"] or "").lower())
+                   for session in self.state.list_sessions())
+
+    def _delete(self, pod: V1Pod):
+        labels = pod.metadata.labels or {}
+        challenge = labels.get("ctf_challenge", "").lower()
+        logger.info("Deleting pod %s, unused for more than %ss", pod.metadata.name, CTF.pod_grace_period_s(challenge))
+        if self.kube_client.delete_pod(pod):
+            self._unattached_since.pop(pod.metadata.name, None)
+            self.pods_reclaimed[challenge] = self.pods_reclaimed.get(challenge, 0) + 1
@@ -0,0 +1,278 @@
+import codecs
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import struct
+import threading
+from datetime import datetime
+from time import monotonic, time
+from typing import Callable, Dict, IO, List, Optional
+
+from gateway.ssh import metrics
+
+logger = logging.getLogger("gateway.recording")
+
+# Elapsed seconds, event kind ("o", "i" or "r") and data length, in front of each chunk in a ring
+_HEADER = struct.Struct("<dBI")
+
+_bytes_written = metrics.registry.counter("gateway_recording_bytes_written",
+                                          "Session output and input written to recordings")
+_bytes_dropped = metrics.registry.counter("gateway_recording_bytes_dropped",
+                                          "Session output and input left out of recordings (full buffer or disk)")
+
+
+class _Ring:
+    """
+    A fixed-size buffer of timestamped chunks. Appending never waits for the writer: a chunk that does not fit
+    in the free space is dropped, and counted in `dropped`. `on_high_water` is called when the ring gets a quarter full,
+    so that the writer drains it before it overflows.
+    """
+    __slots__ = ("buffer", "capacity", "head", "tail", "lock", "dropped", "on_high_water")
+
+    def __init__(self, capacity: int, on_high_water: Callable[[], None] = None):
+        self.buffer = bytearray(capacity)
+        self.capacity = capacity
+        # Total bytes ever appended and drained; their difference is what the ring holds
+        self.head = 0
+        self.tail = 0
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.on_high_water = on_high_water
+
+    def append(self, header: bytes, data: bytes) -> bool:
+        size = len(header) + len(data)
+        with self.lock:
+            if size > self.capacity - (self.head - self.tail):
+                self.dropped += len(data)
+                return False
+            was_below = self.head - self.tail < self.capacity // 4
+            self._put(header)
+            self._put(data)
+            crossed = was_below and self.head - self.tail >= self.capacity // 4
+        if crossed and self.on_high_water:
+            self.on_high_water()
+        return True
+
+    def _put(self, data: bytes):
+        start = self.head % self.capacity
+        first = min(len(data), self.capacity - start)
+        self.buffer[start:start + first] = data[:first]
+        if first < len(data):
+            self.buffer[:len(data) - first] = data[first:]
+        self.head += len(data)
+
+    def drain(self) -> bytes:
+        with self.lock:
+            size = self.head - self.tail
+            if not size:
+                return b""
+            start = self.tail % self.capacity
+            end = start + size
+            if end <= self.capacity:
+                data = bytes(self.buffer[start:end])
+            else:
+                data = bytes(self.buffer[start:]) + bytes(self.buffer[:end - self.capacity])
+            self.tail = self.head
+            return data
+
+
+class Recording:
+    """
+    The recording of one session, in the asciinema v2 format. The relay threads only append to its ring;
+    the recorder's writer thread formats and writes it.
+    """
+
+    def __init__(self, path: str, header: dict, buffer_size: int, record_input: bool = True,
+                 on_high_water: Callable[[], None] = None):
+        self.path = path
+        self.record_input = record_input
+        self.header = header
+        self.started_at = monotonic()
+        self.closed = False
+        # Dropped by the writer thread only, while the ring counts what the relay threads dropped
+        self.write_dropped_bytes = 0
+        self.file: Optional[IO[str]] = None
+        self.failed = False
+        self._ring = _Ring(buffer_size, on_high_water)
+        # Chunks can end in the middle of a UTF-8 sequence
+        self._decoders = {kind: codecs.getincrementaldecoder("utf-8")(errors="replace") for kind in "oi"}
+
+    def output(self, data: bytes):
+        self._append(b"o"[0], data)
+
+    def input(self, data: bytes):
+        if self.record_input:
+            self._append(b"i"[0], data)
+
+    def resize(self, width: int, height: int):
+        self._append(b"r"[0], f"{width}x{height}".encode())
+
+    def close(self):
+        self.closed = True
+
+    @property
+    def dropped_bytes(self) -> int:
+        return self._ring.dropped + self.write_dropped_bytes
+
+    def _append(self, kind: int, data: bytes):
+        if not self._ring.append(_HEADER.pack(monotonic() - self.started_at, kind, len(data)), data):
+            _bytes_dropped.inc(len(data))
+
+    def drain_lines(self) -> List[str]:
+        chunks = self._ring.drain()
+        lines = []
+        offset = 0
+        while offset < len(chunks):
+            elapsed, kind, size = _HEADER.unpack_from(chunks, offset)
+            offset += _HEADER.size
+            kind = chr(kind)
+            data = chunks[offset:offset + size]
+            offset += size
+            text = self._decoders[kind].decode(data) if kind in self._decoders else data.decode()
+            if text:
+                lines.append(json.dumps([round(elapsed, 6), kind, text]) + "\n")
+        return lines
+
+
+def _safe(name: Optional[str]) -> str:
+    return re.sub(r"[^\w.-]", "_", name or "unknown")
+
+
+class SessionRecorder:
+    """
+    Records sessions to `directory`, one asciinema v2 file per session (gzip-compressed with `compress`).
+
+    The relay copies what it relays into each session's pre-allocated ring buffer, and a single writer thread
+    drains every ring every `flush_interval_s`, or as soon as a ring is a quarter full, and writes the files.
+    Players are never slowed down by the disk: when a ring is full because the writer fell behind, the disk has less
+    than `min_free_bytes` free or a write fails, data is dropped and counted.
+    """
+    INSTANCE = None
+
+    def __init__(self, directory: str, compress: bool = False, buffer_size: int = 512 * 1024,
+                 flush_interval_s: float = 0.1, min_free_bytes: int = 512 * 1024 * 1024, record_input: bool = True):
+        self.directory = directory
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.flush_interval_s = flush_interval_s
+        self.min_free_bytes = min_free_bytes
+        self.record_input = record_input
+        self.bytes_written = 0
+        self.bytes_dropped = 0
+        self.disk_full = False
+        self._disk_checked_at = 0.0
+        self._recordings: Dict[str, Recording] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def get():
+        return SessionRecorder.INSTANCE
+
+    def start(self):
+        threading.Thread(target=self._run, name="recording-writer", daemon=True).start()
+
+    def record(self, connection) -> Recording:
+        """
+        Starts recording the connection's session.
+        """
+        team = connection.server.username if connection.server else None
+        dimensions = connection.pty_dimensions
+        header = {
+            "version": 2,
+            "width": dimensions.width if dimensions else 80,
+            "height": dimensions.height if dimensions else 24,
+            "timestamp": int(time()),
+            "env": {"TERM": dimensions.term if dimensions else "xterm"},
+            "title": f"{team} {connection.challenge} {connection.id}",
+        }
+        name = "{}-{}-{}-{}.cast".format(datetime.utcnow().strftime("%Y%m%d-%H%M%S"), _safe(team),
+                                         _safe(connection.challenge), connection.id)
+        if self.compress:
+            name += ".gz"
+        recording = Recording(os.path.join(self.directory, name), header, self.buffer_size, self.record_input,
+                              self._wakeup.set)
+        with self._lock:
+            self._recordings[connection.id] = recording
+        return recording
+
+    def stats(self) -> dict:
+        with self._lock:
+            recording = len(self._recordings)
+        return {
+            "recording": recording,
+            "bytes_written": self.bytes_written,
+            "bytes_dropped": self.bytes_dropped + sum(r.dropped_bytes for r in list(self._recordings.values())),
+            "disk_full": self.disk_full,
+        }
+
+    def flush(self):
+        """
+        Writes what every recording buffered since the last flush, and finishes the closed ones.
+        """
+        # Flushes woken up by full rings can follow each other closely, the disk is checked once per interval
+        now = monotonic()
+        if now - self._disk_checked_at >= self.flush_interval_s:
+            self._disk_checked_at = now
+            try:
+                self.disk_full = shutil.disk_usage(self.directory).free < self.min_free_bytes
+            except OSError:
+                self.disk_full = True
+        with self._lock:
+            recordings = list(self._recordings.items())
+        for conn_id, recording in recordings:
+            # Checked before draining, so that nothing appended before the close is left behind
+            closed = recording.closed
+            lines = recording.drain_lines()
+            if lines:
+                self._write(recording, lines)
+            if closed:
+                self._finish(recording)
+                with self._lock:
+                    del self._recordings[conn_id]
+                    self.bytes_dropped += recording.dropped_bytes
+
+    def _write(self, recording: Recording, lines: List[str]):
+        size = sum(len(line) for line in lines)
+        if self.disk_full or recording.failed:
+            recording.write_dropped_bytes += size
+            _bytes_dropped.inc(size)
+            return
+        try:
+            if not recording.file:
+                opener = gzip.open if self.compress else open
+                recording.file = opener(recording.path, "wt", encoding="utf-8")
+                recording.file.write(json.dumps(recording.header) + "\n")
+            recording.file.writelines(lines)
+            recording.file.flush()
+            self.bytes_written += size
+            _bytes_written.inc(size)
+        except OSError:
+            logger.error("Could not write recording %s, dropping the rest of it", recording.path, exc_info=1)
+            recording.failed = True
+            recording.write_dropped_bytes += size
+            _bytes_dropped.inc(size)
+
+    def _finish(self, recording: Recording):
+        if recording.file:
+            try:
+                recording.file.close()
+            except OSError:
+                logger.error("Could not close recording %s", recording.path, exc_info=1)
+        if recording.dropped_bytes:
+            logger.warning("Recording %s is missing %s bytes", recording.path, recording.dropped_bytes)
+
+    def _run(self):
+        while True:
+            start = monotonic()
+            # Cleared before draining, so that a ring crossing its high-water mark meanwhile wakes the next flush
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.error("An error occurred while writing recordings", exc_info=1)
+            self._wakeup.wait(max(0.0, self.flush_interval_s - (monotonic() - start)))
@@ -0,0 +1,149 @@
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Set, TYPE_CHECKING
+
+from gateway.ssh.events import event_bus
+
+if TYPE_CHECKING:
+    from gateway.ssh.connection import ServerConnection
+    from gateway.ssh.trace import SessionTrace
+
+
+class SessionRecord:
+    """
+    What is kept about a session after it closed.
+    """
+    __slots__ = ("id", "team", "challenge", "client_addr", "opened_at", "closed_at")
+
+    def __init__(self, id: str, team: Optional[str], challenge: Optional[str], client_addr: str,
+                 opened_at: datetime, closed_at: datetime):
+        self.id = id
+        self.team = team
+        self.challenge = challenge
+        self.client_addr = client_addr
+        self.opened_at = opened_at
+        self.closed_at = closed_at
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "team": self.team,
+            "challenge": self.challenge,
+            "client_addr": self.client_addr,
+            "opened": self.opened_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "closed": self.closed_at.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+
+def _describe(connection: "ServerConnection") -> dict:
+    return {
+        "id": connection.id,
+        "team": connection.server.username if connection.server else None,
+        "challenge": connection.challenge,
+        "client_addr": f"{connection.addr[0]}:{connection.addr[1]}" if connection.addr else None,
+    }
+
+
+class ConnectionRegistry:
+    """
+    Live sessions, indexed by id, team, challenge and client address.
+    Sessions leave the registry when they are killed, and a bounded history of closed sessions is kept,
+    along with the traces of recently closed connections, including those that never reached a shell.
+    """
+
+    def __init__(self, history_size: int = 10000):
+        self._connections: Dict[str, "ServerConnection"] = {}
+        self._opened_at: Dict[str, datetime] = {}
+        self._by_team: Dict[str, Set[str]] = {}
+        self._by_challenge: Dict[str, Set[str]] = {}
+        self._by_client_addr: Dict[str, Set[str]] = {}
+        self._history: Deque[SessionRecord] = deque(maxlen=history_size)
+        self._history_size = history_size
+        self._closed_traces: "OrderedDict[str, SessionTrace]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, connection: "ServerConnection"):
+        with self._lock:
+            self._connections[connection.id] = connection
+            self._opened_at[connection.id] = datetime.utcnow()
+            for index, key in self._index_keys(connection):
+                index.setdefault(key, set()).add(connection.id)
+        event_bus.publish("session_opened", **_describe(connection))
+
+    def remove(self, connection: "ServerConnection"):
+        with self._lock:
+            if connection.id not in self._closed_traces:
+                self._closed_traces[connection.id] = connection.trace
+                if len(self._closed_traces) > self._history_size:
+                    self._closed_traces.popitem(last=False)
+            if self._connections.pop(connection.id, None) is None:
+                return
+            for index, key in self._index_keys(connection):
+                ids = index.get(key)
+                if ids is not None:
+                    ids.discard(connection.id)
+                    if not ids:
+                        del index[key]
+            record = SessionRecord(
+                id=connection.id,
+                team=connection.server.username if connection.server else None,
+                challenge=connection.challenge,
+                client_addr=f"{connection.addr[0]}:{connection.addr[1]}" if connection.addr else None,
+                opened_at=self._opened_at.pop(connection.id),
+                closed_at=datetime.utcnow(),
+            )
+            self._history.append(record)
+        event_bus.publish("session_closed", **_describe(connection),
+                          duration_s=(record.closed_at - record.opened_at).total_seconds())
+
+    def get(self, conn_id: str) -> Optional["ServerConnection"]:
+        return self._connections.get(conn_id)
+
+    def by_team(self, team: str) -> List["ServerConnection"]:
+        return self._lookup(self._by_team, team.lower())
+
+    def by_challenge(self, challenge: str) -> List["ServerConnection"]:
+        return self._lookup(self._by_challenge, challenge.lower())
+
+    def by_client_addr(self, host: str) -> List["ServerConnection"]:
+        return self._lookup(self._by_client_addr, host)
+
+    def snapshot(self) -> List["ServerConnection"]:
+        """
+        A copy of the live sessions, which can be iterated while sessions come and go.
+        """
+        with self._lock:
+            return list(self._connections.values())
+
+    def trace(self, conn_id: str) -> Optional["SessionTrace"]:
+        connection = self._connections.get(conn_id)
+        if connection:
+            return connection.trace
+        with self._lock:
+            return self._closed_traces.get(conn_id)
+
+    def history(self) -> List[SessionRecord]:
+        with self._lock:
+            return list(self._history)
+
+    def __len__(self):
+        return len(self._connections)
+
+    def __contains__(self, conn_id: str):
+        return conn_id in self._connections
+
+    def _lookup(self, index: Dict[str, Set[str]], key: str) -> List["ServerConnection"]:
+        with self._lock:
+            return [self._connections[conn_id] for conn_id in index.get(key, ())]
+
+    def _index_keys(self, connection: "ServerConnection"):
+        if connection.server and connection.server.username:
+            yield self._by_team, connection.server.username.lower()
+        if connection.challenge:
+            yield self._by_challenge, connection.challenge.lower()
+        if connection.addr:
+            yield self._by_client_addr, connection.addr[0]
+
+
+connections = ConnectionRegistry()
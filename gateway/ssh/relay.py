@@ -0,0 +1,473 @@
+import logging
+import os
+import selectors
+import socket
+import threading
+from datetime import datetime
+from time import monotonic
+from typing import Dict, List, Optional
+
+import paramiko
+
+from gateway.ssh import detach, metrics
+from gateway.ssh.connection import ServerConnection
+from gateway.ssh.recording import Recording
+from gateway.ssh.trace import SessionTrace
+
+logger = logging.getLogger("gateway.relay")
+
+_bytes_upstream = metrics.bytes_relayed.labels("client_to_backend")
+_bytes_downstream = metrics.bytes_relayed.labels("backend_to_client")
+
+MIN_READ = 1024
+MAX_READ = 256 * 1024
+# Output is held back for up to the coalescing budget while it is smaller than this
+COALESCE_BYTES = 16 * 1024
+# How often the selector loop retries a session whose destination window is full
+BLOCKED_RETRY_S = 0.005
+# How long a closing session may take to flush its remaining output
+CLOSE_FLUSH_S = 5.0
+
+
+class _Pump:
+    """
+    State for one direction of a relayed session.
+
+    Reads are sized to what the destination can accept (its remaining send window), growing while reads fill up
+    and shrinking when traffic is interactive. A read that fills the requested size means more output is waiting:
+    it is gathered with the reads that follow within the coalescing budget into one write. Smaller reads, such as
+    keystroke echoes, are written immediately, however close together they are.
+    """
+
+    def __init__(self, source: paramiko.Channel, destination: paramiko.Channel, coalesce_s: float, upstream: bool,
+                 trace: SessionTrace, recording: Optional[Recording] = None, stderr: bool = False):
+        self.source = source
+        self.destination = destination
+        # With `stderr`, the pump relays the standard error stream of an exec session instead
+        self.recv = source.recv_stderr if stderr else source.recv
+        self.sendall = destination.sendall_stderr if stderr else destination.sendall
+        self.coalesce_s = coalesce_s
+        self.bytes_relayed = _bytes_upstream if upstream else _bytes_downstream
+        self.trace = trace
+        # Marked in the trace once, then cleared
+        self.first_byte_phase = "first_byte_to_backend" if upstream else "first_byte_to_client"
+        # Copies what is read into the session's recording buffer
+        self.record = (recording.input if upstream else recording.output) if recording else None
+        self.read_size = MIN_READ
+        self.last_read_at = 0.0
+        # Whether the last read got all it asked for
+        self.last_read_full = False
+        # Used by the threaded relay only: the timeout of reads, and the data being sent
+        self.read_timeout_s: Optional[float] = None
+        self.sending: Optional[bytes] = None
+        # Used by the selector relay only
+        self.fd: Optional[int] = None
+        self.pending = bytearray()
+        self.flush_at: Optional[float] = None
+        self.blocked = False
+        self.eof = False
+
+    def next_read_size(self) -> int:
+        window = self.destination.out_window_size - len(self.pending)
+        return max(MIN_READ, min(self.read_size, window))
+
+    def adapt(self, received: int, requested: int):
+        self.last_read_full = received >= requested
+        if received >= requested:
+            self.read_size = min(self.read_size * 2, MAX_READ)
+        elif received < self.read_size // 4:
+            self.read_size = max(self.read_size // 2, MIN_READ)
+
+    def sent(self, size: int):
+        self.bytes_relayed.inc(size)
+        if self.first_byte_phase:
+            self.trace.mark(self.first_byte_phase)
+            self.first_byte_phase = None
+
+    def should_coalesce(self, now: float) -> bool:
+        streaming = self.last_read_full and now - self.last_read_at <= self.coalesce_s
+        return self.coalesce_s > 0 and streaming and len(self.pending) < COALESCE_BYTES
+
+
+class ThreadedRelay:
+    """
+    Relays each session with two threads: the calling thread pumps client to backend,
+    and a forward thread pumps backend to client.
+    """
+
+    def __init__(self, coalesce_s: float = 0.0):
+        self.coalesce_s = coalesce_s
+
+    def relay(self, connection: ServerConnection):
+        downstream = _Pump(connection.backend, connection.channel, self.coalesce_s, False, connection.trace,
+                           connection.recording)
+        forward = threading.Thread(target=self._forward, args=(connection, downstream),
+                                   name=f"forward-{connection.id}")
+        forward.start()
+
+        logger.debug("Listening from client %s to proxy", connection.id)
+        pump = _Pump(connection.channel, connection.backend, 0.0, True, connection.trace, connection.recording)
+        while connection.is_alive():
+            try:
+                if not self._pump(pump):
+                    break
+                connection.last_active = datetime.utcnow()
+            except Exception:
+                break
+
+        if connection.detachable:
+            # The backend may be parked, once the forward thread has stopped reading from it
+            connection.detaching = True
+            forward.join()
+            detach.finish(connection, downstream.sending or b"")
+        else:
+            connection.kill()
+
+    def _forward(self, connection: ServerConnection, pump: _Pump):
+        backend = connection.backend
+        if connection.detachable:
+            # Reads wake up every second to check whether the session is being detached
+            pump.read_timeout_s = 1.0
+            backend.settimeout(pump.read_timeout_s)
+        while not backend.closed and not connection.detaching:
+            try:
+                if not self._pump(pump):
+                    break
+            except socket.timeout:
+                continue
+            except Exception:
+                break
+        try:
+            connection.channel.close()
+            if not connection.detachable:
+                backend.close()
+        except EOFError:
+            pass
+        except Exception:
+            logger.error("An error occurred while closing a dead connection", exc_info=1)
+
+    @staticmethod
+    def _pump(pump: _Pump) -> bool:
+        requested = pump.next_read_size()
+        data = pump.recv(requested)
+        if not data:
+            return False
+        pump.adapt(len(data), requested)
+        now = monotonic()
+        if pump.should_coalesce(now):
+            buffer = bytearray(data)
+            deadline = now + pump.coalesce_s
+            try:
+                while len(buffer) < COALESCE_BYTES:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    pump.source.settimeout(remaining)
+                    more = pump.source.recv(pump.next_read_size())
+                    if not more:
+                        break
+                    buffer += more
+            except socket.timeout:
+                pass
+            finally:
+                pump.source.settimeout(pump.read_timeout_s)
+            data = bytes(buffer)
+        if pump.record:
+            pump.record(data)
+        pump.last_read_at = monotonic()
+        # Channel.send may write less than it was given when the window is short, sendall waits for the window.
+        # Blocking here stops reads from the source, whose window then fills up and pauses the sender.
+        pump.sending = data
+        pump.sendall(data)
+        pump.sending = None
+        pump.sent(len(data))
+        return True
+
+
+class PassthroughRelay:
+    """
+    Relays exec and SFTP sessions, whose traffic is data such as a file being transferred rather than a terminal.
+
+    Reads start at the largest size and are never coalesced, so transfers move in window-sized chunks, and
+    a write blocking on the destination's window is the flow control. Each direction ends on its own: the client's
+    EOF is passed on to the backend so that uploads and `scp -t` finish, and once the backend's output and
+    standard error are done, the command's exit status is passed on to the client.
+    """
+
+    def relay(self, connection: ServerConnection):
+        channel, backend = connection.channel, connection.backend
+        upstream = _Pump(channel, backend, 0.0, True, connection.trace)
+        downstream = _Pump(backend, channel, 0.0, False, connection.trace)
+        stderr = _Pump(backend, channel, 0.0, False, connection.trace, stderr=True)
+        stderr.first_byte_phase = None
+        threads = [
+            threading.Thread(target=self._stream, args=(connection, upstream), name=f"upload-{connection.id}"),
+            threading.Thread(target=self._stream, args=(connection, stderr), name=f"stderr-{connection.id}"),
+        ]
+        for thread in threads:
+            thread.start()
+
+        logger.debug("Relaying the %s session of client %s", connection.session_type, connection.id)
+        self._stream(connection, downstream)
+        if not backend.eof_received and not backend.closed:
+            # The client went away before the end of the output
+            self._close(connection)
+            return
+        threads[1].join()
+        try:
+            # OpenSSH sends the exit status right after the end of the output
+            if backend.status_event.wait(CLOSE_FLUSH_S) and backend.exit_status >= 0:
+                channel.send_exit_status(backend.exit_status)
+            channel.shutdown_write()
+            channel.close()
+            if not connection.shares_transport():
+                # Closing the socket while the client still sends (window adjustments) resets the connection, which
+                # can lose the end of the output on its side: the client disconnects first once its channel is closed
+                connection.transport.join(CLOSE_FLUSH_S)
+        except Exception:
+            logger.debug("Could not pass the exit status on to client %s", connection.id, exc_info=1)
+        self._close(connection)
+
+    @staticmethod
+    def _close(connection: ServerConnection):
+        try:
+            connection.kill()
+        except EOFError:
+            pass
+        except Exception:
+            logger.error("An error occurred while closing a dead connection", exc_info=1)
+
+    @staticmethod
+    def _stream(connection: ServerConnection, pump: _Pump):
+        pump.read_size = MAX_READ
+        while True:
+            try:
+                if not ThreadedRelay._pump(pump):
+                    break
+                connection.last_active = datetime.utcnow()
+            except Exception:
+                logger.debug("Relay of client %s failed", connection.id, exc_info=1)
+                break
+        if pump.destination is connection.backend:
+            try:
+                pump.destination.shutdown_write()
+            except Exception:
+                pass
+
+
+class _RelaySession:
+    def __init__(self, connection: ServerConnection, coalesce_s: float):
+        self.connection = connection
+        self.upstream = _Pump(connection.channel, connection.backend, 0.0, True, connection.trace,
+                              connection.recording)
+        self.downstream = _Pump(connection.backend, connection.channel, coalesce_s, False, connection.trace,
+                                connection.recording)
+        self.pumps = (self.upstream, self.downstream)
+        for pump in self.pumps:
+            pump.fd = pump.source.fileno()
+        self.closing_deadline: Optional[float] = None
+
+
+class _RelayLoop(threading.Thread):
+    SWEEP_INTERVAL_S = 1.0
+
+    def __init__(self, name: str, coalesce_s: float):
+        super().__init__(name=name, daemon=True)
+        self.coalesce_s = coalesce_s
+        self.selector = selectors.DefaultSelector()
+        self._sessions: Dict[str, _RelaySession] = {}
+        self._pending: List[ServerConnection] = []
+        self._lock = threading.Lock()
+        self._last_sweep = monotonic()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ)
+
+    @property
+    def sessions(self) -> int:
+        return len(self._sessions) + len(self._pending)
+
+    def add(self, connection: ServerConnection):
+        with self._lock:
+            self._pending.append(connection)
+        try:
+            self._wakeup_w.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def run(self):
+        while True:
+            try:
+                self._step()
+            except Exception:
+                logger.error("An error occurred in relay loop %s", self.name, exc_info=1)
+
+    def _step(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for connection in pending:
+            logger.debug("Relaying client %s on %s", connection.id, self.name)
+            session = _RelaySession(connection, self.coalesce_s)
+            self._sessions[connection.id] = session
+            for pump in session.pumps:
+                self._resume(session, pump)
+
+        for key, _ in self.selector.select(self._next_timeout()):
+            if key.fileobj is self._wakeup_r:
+                try:
+                    while self._wakeup_r.recv(512):
+                        pass
+                except (BlockingIOError, InterruptedError):
+                    pass
+                continue
+            session, pump = key.data
+            if session.connection.id in self._sessions:
+                self._read(session, pump)
+
+        now = monotonic()
+        for session in list(self._sessions.values()):
+            for pump in session.pumps:
+                if pump.pending and (pump.blocked or pump.flush_at is None or pump.flush_at <= now):
+                    self._flush(session, pump)
+            if session.closing_deadline is not None:
+                if not any(pump.pending for pump in session.pumps) or session.closing_deadline <= now:
+                    self._close(session)
+
+        if now - self._last_sweep >= self.SWEEP_INTERVAL_S:
+            self._last_sweep = now
+            self._sweep()
+
+    def _next_timeout(self) -> float:
+        timeout = self.SWEEP_INTERVAL_S
+        now = monotonic()
+        for session in self._sessions.values():
+            for pump in session.pumps:
+                if pump.blocked:
+                    # The selector cannot watch for the destination window opening up
+                    timeout = min(timeout, BLOCKED_RETRY_S)
+                elif pump.flush_at is not None:
+                    timeout = min(timeout, max(pump.flush_at - now, 0))
+        return timeout
+
+    def _resume(self, session: _RelaySession, pump: _Pump):
+        try:
+            self.selector.register(pump.fd, selectors.EVENT_READ, (session, pump))
+        except KeyError:
+            stale_session, _ = self.selector.get_key(pump.fd).data
+            if stale_session is session:
+                return
+            # The descriptor number was reused after a channel was closed outside of the loop
+            self._close(stale_session)
+            self.selector.register(pump.fd, selectors.EVENT_READ, (session, pump))
+
+    def _pause(self, pump: _Pump):
+        try:
+            self.selector.unregister(pump.fd)
+        except (KeyError, ValueError):
+            pass
+
+    def _sweep(self):
+        # Sessions killed from other threads close their channels' pipes, which the selector never reports
+        for session in list(self._sessions.values()):
+            if not session.connection.is_alive():
+                self._close(session)
+
+    def _read(self, session: _RelaySession, pump: _Pump):
+        try:
+            requested = pump.next_read_size()
+            data = pump.source.recv(requested)
+        except Exception:
+            logger.debug("Relay of client %s failed", session.connection.id, exc_info=1)
+            data = b""
+        now = monotonic()
+        if not data:
+            # Stop reading, and close the session once whatever is still pending has been flushed
+            pump.eof = True
+            self._pause(pump)
+            if session.closing_deadline is None:
+                session.closing_deadline = now + CLOSE_FLUSH_S
+            return
+
+        pump.adapt(len(data), requested)
+        if pump.record:
+            pump.record(data)
+        coalesce = pump.should_coalesce(now)
+        pump.pending += data
+        pump.last_read_at = now
+        if pump is session.upstream:
+            session.connection.last_active = datetime.utcnow()
+        if coalesce and len(pump.pending) < COALESCE_BYTES:
+            if pump.flush_at is None:
+                pump.flush_at = now + pump.coalesce_s
+        else:
+            self._flush(session, pump)
+
+    def _flush(self, session: _RelaySession, pump: _Pump):
+        try:
+            while pump.pending and pump.destination.send_ready():
+                sent = pump.destination.send(bytes(pump.pending[:MAX_READ]))
+                if not sent:
+                    raise EOFError("Channel closed")
+                del pump.pending[:sent]
+                pump.sent(sent)
+        except Exception:
+            logger.debug("Relay of client %s failed", session.connection.id, exc_info=1)
+            self._close(session)
+            return
+
+        pump.flush_at = None
+        if pump.pending and not pump.blocked:
+            # Backpressure: stop reading from the source until the destination accepts more data
+            pump.blocked = True
+            self._pause(pump)
+        elif not pump.pending and pump.blocked:
+            pump.blocked = False
+            if not pump.eof:
+                self._resume(session, pump)
+
+    def _close(self, session: _RelaySession):
+        if self._sessions.pop(session.connection.id, None) is None:
+            return
+        for pump in session.pumps:
+            self._pause(pump)
+        detach.finish(session.connection, bytes(session.downstream.pending))
+
+
+class SelectorRelay:
+    """
+    Relays every session from a few event loops, driven by the readiness of the channels' file descriptors.
+    """
+
+    def __init__(self, loops: int = 1, coalesce_s: float = 0.0):
+        self._loops = [_RelayLoop(f"relay-loop-{i}", coalesce_s) for i in range(loops)]
+        for loop in self._loops:
+            loop.start()
+
+    def relay(self, connection: ServerConnection):
+        loop = min(self._loops, key=lambda l: l.sessions)
+        loop.add(connection)
+
+
+_relay = None
+_relay_lock = threading.Lock()
+passthrough = PassthroughRelay()
+
+
+def get_relay():
+    """
+    Returns the relay selected with the RELAY_MODE environment variable ("threaded" or "selector").
+    """
+    global _relay
+    with _relay_lock:
+        if _relay is None:
+            mode = os.getenv("RELAY_MODE", "threaded")
+            coalesce_s = float(os.getenv("RELAY_COALESCE_MS", "2")) / 1000
+            if mode == "selector":
+                _relay = SelectorRelay(loops=int(os.getenv("RELAY_LOOPS", "1")), coalesce_s=coalesce_s)
+            elif mode == "threaded":
+                _relay = ThreadedRelay(coalesce_s=coalesce_s)
+            else:
+                raise ValueError(f"Unknown relay mode: {mode}")
+            logger.info("Using the %s relay", mode)
+        return _relay
@@ -3,35 +3,66 @@ import socket
 import sys
 import threading
 import uuid
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime
+from time import monotonic
+from typing import List, Optional, Sequence
 
 import paramiko
 
-from gateway.ssh import pty
-from gateway.ssh.backend import get_pod_backend, is_username_known, is_challenge_known
-from gateway.ssh.connection import ServerConnection
+from gateway.ssh import detach, metrics, pty
+from gateway.ssh.backend import BackendResource, abandon_provisioning, get_pod_backend, is_username_known, \
+    is_challenge_known, start_provisioning
+from gateway.ssh.connection import ClientChannels, ServerConnection
+from gateway.ssh.crypto import AlgorithmPreferences, load_key, load_keys
 from gateway.ssh.ctf import CTF
-from gateway.ssh.proxy import create_proxy_to_backend_and_forward
+from gateway.ssh.events import event_bus
+from gateway.ssh.provisioning import PositionCallback
+from gateway.ssh.proxy import create_proxy_to_backend
+from gateway.ssh.recording import SessionRecorder
+from gateway.ssh.registry import connections
+from gateway.ssh.relay import get_relay, passthrough
+from gateway.ssh.trace import SessionTrace
+from gateway.ssh.transports import BackendTransportPool
 
 logger = logging.getLogger("gateway.ssh")
 
-connections = {}
-
-
-def run_ssh_server(ip_address: str, port: int, host_key_file: str, backend_key_file: str):
-    host_key = paramiko.RSAKey(filename=host_key_file)
-    backend_key = paramiko.RSAKey(filename=backend_key_file)
+# Sessions give up on the provisioning started at authentication after this long, queue included
+PROVISIONING_TIMEOUT_S = 600.0
+
+
+def run_ssh_server(ip_address: str, port: int, host_key_files: Sequence[str], backend_key_file: str,
+                   backlog: int = 128, reuse_port: bool = False, handshake_workers: int = 32,
+                   client_algorithms: AlgorithmPreferences = None, backend_algorithms: AlgorithmPreferences = None,
+                   max_channels: int = 10):
+    """
+    Accepts SSH clients. The key exchange and authentication of new clients happen on a pool of handshake workers,
+    so the accept loop only accepts.
+    With `reuse_port`, several gateway processes can listen on the same port and the kernel spreads clients across them.
+    Each client can have up to `max_channels` sessions open at once over its connection.
+
+    Host keys and the backend key can be Ed25519, ECDSA or RSA. With several host keys,
+    each client gets the first type in the server's preference list that it also supports.
+    """
+    host_keys = load_keys(host_key_files)
+    backend_key = load_key(backend_key_file)
+    client_algorithms = client_algorithms or AlgorithmPreferences()
+    BackendTransportPool.INSTANCE = BackendTransportPool(algorithms=backend_algorithms)
+    BackendTransportPool.INSTANCE.start()
+    handshakes = ThreadPoolExecutor(max_workers=handshake_workers, thread_name_prefix="ssh-handshake")
 
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.bind((ip_address, port))
     except Exception as e:
         logger.error("Socket bind failed: %s", e, exc_info=1)
         sys.exit(1)
 
     try:
-        sock.listen(20)
+        sock.listen(backlog)
         logger.info("Listening for connections on %s:%s", ip_address, port)
     except Exception as e:
         logger.error("Socket listen failed: %s", e, exc_info=1)
@@ -39,34 +70,66 @@ def run_ssh_server(ip_address: str, port: int, host_key_file: str, backend_key_f
 
     while True:
         client, addr = sock.accept()
-        client_id = str(uuid.uuid4())
-        logger.debug("Received a connection from %s (id=%s)", addr, client_id)
-        transport = paramiko.Transport(client)
-        transport.add_server_key(host_key)
+        metrics.connections_accepted.inc()
+        handshakes.submit(start_connection, client, addr, host_keys, backend_key, client_algorithms, monotonic(),
+                          max_channels)
 
-        connection = ServerConnection(
-            client=client,
-            transport=transport,
-            last_active=datetime.utcnow(),
-            addr=addr,
-            id=client_id
-        )
 
-        try:
-            connection.server = GatewayServer(connection)
+def start_connection(client: socket.socket, addr, host_keys: List[paramiko.PKey], backend_key: paramiko.PKey,
+                     algorithms: AlgorithmPreferences, accepted_at: float, max_channels: int = 10):
+    client_id = str(uuid.uuid4())
+    logger.debug("Received a connection from %s (id=%s)", addr, client_id)
+    try:
+        transport = paramiko.Transport(client)
+        for host_key in host_keys:
+            transport.add_server_key(host_key)
+        algorithms.apply(transport)
+    except Exception:
+        logger.error("An error occurred while creating a transport for client %s", client_id, exc_info=1)
+        client.close()
+        return
+
+    connection = ServerConnection(
+        client=client,
+        transport=transport,
+        last_active=datetime.utcnow(),
+        addr=addr,
+        id=client_id,
+        trace=SessionTrace(accepted_at)
+    )
+    connection.trace.mark("accept", accepted_at)
+    connection.trace.add_span("handshake_queue", accepted_at)
+
+    try:
+        connection.server = GatewayServer(connection, backend_key, max_channels)
+        with connection.trace.span("transport_start"):
             transport.start_server(server=connection.server)
-            ConnectionThread(connection, backend_key).start()
-        except Exception:
-            logger.error("An error occurred while creating a connection to client %s", client_id, exc_info=1)
+        metrics.handshake_seconds.observe(monotonic() - accepted_at)
+        ConnectionThread(connection.server, backend_key).start()
+    except Exception:
+        logger.error("An error occurred while creating a connection to client %s", client_id, exc_info=1)
+        connection.kill()
 
 
 class GatewayServer(paramiko.ServerInterface):
+    """
+    The SSH side of a client connection. Every session channel the client opens, up to `max_channels` at once,
+    is a session of its own (the first one being `connection`), with its own backend channel and ConnectionThread.
+    The sessions share the client's authentication and the provisioning of the team's pod.
+    """
 
-    def __init__(self, connection: ServerConnection):
+    def __init__(self, connection: ServerConnection, backend_key: paramiko.PKey = None, max_channels: int = 10):
         self.client = connection.client
-        self.wait_for_shell = threading.Event()
         self.connection = connection
+        self.channels = ClientChannels(max_channels)
+        connection.channels = self.channels
+        self.backend_key = backend_key
         self.username = None
+        # Started as soon as the client authenticates, see start_provisioning
+        self.provisioning: Optional[Future] = None
+        self.queue_position: Optional[int] = None
+        # One per session waiting for the provisioning
+        self.queue_position_listeners: List[PositionCallback] = []
 
     def get_allowed_auths(self, username):
         return "password"
@@ -74,140 +137,314 @@ class GatewayServer(paramiko.ServerInterface):
     def check_auth_password(self, username, password):
         if ":" in username:
             self.username, self.connection.challenge = username.split(":", 1)
-            self.username = CTF.capitalize_team_name(self.username)
         else:
             self.username = username
         logger.debug("Checking password for %s (%s)", username, self.connection.id)
-        if CTF.check_password(self.username, password):
+        team = CTF.teams.authenticate(self.username, password)
+        if team:
+            self.username = team
+            self.connection.trace.mark("auth")
+            self.start_provisioning()
             return paramiko.AUTH_SUCCESSFUL
+        self.connection.trace.mark("auth_failed")
+        metrics.auth_failures.inc()
         return paramiko.AUTH_FAILED
 
+    def start_provisioning(self):
+        """
+        Starts looking up or creating the team's pod while the client opens its channel and asks for a pty
+        and a shell, which takes a few round trips.
+        """
+        if self.provisioning or not self.connection.challenge or not is_challenge_known(self.connection.challenge):
+            return
+        self.provisioning = start_provisioning(self.connection, self.backend_key, self._report_queue_position)
+
+    def abandon_provisioning(self):
+        # Other sessions of the client may still be waiting for the pod
+        if self.provisioning and len(self.channels) <= 1:
+            abandon_provisioning(self.connection)
+            self.provisioning = None
+
+    def _report_queue_position(self, position: int):
+        # The client may not have a channel yet, the position is then reported once it has one
+        self.queue_position = position
+        for listener in list(self.queue_position_listeners):
+            listener(position)
+
     def check_channel_request(self, kind, chanid):
         logger.debug("Received channel request of type '%s' from channel %s (client: %s)", kind, chanid,
                      self.connection.id)
-        if kind == "session":
-            return paramiko.OPEN_SUCCEEDED
-        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        if kind != "session":
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        # Called on the transport's thread only, one channel at a time
+        first = not self.channels.opened
+        session = self.connection if first else self._new_session()
+        if not self.channels.open(chanid, session):
+            logger.info("Client %s already has %s channels open, refusing another", self.connection.id,
+                        self.channels.max_channels)
+            metrics.channels_refused.inc()
+            return paramiko.OPEN_FAILED_RESOURCE_SHORTAGE
+        metrics.channels_opened.inc()
+        session.trace.mark("channel_open")
+        if not first:
+            # The first channel is accepted by the thread started along with the connection
+            ConnectionThread(self, self.backend_key).start()
+        return paramiko.OPEN_SUCCEEDED
+
+    def _new_session(self) -> ServerConnection:
+        return ServerConnection(
+            client=self.client,
+            transport=self.connection.transport,
+            server=self,
+            last_active=datetime.utcnow(),
+            addr=self.connection.addr,
+            challenge=self.connection.challenge,
+            id=str(uuid.uuid4()),
+            channels=self.channels
+        )
 
     def check_channel_shell_request(self, channel):
-        self.wait_for_shell.set()
+        return self._request_session(channel, "shell")
+
+    def check_channel_exec_request(self, channel, command):
+        # scp runs as a command too ("scp -t" or "scp -f") and goes through unchanged
+        logger.debug("Client %s is executing %r on channel %s", self.connection.id, command, channel.get_id())
+        return self._request_session(channel, "exec", command)
+
+    def check_channel_subsystem_request(self, channel, name):
+        if name != "sftp":
+            return False
+        return self._request_session(channel, "sftp")
+
+    def _request_session(self, channel: paramiko.Channel, session_type: str, command: bytes = None) -> bool:
+        session = self.channels.get(channel.get_id())
+        # A session channel runs one shell, command or subsystem
+        if not session or session.requested.is_set():
+            return False
+        session.session_type = session_type
+        session.command = command
+        session.trace.mark(f"{session_type}_request")
+        session.requested.set()
         return True
 
     def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
-        logger.debug("Client %s is creating PTY with (t=%s,w=%s,h=%s,pw=%s,ph=%s)", self.connection.id,
+        session = self.channels.get(channel.get_id())
+        if not session:
+            return False
+        logger.debug("Client %s is creating PTY with (t=%s,w=%s,h=%s,pw=%s,ph=%s)", session.id,
                      term, width, height, pixelwidth, pixelheight)
-        self.connection.pty_dimensions = pty.PtyDimensions(
+        session.trace.mark("pty_request")
+        session.pty_dimensions = pty.PtyDimensions(
             term=term,
             width=width, height=height,
             width_pixels=pixelwidth, height_pixels=pixelheight)
         return True
 
     def check_channel_window_change_request(self, channel, width, height, pixelwidth, pixelheight):
-        self.connection.pty_dimensions.width = width
-        self.connection.pty_dimensions.height = height
-        self.connection.pty_dimensions.width_pixels = pixelwidth
-        self.connection.pty_dimensions.height_pixels = pixelheight
-        self.connection.resize_backend()
+        session = self.channels.get(channel.get_id())
+        if not session or not session.pty_dimensions:
+            return False
+        session.pty_dimensions.width = width
+        session.pty_dimensions.height = height
+        session.pty_dimensions.width_pixels = pixelwidth
+        session.pty_dimensions.height_pixels = pixelheight
+        session.resize_backend()
+        if session.recording:
+            session.recording.resize(width, height)
         return True
 
 
 class ConnectionThread(threading.Thread):
+    """
+    Accepts one of the client's session channels, and relays it to a backend channel of its own.
+    """
 
-    def __init__(self, connection: ServerConnection, backend_key: paramiko.PKey):
+    def __init__(self, server: GatewayServer, backend_key: paramiko.PKey):
         super().__init__()
         self.backend_key = backend_key
-        self.client = connection.client
-        self.server: GatewayServer = connection.server
-        self.transport = connection.transport
-        self.connection = connection
+        self.server = server
+        self.transport = server.connection.transport
+        self.connection: Optional[ServerConnection] = None
+        self.queue_position_reported = False
 
     def run(self):
-        self.connection.channel: paramiko.Channel = self.transport.accept(30)
-        if not self.connection.channel:
-            logger.debug("Client %s timed out, closing", self.connection.id)
-            self.connection.kill()
+        channel: paramiko.Channel = self.transport.accept(30)
+        if not channel:
+            if not self.server.channels.opened:
+                logger.debug("Client %s timed out, closing", self.server.connection.id)
+                self.server.abandon_provisioning()
+                self.server.connection.kill()
             return
-        self.server.wait_for_shell.wait(60)
-        if not self.server.wait_for_shell.is_set():
-            logger.debug("Client %s never requested a shell, closing", self.connection.id)
+        self.connection = self.server.channels.get(channel.get_id())
+        if not self.connection:
+            channel.close()
+            return
+        self.connection.channel = channel
+        # Checks regularly whether the client left, to stop its provisioning early
+        deadline = monotonic() + 60
+        while not self.connection.requested.wait(0.5) and self.transport.is_active() and not channel.closed \
+                and monotonic() < deadline:
+            pass
+        if not self.connection.requested.is_set():
+            logger.debug("Client %s never requested a shell, a command or a subsystem, closing", self.connection.id)
+            self.server.abandon_provisioning()
             self.connection.kill()
             return
 
-        connections[self.connection.id] = self.connection
+        connections.add(self.connection)
 
         if not is_username_known(self.connection.server.username):
             logger.info("Client %s used an invalid team code, therefore it is being killed.", self.connection.id)
-            self.connection.channel.send("*********\r\n"
-                                         f"  Unknown team code: {self.connection.server.username}. "
-                                         f"Please use a valid code as a username, followed by : and the challenge name"
-                                         f".\r\n"
-                                         "  Example: ssh TeamCode:CATLWALK@ssh.coop-ctf.ca\r\n"
-                                         "*********\r\n")
+            self.connection.send_notice("*********\r\n"
+                                        f"  Unknown team code: {self.connection.server.username}. "
+                                        f"Please use a valid code as a username, followed by : and the challenge name"
+                                        f".\r\n"
+                                        "  Example: ssh TeamCode:CATLWALK@ssh.coop-ctf.ca\r\n"
+                                        "*********\r\n")
             self.connection.kill()
             return
 
         if not self.connection.challenge:
             logger.info("Client %s did not provide a challenge, therefore it is being killed.", self.connection.id)
-            self.connection.channel.send("*********\r\n"
-                                         "No challenge was provided.\r\n"
-                                         "Please set a challenge by appending the username with ':CHALLENGE_NAME'.\r\n"
-                                         f"  Example: ssh {self.connection.server.username}:CATWALK"
-                                         f"@ssh.coop-ctf.ca\r\n"
-                                         "*********\r\n")
+            self.connection.send_notice("*********\r\n"
+                                        "No challenge was provided.\r\n"
+                                        "Please set a challenge by appending the username with ':CHALLENGE_NAME'.\r\n"
+                                        f"  Example: ssh {self.connection.server.username}:CATWALK"
+                                        f"@ssh.coop-ctf.ca\r\n"
+                                        "*********\r\n")
             self.connection.kill()
             return
 
         if not is_challenge_known(self.connection.challenge):
             logger.info("Client %s provided an invalid challenge, therefore it is being killed.", self.connection.id)
-            self.connection.channel.send("*********\r\n"
-                                         f"Challenge not found: {self.connection.challenge}.\r\n"
-                                         "Please set a valid challenge by appending the username "
-                                         "with ':CHALLENGE_NAME'.\r\n"
-                                         f"  Example: ssh {self.connection.server.username}:CATWALK"
-                                         f"@ssh.coop-ctf.ca\r\n"
-                                         "*********\r\n")
+            self.connection.send_notice("*********\r\n"
+                                        f"Challenge not found: {self.connection.challenge}.\r\n"
+                                        "Please set a valid challenge by appending the username "
+                                        "with ':CHALLENGE_NAME'.\r\n"
+                                        f"  Example: ssh {self.connection.server.username}:CATWALK"
+                                        f"@ssh.coop-ctf.ca\r\n"
+                                        "*********\r\n")
             self.connection.kill()
             return
 
-        self.connection.channel.send(
+        parked: detach.ParkedSessions = detach.ParkedSessions.get()
+        # Only shells are parked and resumed: a command or a transfer cannot continue on another connection
+        self.connection.detachable = parked is not None and self.connection.session_type == "shell"
+        resumed = None
+        if self.connection.detachable:
+            resumed = parked.reattach(self.connection.server.username, self.connection.challenge)
+        if resumed:
+            self.server.abandon_provisioning()
+            self._resume(resumed)
+            return
+
+        self.connection.send_notice(
             f"Preparing resources for {self.connection.server.username} "
-            f"(challenge: {self.connection.challenge})...\r\n")
+            f"(challenge: {self.connection.challenge}, session: {self.connection.id})...\r\n")
 
-        backend_res = get_pod_backend(self.connection, self.backend_key)
+        with self.connection.trace.span("provisioning"):
+            backend_res = self._provision()
+        if self.queue_position_reported:
+            self._send_status("\r\n")
 
         if not self.connection.is_alive():
-            # TODO: Delete pod because it is no longer needed
+            # The pod is left to the reaper, in case the client reconnects within its grace period
             return
 
         if not backend_res:
-            self.connection.channel.send("*********\r\n"
-                                         "  Our apologies. Your challenge server never came up."
-                                         "  This could be caused by increased load or a backend issue.\r\n"
-                                         f"  Please notify the event organizers with this code: {self.connection.id}\r\n"
-                                         "*********\r\n")
+            event_bus.publish("provisioning_failed", id=self.connection.id, team=self.connection.server.username,
+                              challenge=self.connection.challenge, stage="pod")
+            self.connection.send_notice("*********\r\n"
+                                        "  Our apologies. Your challenge server never came up."
+                                        "  This could be caused by increased load or a backend issue.\r\n"
+                                        f"  Please notify the event organizers with this code: {self.connection.id}\r\n"
+                                        "*********\r\n")
             self.connection.kill()
             return
 
         try:
             logger.debug("Creating proxy to %s:%s, with username %s (client: %s)",
                          backend_res.ssh_hostname, backend_res.ssh_port, backend_res.ssh_username, self.connection.id)
-            self.connection.backend = create_proxy_to_backend_and_forward(backend_res, self.connection)
+            with metrics.provisioning_seconds.labels("backend_connect").time(), \
+                    self.connection.trace.span("backend_connect"):
+                self.connection.backend = create_proxy_to_backend(backend_res, self.connection)
         except Exception:
             logger.error("Failed to create connection to backend (proxy) for client %s", self.connection.id, exc_info=1)
-            self.connection.channel.send("*********\r\n"
-                                         "  Could not create connection due to a backend error.\r\n"
-                                         f"  Please notify the event organizers with this code: {self.connection.id}\r\n"
-                                         "*********\r\n")
+            event_bus.publish("provisioning_failed", id=self.connection.id, team=self.connection.server.username,
+                              challenge=self.connection.challenge, stage="backend_connect")
+            self.connection.send_notice("*********\r\n"
+                                        "  Could not create connection due to a backend error.\r\n"
+                                        f"  Please notify the event organizers with this code: {self.connection.id}\r\n"
+                                        "*********\r\n")
             self.connection.kill()
             return
 
-        logger.debug("Listening from client %s to proxy", self.connection.id)
-        while self.connection.is_alive():
+        self._relay()
+
+    def _provision(self) -> Optional[BackendResource]:
+        """
+        Waits for the provisioning started when the client authenticated, or provisions the pod itself.
+        A failed provisioning is logged, and returns None.
+        """
+        provisioning = self.server.provisioning
+        if not provisioning:
             try:
-                recv = self.connection.channel.recv(1024)
-                self.connection.backend.send(recv)
-                self.connection.last_active = datetime.utcnow()
-            except Exception:
-                break
+                return get_pod_backend(self.connection, self.backend_key, self._report_queue_position)
+            except (CancelledError, Exception):
+                logger.error("Provisioning failed for client %s", self.connection.id, exc_info=1)
+                return None
 
-        self.connection.kill()
+        self.server.queue_position_listeners.append(self._report_queue_position)
+        try:
+            if self.server.queue_position is not None:
+                self._report_queue_position(self.server.queue_position)
+            return provisioning.result(PROVISIONING_TIMEOUT_S)
+        except FutureTimeoutError:
+            logger.warning("Provisioning for client %s took more than %ss, giving up", self.connection.id,
+                           PROVISIONING_TIMEOUT_S)
+            self.server.abandon_provisioning()
+            return None
+        except (CancelledError, Exception):
+            logger.error("Provisioning failed for client %s", self.connection.id, exc_info=1)
+            return None
+        finally:
+            self.server.queue_position_listeners.remove(self._report_queue_position)
+
+    def _resume(self, session: detach.ParkedSession):
+        logger.info("Client %s reattached to the session of %s", self.connection.id, session.id)
+        self.connection.trace.mark("reattach")
+        self.connection.backend = session.backend
+        try:
+            self.connection.send_notice(f"Reattached to your previous session ({session.id}).\r\n")
+            self.connection.channel.sendall(bytes(session.scrollback))
+            if self.connection.pty_dimensions:
+                self.connection.resize_backend()
+        except Exception:
+            logger.debug("Client %s left while reattaching", self.connection.id, exc_info=1)
+            detach.finish(self.connection)
+            return
+        self._relay()
+
+    def _relay(self):
+        if self.connection.session_type != "shell":
+            passthrough.relay(self.connection)
+            return
+        recorder: SessionRecorder = SessionRecorder.get()
+        if recorder:
+            self.connection.recording = recorder.record(self.connection)
+        get_relay().relay(self.connection)
+
+    def _report_queue_position(self, position: int):
+        # Rewrites the same line as the position changes
+        if position:
+            status = f"Waiting for a challenge server: position {position} in the queue..."
+        else:
+            status = "Starting your challenge server..."
+        self.queue_position_reported = True
+        self._send_status(f"\r\x1b[K{status}")
+
+    def _send_status(self, status: str):
+        try:
+            self.connection.send_notice(status)
+        except Exception:
+            pass
@@ -0,0 +1,238 @@
+import logging
+import os
+import threading
+import uuid
+from datetime import datetime
+from queue import Empty, Full
+from time import monotonic, sleep
+from typing import List, Optional
+
+from gateway.ssh.connection import ServerConnection
+from gateway.ssh.events import EventBus, event_bus
+from gateway.ssh.registry import ConnectionRegistry
+
+logger = logging.getLogger("gateway.state")
+
+
+def session_summary(connection: ServerConnection) -> dict:
+    return {
+        "id": connection.id,
+        "team": connection.server.username if connection.server else None,
+        "challenge": connection.challenge,
+        "type": connection.session_type,
+        "client_addr": f"{connection.addr[0]}:{connection.addr[1]}" if connection.addr else None,
+        "last_active": connection.last_active.timestamp() if connection.last_active else None,
+        "alive": connection.is_alive(),
+    }
+
+
+def session_matches(session: dict, team: Optional[str], challenge: Optional[str],
+                    client: Optional[str]) -> bool:
+    if team and (session["team"] or "").lower() != team.lower():
+        return False
+    if challenge and (session["challenge"] or "").lower() != challenge.lower():
+        return False
+    if client and (session["client_addr"] or "").rsplit(":", 1)[0] != client:
+        return False
+    return True
+
+
+class SessionState:
+    """
+    Where the web API and the reaper find the gateway's live sessions, whichever process they run in.
+    """
+    INSTANCE = None
+
+    @staticmethod
+    def get():
+        return SessionState.INSTANCE
+
+    def list_sessions(self, team: str = None, challenge: str = None, client: str = None) -> List[dict]:
+        raise NotImplementedError
+
+    def get_session(self, conn_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def kill(self, conn_id: str) -> bool:
+        raise NotImplementedError
+
+    def get_trace(self, conn_id: str) -> Optional[dict]:
+        """
+        The phase timeline of a live or recently closed connection, see SessionTrace.to_dict.
+        """
+        raise NotImplementedError
+
+    def worker_stats(self) -> List[dict]:
+        return []
+
+
+class LocalSessionState(SessionState):
+    """
+    Session state of a gateway running in a single process: the sessions are the ones in the registry.
+    """
+
+    def __init__(self, registry: ConnectionRegistry):
+        self.registry = registry
+
+    def list_sessions(self, team: str = None, challenge: str = None, client: str = None) -> List[dict]:
+        if team:
+            found = self.registry.by_team(team)
+        elif challenge:
+            found = self.registry.by_challenge(challenge)
+        elif client:
+            found = self.registry.by_client_addr(client)
+        else:
+            found = self.registry.snapshot()
+        sessions = [session_summary(connection) for connection in found]
+        return [session for session in sessions if session_matches(session, team, challenge, client)]
+
+    def get_session(self, conn_id: str) -> Optional[dict]:
+        connection = self.registry.get(conn_id)
+        return session_summary(connection) if connection else None
+
+    def kill(self, conn_id: str) -> bool:
+        connection = self.registry.get(conn_id)
+        if not connection:
+            return False
+        connection.kill()
+        return True
+
+    def get_trace(self, conn_id: str) -> Optional[dict]:
+        trace = self.registry.trace(conn_id)
+        return trace.to_dict() if trace else None
+
+
+class ProcessSessionState(SessionState):
+    """
+    Session state shared by gateway worker processes through a multiprocessing manager.
+
+    Every worker publishes a snapshot of its sessions (and any stats it wants to report) every second,
+    and picks up the requests addressed to it (kills, and traces, which are too large to publish every second).
+    The web API reads the combined snapshots. Workers also forward their events to the web process's event bus.
+    """
+
+    def __init__(self, manager, workers: int, publish_interval_s: float = 1.0, request_timeout_s: float = 2.0):
+        self.publish_interval_s = publish_interval_s
+        self.request_timeout_s = request_timeout_s
+        self._snapshots = manager.dict()
+        self._requests = [manager.Queue() for _ in range(workers)]
+        # Replies to trace requests: (request id, worker) -> trace or None
+        self._replies = manager.dict()
+        self._events = manager.Queue(maxsize=10000)
+
+    def start_publisher(self, worker: int, registry: ConnectionRegistry, stats=None):
+        """
+        Called in a worker process after it started.
+        """
+        threading.Thread(target=self._publish_loop, args=(worker, registry, stats),
+                         name="state-publisher", daemon=True).start()
+        threading.Thread(target=self._forward_events, name="event-forwarder", daemon=True).start()
+
+    def start_event_relay(self, bus: EventBus):
+        """
+        Called in the web process: publishes the workers' events on its bus.
+        """
+        threading.Thread(target=self._relay_events, args=(bus,), name="event-relay", daemon=True).start()
+
+    def list_sessions(self, team: str = None, challenge: str = None, client: str = None) -> List[dict]:
+        return [session
+                for snapshot in self._snapshots.values()
+                for session in snapshot["sessions"]
+                if session_matches(session, team, challenge, client)]
+
+    def get_session(self, conn_id: str) -> Optional[dict]:
+        for snapshot in self._snapshots.values():
+            for session in snapshot["sessions"]:
+                if session["id"] == conn_id:
+                    return session
+        return None
+
+    def kill(self, conn_id: str) -> bool:
+        for worker, snapshot in self._snapshots.items():
+            if any(session["id"] == conn_id for session in snapshot["sessions"]):
+                self._requests[worker].put(("kill", conn_id))
+                return True
+        return False
+
+    def get_trace(self, conn_id: str) -> Optional[dict]:
+        # Closed connections are not in the snapshots, so every worker is asked
+        request_id = uuid.uuid4().hex
+        for requests in self._requests:
+            requests.put(("trace", conn_id, request_id))
+        keys = [(request_id, worker) for worker in range(len(self._requests))]
+        deadline = monotonic() + self.request_timeout_s
+        try:
+            while monotonic() < deadline:
+                replies = [self._replies.get(key, False) for key in keys]
+                found = next((reply for reply in replies if reply), None)
+                if found or all(reply is not False for reply in replies):
+                    return found
+                sleep(0.02)
+            return None
+        finally:
+            for key in keys:
+                self._replies.pop(key, None)
+
+    def worker_stats(self) -> List[dict]:
+        return [dict(snapshot["stats"], worker=worker, pid=snapshot["pid"])
+                for worker, snapshot in sorted(self._snapshots.items())]
+
+    def _forward_events(self):
+        subscription = event_bus.subscribe(max_queued=10000)
+        while True:
+            event = subscription.get(timeout_s=1.0)
+            if subscription.dropped:
+                logger.warning("Events were lost while forwarding them to the web process")
+                subscription = event_bus.subscribe(max_queued=10000)
+            if not event:
+                continue
+            try:
+                self._events.put_nowait((event["type"], event["data"]))
+            except Full:
+                # The web process is not keeping up, the event is lost rather than blocking the worker
+                pass
+            except Exception:
+                logger.error("An error occurred while forwarding an event", exc_info=1)
+                sleep(1)
+
+    def _relay_events(self, bus: EventBus):
+        while True:
+            try:
+                type, data = self._events.get()
+                bus.publish(type, **data)
+            except Exception:
+                logger.error("An error occurred while relaying worker events", exc_info=1)
+                sleep(1)
+
+    def _publish_loop(self, worker: int, registry: ConnectionRegistry, stats):
+        while True:
+            try:
+                self._snapshots[worker] = {
+                    "pid": os.getpid(),
+                    "published": datetime.utcnow().timestamp(),
+                    "sessions": [session_summary(connection) for connection in registry.snapshot()],
+                    "stats": stats() if stats else {},
+                }
+            except Exception:
+                logger.error("An error occurred while publishing sessions", exc_info=1)
+
+            # Handle requests until the next snapshot is due
+            deadline = monotonic() + self.publish_interval_s
+            try:
+                while True:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    request = self._requests[worker].get(timeout=remaining)
+                    if request[0] == "kill":
+                        connection = registry.get(request[1])
+                        if connection:
+                            connection.kill()
+                    elif request[0] == "trace":
+                        trace = registry.trace(request[1])
+                        self._replies[(request[2], worker)] = trace.to_dict() if trace else None
+            except Empty:
+                pass
+            except Exception:
+                logger.error("An error occurred while handling requests", exc_info=1)
+                sleep(self.publish_interval_s)
@@ -0,0 +1,151 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sys
+import threading
+from pathlib import Path
+from time import monotonic, sleep
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger("gateway.teams")
+
+HASH_SCHEME = "pbkdf2_sha256"
+HASH_ITERATIONS = 50_000
+
+
+def hash_password(password: str, iterations: int = HASH_ITERATIONS, salt: bytes = None) -> str:
+    """
+    Returns "pbkdf2_sha256$<iterations>$<salt>$<hash>", the format accepted in teams.json.
+    """
+    salt = salt or os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return "$".join((HASH_SCHEME, str(iterations), base64.b64encode(salt).decode(), base64.b64encode(digest).decode()))
+
+
+class _Credential:
+    __slots__ = ("iterations", "salt", "digest")
+
+    def __init__(self, encoded: str):
+        if encoded.startswith(HASH_SCHEME + "$"):
+            _, iterations, salt, digest = encoded.split("$")
+            self.iterations = int(iterations)
+            self.salt = base64.b64decode(salt)
+            self.digest = base64.b64decode(digest)
+        else:
+            # A plain text password: only its hash is kept in memory
+            self.iterations = HASH_ITERATIONS
+            self.salt = os.urandom(16)
+            self.digest = hashlib.pbkdf2_hmac("sha256", encoded.encode(), self.salt, self.iterations)
+
+    def verify(self, password: str) -> bool:
+        attempt = hashlib.pbkdf2_hmac("sha256", password.encode(), self.salt, self.iterations)
+        return hmac.compare_digest(attempt, self.digest)
+
+
+class _Teams:
+    """
+    One version of teams.json. It is never modified: a reload builds a new one, along with a new login cache.
+    """
+
+    def __init__(self, teams: Dict[str, str]):
+        self.names: Tuple[str, ...] = tuple(teams)
+        self.by_folded_name: Dict[str, Tuple[str, _Credential]] = {
+            team.casefold(): (team, _Credential(password)) for team, password in teams.items()
+        }
+        # Verified logins: folded team name -> (keyed digest of the password, expiry)
+        self.logins: Dict[str, Tuple[bytes, float]] = {}
+
+
+class TeamDirectory:
+    """
+    The teams and their passwords, read from teams.json.
+
+    Team names are looked up case-insensitively in constant time. Passwords are compared through salted
+    PBKDF2 hashes, and verified logins are remembered for a short while so that bursts of logins do not
+    spend their time hashing. teams.json is reloaded when it changes; a file that does not parse is ignored.
+    """
+
+    def __init__(self, path: str = "teams.json", reload_interval_s: float = 2.0, login_cache_ttl_s: float = 60.0):
+        self.path = Path(path)
+        self.reload_interval_s = reload_interval_s
+        self.login_cache_ttl_s = login_cache_ttl_s
+        self.reloads = 0
+        self._teams = _Teams({})
+        self._file_version = None
+        self._cache_key = os.urandom(32)
+        # Checked against for unknown teams, so they take as long to reject as wrong passwords
+        self._unknown = _Credential(base64.b64encode(os.urandom(16)).decode())
+
+    def load(self):
+        """
+        Reads teams.json, raising if it cannot be read.
+        """
+        stat = self.path.stat()
+        self.set_teams(json.loads(self.path.read_text()))
+        self._file_version = (stat.st_mtime_ns, stat.st_size)
+
+    def set_teams(self, teams: Dict[str, str]):
+        self._teams = _Teams(teams)
+        self.reloads += 1
+
+    def start(self):
+        threading.Thread(target=self._watch_loop, name="team-directory", daemon=True).start()
+
+    def team_names(self) -> Tuple[str, ...]:
+        return self._teams.names
+
+    def canonical_name(self, team: str) -> Optional[str]:
+        """
+        The team's name as written in teams.json, or None for unknown teams.
+        """
+        entry = self._teams.by_folded_name.get(team.casefold())
+        return entry[0] if entry else None
+
+    def is_known(self, team: str) -> bool:
+        return team.casefold() in self._teams.by_folded_name
+
+    def authenticate(self, team: str, password: str) -> Optional[str]:
+        """
+        Returns the team's canonical name if the password is right, otherwise None.
+        """
+        teams = self._teams
+        folded = team.casefold()
+        login = hmac.new(self._cache_key, f"{folded}\0{password}".encode(), hashlib.sha256).digest()
+        cached = teams.logins.get(folded)
+        if cached and cached[1] > monotonic() and hmac.compare_digest(cached[0], login):
+            return teams.by_folded_name[folded][0]
+
+        entry = teams.by_folded_name.get(folded)
+        if not entry:
+            self._unknown.verify(password)
+            return None
+        name, credential = entry
+        if not credential.verify(password):
+            return None
+        teams.logins[folded] = (login, monotonic() + self.login_cache_ttl_s)
+        return name
+
+    def _watch_loop(self):
+        while True:
+            sleep(self.reload_interval_s)
+            try:
+                stat = self.path.stat()
+            except OSError:
+                continue
+            if (stat.st_mtime_ns, stat.st_size) == self._file_version:
+                continue
+            try:
+                self.load()
+                logger.info("Reloaded %s teams from %s", len(self._teams.names), self.path)
+            except Exception:
+                # Keep the previous teams, the file may be in the middle of being written
+                logger.error("Could not reload %s", self.path, exc_info=1)
+                self._file_version = (stat.st_mtime_ns, stat.st_size)
+
+
+if __name__ == '__main__':
+    # python -m gateway.ssh.teams <password>: prints a hash to use in teams.json
+    print(hash_password(sys.argv[1]))
@@ -0,0 +1,74 @@
+import threading
+from contextlib import contextmanager
+from time import monotonic, time
+from typing import List, Optional, Tuple
+
+
+class SessionTrace:
+    """
+    The timeline of one session: instants (such as "auth") and spans (such as "pod_create") relative to the moment
+    the connection was accepted. Recording is a monotonic() call and a list append, cheap enough to always be on.
+    """
+    __slots__ = ("started_at", "started_at_wall", "events", "closed")
+
+    def __init__(self, started_at: float = None):
+        self.started_at = started_at if started_at is not None else monotonic()
+        self.started_at_wall = time() - (monotonic() - self.started_at)
+        # (phase, start, end or None for instants, thread name)
+        self.events: List[Tuple[str, float, Optional[float], str]] = []
+        self.closed = False
+
+    def mark(self, phase: str, at: float = None):
+        self.events.append((phase, at if at is not None else monotonic(), None, threading.current_thread().name))
+
+    def add_span(self, phase: str, start: float, end: float = None):
+        self.events.append((phase, start, end if end is not None else monotonic(), threading.current_thread().name))
+
+    @contextmanager
+    def span(self, phase: str):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.add_span(phase, start)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.mark("close")
+
+    def to_dict(self) -> dict:
+        return {
+            "started": self.started_at_wall,
+            "phases": [
+                {
+                    "phase": phase,
+                    "at_ms": round((start - self.started_at) * 1000, 3),
+                    "duration_ms": round((end - start) * 1000, 3) if end is not None else None,
+                    "thread": thread,
+                }
+                for phase, start, end, thread in sorted(list(self.events), key=lambda event: event[1])
+            ],
+        }
+
+
+def to_chrome_trace(trace: dict, conn_id: str) -> dict:
+    """
+    Converts a trace from SessionTrace.to_dict to the Chrome trace-event format (chrome://tracing, Perfetto).
+    """
+    started_us = trace["started"] * 1e6
+    thread_ids = {}
+    events = []
+    for phase in trace["phases"]:
+        tid = thread_ids.setdefault(phase["thread"], len(thread_ids) + 1)
+        event = {"name": phase["phase"], "cat": "session", "pid": 1, "tid": tid,
+                 "ts": round(started_us + phase["at_ms"] * 1000)}
+        if phase["duration_ms"] is None:
+            event.update(ph="i", s="t")
+        else:
+            event.update(ph="X", dur=round(phase["duration_ms"] * 1000))
+        events.append(event)
+    events.append({"name": "process_name", "ph": "M", "pid": 1, "args": {"name": f"session {conn_id}"}})
+    for thread, tid in thread_ids.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": thread}})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
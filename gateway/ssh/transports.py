@@ -0,0 +1,203 @@
+import logging
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from time import monotonic, sleep
+from typing import Dict, List, Optional, Tuple
+
+import paramiko
+
+from gateway.ssh.crypto import AlgorithmPreferences
+
+logger = logging.getLogger("gateway.ssh")
+
+TransportKey = Tuple[str, int, str]
+
+
+@dataclass
+class _PooledTransport:
+    transport: paramiko.Transport
+    capacity: int
+    channels: List[paramiko.Channel] = field(default_factory=list)
+    idle_since: Optional[float] = None
+
+    def live_channels(self) -> List[paramiko.Channel]:
+        self.channels = [channel for channel in self.channels if not channel.closed]
+        return self.channels
+
+
+class _KeyLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = 0
+
+
+class BackendTransportPool:
+    """
+    Keeps authenticated transports to the challenge pods, so that reconnects and extra terminals
+    only open a new session channel instead of doing a full key exchange and authentication.
+
+    A pod can have several transports, since sshd limits the sessions of a connection (MaxSessions, 10 by default):
+    a channel is opened on a transport with fewer than `max_channels` of them, or on a new transport.
+    Opening a channel on a pooled transport is given `reuse_timeout_s`, as a pod that died without closing the
+    connection still looks active. A transport that fails it is closed if it has no channels; otherwise its sessions
+    keep it, and it takes no new channels until some of them close.
+    """
+    INSTANCE = None
+
+    def __init__(self, idle_ttl_s: float = 300.0, reap_interval_s: float = 30.0, connect_timeout_s: float = 15.0,
+                 reuse_timeout_s: float = 3.0, max_channels: int = 10, algorithms: AlgorithmPreferences = None):
+        self.idle_ttl_s = idle_ttl_s
+        self.reap_interval_s = reap_interval_s
+        self.connect_timeout_s = connect_timeout_s
+        self.reuse_timeout_s = reuse_timeout_s
+        self.max_channels = max_channels
+        self.algorithms = algorithms or AlgorithmPreferences()
+        self.host_keys = paramiko.HostKeys()
+        try:
+            self.host_keys.load(os.path.expanduser("~/.ssh/known_hosts"))
+        except IOError:
+            pass
+        self._transports: Dict[TransportKey, List[_PooledTransport]] = {}
+        self._key_locks: Dict[TransportKey, _KeyLock] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get():
+        return BackendTransportPool.INSTANCE
+
+    def start(self):
+        threading.Thread(target=self._reap_loop, name="backend-transport-reaper", daemon=True).start()
+
+    def open_session(self, hostname: str, port: int, username: str, key: Optional[paramiko.PKey]) -> paramiko.Channel:
+        transport_key = (hostname, port, username)
+        with self._locked(transport_key):
+            for pooled in list(self._transports.get(transport_key, ())):
+                if not self._is_healthy(pooled.transport):
+                    logger.debug("Discarding unhealthy backend transport to %s:%s", hostname, port)
+                    self._discard(transport_key, pooled)
+                    continue
+                if len(pooled.live_channels()) >= pooled.capacity:
+                    continue
+                try:
+                    channel = pooled.transport.open_session(timeout=self.reuse_timeout_s)
+                except Exception:
+                    logger.debug("Could not reuse backend transport to %s:%s", hostname, port, exc_info=1)
+                    if pooled.live_channels():
+                        # Busy, or at the pod's session limit: the sessions on it go on, new ones go elsewhere
+                        pooled.capacity = len(pooled.channels)
+                    else:
+                        self._discard(transport_key, pooled)
+                    continue
+                return self._add_channel(pooled, channel)
+
+            pooled = _PooledTransport(self._connect(hostname, port, username, key), self.max_channels)
+            with self._lock:
+                self._transports.setdefault(transport_key, []).append(pooled)
+            return self._add_channel(pooled, pooled.transport.open_session(timeout=self.connect_timeout_s))
+
+    def stats(self) -> dict:
+        with self._lock:
+            pooled_transports = [pooled for pooled_list in self._transports.values() for pooled in pooled_list]
+        return {
+            "transports": len(pooled_transports),
+            "channels": sum(len([c for c in p.channels if not c.closed]) for p in pooled_transports),
+        }
+
+    @staticmethod
+    def _add_channel(pooled: _PooledTransport, channel: paramiko.Channel) -> paramiko.Channel:
+        pooled.live_channels().append(channel)
+        pooled.idle_since = None
+        return channel
+
+    def _connect(self, hostname: str, port: int, username: str, key: Optional[paramiko.PKey]) -> paramiko.Transport:
+        transport = paramiko.Transport((hostname, port))
+        # Channel requests are tiny packets waiting on each other, Nagle's algorithm would delay every one of them
+        transport.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self.algorithms.apply(transport)
+            transport.start_client(timeout=self.connect_timeout_s)
+            self._check_host_key(hostname, port, transport.get_remote_server_key())
+            keys = [key] if key else paramiko.Agent().get_keys()
+            for pkey in keys:
+                try:
+                    transport.auth_publickey(username, pkey)
+                    break
+                except paramiko.AuthenticationException:
+                    continue
+            if not transport.is_authenticated():
+                raise paramiko.AuthenticationException(f"Could not authenticate to {hostname}:{port} as {username}")
+            return transport
+        except Exception:
+            transport.close()
+            raise
+
+    def _check_host_key(self, hostname: str, port: int, server_key: paramiko.PKey):
+        # Pods are recreated all the time, so unknown keys only produce a warning (like paramiko.WarningPolicy)
+        host = hostname if port == 22 else f"[{hostname}]:{port}"
+        known = self.host_keys.lookup(host)
+        if not known or server_key.get_name() not in known:
+            logger.warning("Unknown %s host key for %s: %s", server_key.get_name(), host,
+                           server_key.get_fingerprint().hex())
+        elif known[server_key.get_name()] != server_key:
+            raise paramiko.BadHostKeyException(hostname, server_key, known[server_key.get_name()])
+
+    @contextmanager
+    def _locked(self, transport_key: TransportKey):
+        # Serializes the users of one transport; the lock is dropped with the last of them if nothing is pooled
+        with self._lock:
+            key_lock = self._key_locks.get(transport_key)
+            if not key_lock:
+                key_lock = self._key_locks[transport_key] = _KeyLock()
+            key_lock.users += 1
+        try:
+            with key_lock.lock:
+                yield
+        finally:
+            with self._lock:
+                key_lock.users -= 1
+                if not key_lock.users and transport_key not in self._transports:
+                    del self._key_locks[transport_key]
+
+    @staticmethod
+    def _is_healthy(transport: paramiko.Transport) -> bool:
+        return transport.is_active() and transport.is_authenticated()
+
+    def _discard(self, transport_key: TransportKey, pooled: _PooledTransport):
+        with self._lock:
+            pooled_list = self._transports.get(transport_key, [])
+            if pooled in pooled_list:
+                pooled_list.remove(pooled)
+            if not pooled_list:
+                self._transports.pop(transport_key, None)
+        pooled.transport.close()
+
+    def _reap_loop(self):
+        while True:
+            sleep(self.reap_interval_s)
+            try:
+                self._reap()
+            except Exception:
+                logger.error("An error occurred while reaping backend transports", exc_info=1)
+
+    def _reap(self):
+        now = monotonic()
+        with self._lock:
+            keys = list(self._transports)
+        for transport_key in keys:
+            with self._locked(transport_key):
+                for pooled in list(self._transports.get(transport_key, ())):
+                    if not pooled.transport.is_active():
+                        self._discard(transport_key, pooled)
+                    elif pooled.live_channels():
+                        pooled.idle_since = None
+                    elif pooled.idle_since is None:
+                        pooled.idle_since = now
+                        pooled.capacity = self.max_channels
+                    elif now - pooled.idle_since >= self.idle_ttl_s:
+                        logger.debug("Closing idle backend transport to %s:%s", transport_key[0], transport_key[1])
+                        self._discard(transport_key, pooled)
@@ -0,0 +1,255 @@
+import logging
+import threading
+from concurrent.futures import Future
+from time import monotonic, sleep
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from kubernetes import client, watch
+from kubernetes.client.rest import ApiException
+
+logger = logging.getLogger("gateway.kube")
+
+TERMINAL_PHASES = ("Failed", "Succeeded")
+
+# Generated clients reject parameters they don't document, and bookmarks were only added in kubernetes 11
+WATCH_BOOKMARKS = "allow_watch_bookmarks" in (client.CoreV1Api.list_namespaced_pod.__doc__ or "")
+
+
+class PodTerminated(Exception):
+    pass
+
+
+def _team_challenge(pod: client.V1Pod) -> Optional[Tuple[str, str]]:
+    labels = pod.metadata.labels or {}
+    team, challenge = labels.get("ctf_team"), labels.get("ctf_challenge")
+    if not team or not challenge:
+        return None
+    return team.lower(), challenge.lower()
+
+
+def _team(pod: client.V1Pod) -> Optional[str]:
+    # Pods that stopped no longer use the team's resources, even before they are deleted
+    team = (pod.metadata.labels or {}).get("ctf_team")
+    if not team or (pod.status and pod.status.phase in TERMINAL_PHASES):
+        return None
+    return team.lower()
+
+
+def _is_ready(pod: client.V1Pod) -> bool:
+    status: Optional[client.V1PodStatus] = pod.status
+    if not status or status.phase != "Running" or not status.pod_ip:
+        return False
+    return all(container.ready for container in status.container_statuses or ())
+
+
+class PodWatcher:
+    """
+    Follows every pod in a namespace with a single watch. It keeps an index of the pods by name, by
+    (team, challenge) labels and by team, and resolves the futures of sessions waiting for a pod.
+
+    `list_pods` returns the current pods and the resource version to watch from,
+    and `stream_pods` yields watch events (dicts with a "type" and a V1Pod "object") starting at a resource version.
+    Both can be replaced with fakes to use the watcher without a cluster.
+
+    Once the first list is indexed, `on_change` (if set) is called with "created", "ready" or "deleted"
+    and the pod as pods come and go.
+    """
+
+    def __init__(self, list_pods: Callable[[], Tuple[List[client.V1Pod], str]],
+                 stream_pods: Callable[[str], Iterable[dict]]):
+        self._list_pods = list_pods
+        self._stream_pods = stream_pods
+        self._pods: Dict[str, client.V1Pod] = {}
+        self._by_team_challenge: Dict[Tuple[str, str], client.V1Pod] = {}
+        self._by_team: Dict[str, Set[str]] = {}
+        self._synced = threading.Event()
+        self._last_contact: Optional[float] = None
+        self._resyncs = 0
+        self._waiters: Dict[str, List[Future]] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.on_change: Optional[Callable[[str, client.V1Pod], None]] = None
+
+    @staticmethod
+    def for_api(api: client.CoreV1Api, namespace: str = "ctf", timeout_s: int = 300) -> "PodWatcher":
+        def list_pods():
+            pod_list: client.V1PodList = api.list_namespaced_pod(namespace=namespace)
+            return pod_list.items, pod_list.metadata.resource_version
+
+        def stream_pods(resource_version: str):
+            options = {"allow_watch_bookmarks": True} if WATCH_BOOKMARKS else {}
+            return watch.Watch().stream(api.list_namespaced_pod, namespace=namespace,
+                                        resource_version=resource_version, timeout_seconds=timeout_s, **options)
+
+        return PodWatcher(list_pods, stream_pods)
+
+    def start(self):
+        threading.Thread(target=self._run, name="pod-watcher", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def is_synced(self) -> bool:
+        return self._synced.is_set()
+
+    def wait_until_synced(self, timeout_s: float) -> bool:
+        return self._synced.wait(timeout_s)
+
+    def get(self, name: str) -> Optional[client.V1Pod]:
+        with self._lock:
+            return self._pods.get(name)
+
+    def find(self, team: str, challenge: str) -> Optional[client.V1Pod]:
+        with self._lock:
+            return self._by_team_challenge.get((team.lower(), challenge.lower()))
+
+    def team_pods(self, team: str) -> Set[str]:
+        """
+        The names of the team's pods that have not stopped.
+        """
+        with self._lock:
+            return set(self._by_team.get(team.lower(), ()))
+
+    def list(self) -> List[client.V1Pod]:
+        with self._lock:
+            return list(self._pods.values())
+
+    def stats(self) -> dict:
+        """
+        Staleness is the time since the index last heard from the API server, through a list, an event or a bookmark.
+        """
+        with self._lock:
+            pods = len(self._pods)
+        return {
+            "synced": self.is_synced(),
+            "pods": pods,
+            "resyncs": self._resyncs,
+            "staleness_s": None if self._last_contact is None else monotonic() - self._last_contact,
+        }
+
+    def wait_for_ip(self, pod_name: str) -> Future:
+        """
+        Returns a future that resolves to the pod's IP as soon as it has one,
+        or fails with PodTerminated if the pod is deleted or stops.
+        """
+        future = Future()
+        with self._lock:
+            pod = self._pods.get(pod_name)
+            if pod and self._resolve(future, pod):
+                return future
+            self._waiters.setdefault(pod_name, []).append(future)
+        return future
+
+    def unsubscribe(self, pod_name: str, future: Future):
+        with self._lock:
+            waiters = self._waiters.get(pod_name)
+            if waiters and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._waiters[pod_name]
+
+    def handle_event(self, event: dict):
+        pod: client.V1Pod = event["object"]
+        name = pod.metadata.name
+        changes = []
+        with self._lock:
+            previous = self._pods.get(name)
+            if previous:
+                key = _team_challenge(previous)
+                if key and self._by_team_challenge.get(key) is previous:
+                    del self._by_team_challenge[key]
+                self._unindex_team(previous)
+            if event["type"] == "DELETED":
+                self._pods.pop(name, None)
+                for future in self._waiters.pop(name, []):
+                    future.set_exception(PodTerminated(f"Pod {name} was deleted"))
+                if previous:
+                    changes.append("deleted")
+            else:
+                self._pods[name] = pod
+                key = _team_challenge(pod)
+                if key:
+                    self._by_team_challenge[key] = pod
+                team = _team(pod)
+                if team:
+                    self._by_team.setdefault(team, set()).add(name)
+                waiters = self._waiters.get(name)
+                if waiters:
+                    self._waiters[name] = [future for future in waiters if not self._resolve(future, pod)]
+                    if not self._waiters[name]:
+                        del self._waiters[name]
+                if not previous:
+                    changes.append("created")
+                if _is_ready(pod) and not (previous and _is_ready(previous)):
+                    changes.append("ready")
+        if self.on_change and self.is_synced():
+            for change in changes:
+                try:
+                    self.on_change(change, pod)
+                except Exception:
+                    logger.debug("Could not report a pod change", exc_info=1)
+
+    def _unindex_team(self, pod: client.V1Pod):
+        team = ((pod.metadata.labels or {}).get("ctf_team") or "").lower()
+        names = self._by_team.get(team)
+        if names:
+            names.discard(pod.metadata.name)
+            if not names:
+                del self._by_team[team]
+
+    def _resolve(self, future: Future, pod: client.V1Pod) -> bool:
+        status: Optional[client.V1PodStatus] = pod.status
+        if not status:
+            return False
+        if status.phase in TERMINAL_PHASES:
+            future.set_exception(PodTerminated(f"Pod {pod.metadata.name} is in phase {status.phase}"))
+            return True
+        if status.pod_ip:
+            future.set_result(status.pod_ip)
+            return True
+        return False
+
+    def _resync(self) -> str:
+        pods, resource_version = self._list_pods()
+        self._resyncs += 1
+        for pod in pods:
+            self.handle_event({"type": "MODIFIED", "object": pod})
+        names = set(pod.metadata.name for pod in pods)
+        with self._lock:
+            missing = [pod for name, pod in self._pods.items() if name not in names]
+        for pod in missing:
+            self.handle_event({"type": "DELETED", "object": pod})
+        self._last_contact = monotonic()
+        self._synced.set()
+        return resource_version
+
+    def _run(self):
+        resource_version = None
+        while not self._stopped.is_set():
+            try:
+                if not resource_version:
+                    resource_version = self._resync()
+                for event in self._stream_pods(resource_version):
+                    if self._stopped.is_set():
+                        return
+                    if event["type"] == "ERROR":
+                        # The resource version expired, a fresh list is needed
+                        resource_version = None
+                        break
+                    if event["type"] != "BOOKMARK":
+                        self.handle_event(event)
+                    resource_version = event["object"].metadata.resource_version
+                    self._last_contact = monotonic()
+                else:
+                    # The watch timed out normally, which also proves the index is current
+                    self._last_contact = monotonic()
+            except ApiException as e:
+                if e.status == 410:
+                    resource_version = None
+                    continue
+                logger.warning("Pod watch failed, retrying", exc_info=e)
+                sleep(1)
+            except Exception as e:
+                logger.warning("Pod watch failed, retrying", exc_info=e)
+                resource_version = None
+                sleep(1)
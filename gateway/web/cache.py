@@ -0,0 +1,162 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from time import monotonic
+from typing import Callable, Dict, Hashable, Set, Tuple
+
+import falcon
+
+from gateway.ssh.events import EventBus
+from gateway.ssh.provisioning import SingleFlight
+
+logger = logging.getLogger("gateway.web")
+
+# What a route's build function returns: the response media, and headers to send with it
+Built = Tuple[object, Dict[str, str]]
+
+# The responses that events make out of date: session lists show each session's pod
+_SESSION_PATHS = ("/ssh/connections",)
+_POD_PATHS = ("/ssh/pods", "/ssh/connections")
+INVALIDATED_BY = {
+    "session_opened": _SESSION_PATHS,
+    "session_closed": _SESSION_PATHS,
+    "session_parked": _SESSION_PATHS,
+    "session_reattached": _SESSION_PATHS,
+    "pod_created": _POD_PATHS,
+    "pod_ready": _POD_PATHS,
+    "pod_deleted": _POD_PATHS,
+}
+
+
+class CachedResponse:
+    __slots__ = ("body", "headers", "etag", "last_modified", "expires_at")
+
+    def __init__(self, body: bytes, headers: Dict[str, str], etag: str, last_modified: datetime, expires_at: float):
+        self.body = body
+        self.headers = headers
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires_at = expires_at
+
+
+class ResponseCache:
+    """
+    Responses of the admin API's GET routes, kept for a short while so that dashboards polling the same route
+    share one build of it. Concurrent requests for an expired response wait for a single rebuild.
+
+    Responses carry an ETag (a hash of the body) and the time the body last changed, so pollers can revalidate
+    with If-None-Match or If-Modified-Since and get a 304. Expired entries are kept until they are evicted,
+    so that a rebuild with the same body keeps its Last-Modified.
+    """
+
+    def __init__(self, ttl_s: float = 1.0, max_entries: int = 1024):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, CachedResponse]" = OrderedDict()
+        # Incremented by invalidate(), so that builds started before it are not kept
+        self._generation = 0
+        self._builds = SingleFlight()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str, str], build: Callable[[], Built]) -> CachedResponse:
+        """
+        The response for (path, query), built by `build` if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry.expires_at > monotonic():
+                self._entries.move_to_end(key)
+                return entry
+        return self._builds.do(key, lambda _: self._build(key, build))
+
+    def invalidate(self, path_prefix: str):
+        """
+        Expires the responses of every route whose path starts with `path_prefix`.
+        """
+        with self._lock:
+            self._generation += 1
+            for (path, _), entry in self._entries.items():
+                if path.startswith(path_prefix):
+                    entry.expires_at = 0
+
+    def _build(self, key: Tuple[str, str], build: Callable[[], Built]) -> CachedResponse:
+        with self._lock:
+            generation = self._generation
+        media, headers = build()
+        body = json.dumps(media).encode()
+        etag = hashlib.sha1(body).hexdigest()[:20]
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous and previous.etag == etag:
+                last_modified = previous.last_modified
+            else:
+                last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+            # A build that raced with an invalidation is served to the requests waiting for it, but not kept fresh
+            expires_at = monotonic() + self.ttl_s if generation == self._generation else 0
+            entry = CachedResponse(body, headers, etag, last_modified, expires_at)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+
+responses = ResponseCache()
+
+
+def follow(bus: EventBus, cache: ResponseCache = None):
+    """
+    Invalidates cached responses as sessions open and close and pods come and go, from a background thread,
+    instead of serving them until they expire.
+    """
+    threading.Thread(target=_follow, args=(bus, cache or responses), name="web-cache-invalidation",
+                     daemon=True).start()
+
+
+def _follow(bus: EventBus, cache: ResponseCache):
+    while True:
+        subscription = bus.subscribe(types=list(INVALIDATED_BY))
+        while True:
+            event = subscription.get(1.0)
+            if not event:
+                if subscription.dropped:
+                    break
+                continue
+            # Events arriving together, like a burst of logins, invalidate once
+            prefixes: Set[str] = set()
+            while event:
+                prefixes.update(INVALIDATED_BY[event["type"]])
+                event = subscription.get(0)
+            for prefix in prefixes:
+                cache.invalidate(prefix)
+        # Events were missed while falling behind
+        logger.info("The response cache fell behind the event stream, invalidating every response")
+        cache.invalidate("/")
+
+
+def serve(req, resp, build: Callable[[], Built]):
+    """
+    Answers a GET request from the response cache, with a 304 if the client already has the current response.
+    """
+    # The same parameters in another order are the same response
+    query = "&".join(sorted(req.query_string.split("&"))) if req.query_string else ""
+    entry = responses.get((req.path, query), build)
+    resp.etag = entry.etag
+    resp.last_modified = entry.last_modified
+    # Clients may keep the response, but have to check that it is still current
+    resp.cache_control = ["no-cache"]
+    for name, value in entry.headers.items():
+        resp.set_header(name, value)
+
+    if req.if_none_match is not None:
+        not_modified = any(tag == "*" or tag == entry.etag for tag in req.if_none_match)
+    else:
+        not_modified = req.if_modified_since is not None and entry.last_modified <= req.if_modified_since
+    if not_modified:
+        resp.status = falcon.HTTP_NOT_MODIFIED
+        return
+    resp.content_type = falcon.MEDIA_JSON
+    resp.data = entry.body
@@ -1,13 +1,19 @@
 import base64
 import datetime
+import json
 import logging
-from typing import Optional
+import threading
+from typing import Dict, List, Optional, Tuple
 
 import falcon
 import waitress
-from kubernetes.client import V1Pod, V1PodList
+from kubernetes.client import V1Pod
 
-from gateway.ssh import server as ssh_server, kube, ctf
+from gateway.ssh import server as ssh_server, backend, detach, kube, ctf, metrics, pool, reaper, recording, trace
+from gateway.ssh.cluster import ReplicaSessionState
+from gateway.ssh.events import Subscription, event_bus
+from gateway.ssh.state import SessionState
+from gateway.web import cache
 
 logger = logging.getLogger("gateway.web")
 
@@ -20,60 +26,126 @@ class IndexRoute:
 
 class SSHConnectionListRoute:
     def on_get(self, req, resp):
+        cache.serve(req, resp, lambda: self.build(req))
+
+    def build(self, req):
+        state: SessionState = SessionState.get()
+        client: kube.KubeClient = kube.KubeClient.get()
+        sessions = [session for session in state.list_sessions(team=req.get_param("team"),
+                                                                challenge=req.get_param("challenge"),
+                                                                client=req.get_param("client"))
+                    if session["alive"]]
+        sessions.sort(key=lambda session: session["id"])
+        sessions, headers = paginate(req, sessions)
         connections = []
-        for conn in ssh_server.connections.values():
-            conn: ssh_server.ServerConnection = conn
-            if conn.is_alive():
-                client: kube.KubeClient = kube.KubeClient.get()
-                pod: V1Pod = client.get_pod(team=conn.server.username, challenge=conn.challenge)
-                connections.append({
-                    "id": conn.id,
-                    "last_active": datetime.datetime.utcnow().timestamp() - conn.last_active.timestamp(),
-                    "username": conn.server.username,
-                    "client_addr": f"{conn.addr[0]}:{conn.addr[1]}",
-                    "challenge": conn.challenge,
-                    "pod": {
-                        "name": pod.metadata.name,
-                        "namespace": pod.metadata.namespace,
-                        "created": pod.metadata.creation_timestamp.strftime("%Y-%m-%d %H:%M:%S")
-                    }
-                })
-
-        resp.media = connections
+        now = datetime.datetime.utcnow().timestamp()
+        for session in sessions:
+            # Only the page's pods are looked up
+            pod: V1Pod = client.get_pod(team=session["team"], challenge=session["challenge"])
+            connections.append({
+                "id": session["id"],
+                "last_active": now - session["last_active"],
+                "username": session["team"],
+                "client_addr": session["client_addr"],
+                "challenge": session["challenge"],
+                "type": session.get("type"),
+                "replica": session.get("replica"),
+                "pod": {
+                    "name": pod.metadata.name,
+                    "namespace": pod.metadata.namespace,
+                    "created": pod.metadata.creation_timestamp.strftime("%Y-%m-%d %H:%M:%S")
+                } if pod else None
+            })
+        return select_fields(req, connections), headers
+
+    def on_delete(self, req, resp):
+        user = get_auth(req)
+        if user != "admin":
+            resp.media = {"login": False}
+            return
+
+        team, challenge, client = req.get_param("team"), req.get_param("challenge"), req.get_param("client")
+        if not (team or challenge or client or req.get_param_as_bool("all")):
+            # Killing every session takes an explicit all=1, not a forgotten filter
+            resp.status = falcon.HTTP_BAD_REQUEST
+            resp.media = {"success": False, "error": "Filter by team, challenge or client, or pass all=1"}
+            return
+
+        state: SessionState = SessionState.get()
+        killed = []
+        for session in state.list_sessions(team=team, challenge=challenge, client=client):
+            if state.kill(session["id"]):
+                killed.append(session["id"])
+        cache.responses.invalidate("/ssh/connections")
+        resp.media = {"success": True, "killed": killed}
+
+
+class SSHConnectionHistoryRoute:
+    def on_get(self, req, resp):
+        cache.serve(req, resp, lambda: self.build(req))
+
+    def build(self, req):
+        records = [record.to_dict() for record in ssh_server.connections.history()
+                   if matches(req, record.team, record.challenge)]
+        records, headers = paginate(req, records)
+        return select_fields(req, records), headers
 
 
 class SSHConnectionRoute:
     def on_delete(self, req, resp, conn_id):
         user = get_auth(req)
-        if user != "admin" and (not user or user.lower() != team.lower()):
+        state: SessionState = SessionState.get()
+        session = state.get_session(conn_id)
+        if user != "admin" and (not user or not session or user.lower() != (session["team"] or "").lower()):
             resp.media = {"login": False}
             return
 
-        connection: ssh_server.ServerConnection = ssh_server.connections.get(conn_id)
-        if not connection:
+        if not session:
             resp.status = falcon.HTTP_NOT_FOUND
             return
 
-        if connection.is_alive():
-            connection.kill()
+        if session["alive"] and state.kill(conn_id):
+            cache.responses.invalidate("/ssh/connections")
             resp.status = falcon.HTTP_OK
 
 
+class SSHConnectionTraceRoute:
+    def on_get(self, req, resp, conn_id):
+        state: SessionState = SessionState.get()
+        session_trace = state.get_trace(conn_id)
+        if not session_trace:
+            resp.status = falcon.HTTP_NOT_FOUND
+            return
+
+        if req.get_param("format") == "chrome":
+            resp.media = trace.to_chrome_trace(session_trace, conn_id)
+        else:
+            resp.media = dict(session_trace, id=conn_id)
+
+
 class PodListRoute:
     def on_get(self, req, resp):
+        cache.serve(req, resp, lambda: self.build(req))
+
+    def build(self, req):
         client: kube.KubeClient = kube.KubeClient.get()
-        pod_list: V1PodList = client.api.list_namespaced_pod(namespace="ctf")
-        pods = pod_list.items
+        pods = client.list_pods()
         output = []
         for pod in pods:
             pod: V1Pod = pod
+            labels = pod.metadata.labels or {}
+            if not matches(req, labels.get("ctf_team"), labels.get("ctf_challenge")):
+                continue
             output.append({
                 "name": pod.metadata.name,
-                "team": pod.metadata.labels.get("ctf_team"),
-                "challenge": pod.metadata.labels.get("ctf_challenge"),
+                "team": labels.get("ctf_team"),
+                "challenge": labels.get("ctf_challenge"),
+                "owner": (pod.metadata.annotations or {}).get("ctf_owner"),
                 "created": pod.metadata.creation_timestamp.strftime("%Y-%m-%d %H:%M:%S")
             })
-        resp.media = output
+        output.sort(key=lambda pod: pod["name"])
+        output, headers = paginate(req, output)
+        return select_fields(req, output), headers
 
 
 class PodRoute:
@@ -85,12 +157,13 @@ class PodRoute:
             resp.media = {"success": False}
             return
 
-        resp.media = {
+        cache.serve(req, resp, lambda: ({
             "name": pod.metadata.name,
             "team": pod.metadata.labels.get("ctf_team"),
             "challenge": pod.metadata.labels.get("ctf_challenge"),
+            "owner": (pod.metadata.annotations or {}).get("ctf_owner"),
             "created": pod.metadata.creation_timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        }
+        }, {}))
 
     def on_delete(self, req, resp, team, challenge):
         user = get_auth(req)
@@ -112,9 +185,197 @@ class PodRoute:
             resp.media = {"success": False}
             return
 
+        # Connection lists show the pods too
+        cache.responses.invalidate("/ssh/pods")
+        cache.responses.invalidate("/ssh/connections")
         resp.media = {"success": True}
 
 
+class PodIndexRoute:
+    def on_get(self, req, resp):
+        client: kube.KubeClient = kube.KubeClient.get()
+        resp.media = client.watcher.stats()
+
+
+class WarmPoolRoute:
+    def on_get(self, req, resp):
+        warm_pool: pool.WarmPodPool = pool.WarmPodPool.get()
+        if not warm_pool:
+            resp.status = falcon.HTTP_NOT_FOUND
+            resp.media = {"success": False}
+            return
+        stats = warm_pool.stats()
+        # In worker mode, the claims happen in the worker processes
+        for worker in SessionState.get().worker_stats():
+            for challenge, counters in worker.get("pool", {}).items():
+                if challenge in stats:
+                    stats[challenge]["hits"] += counters["hits"]
+                    stats[challenge]["misses"] += counters["misses"]
+        resp.media = stats
+
+
+class ReaperRoute:
+    def on_get(self, req, resp):
+        stats = reaper.Reaper.get().stats()
+        # In worker mode, idle sessions are closed by the worker processes
+        stats["sessions_closed"] += sum(worker.get("sessions_closed", 0)
+                                        for worker in SessionState.get().worker_stats())
+        resp.media = stats
+
+
+class ProvisioningRoute:
+    def on_get(self, req, resp):
+        # In worker mode, each worker provisions its own sessions' pods
+        processes = [worker["provisioning"] for worker in SessionState.get().worker_stats() if "provisioning" in worker]
+        if not processes:
+            processes = [backend.provisioning_stats()]
+        resp.media = {key: sum(stats.get(key, 0) for stats in processes) for key in processes[0]}
+
+
+class ParkedSessionsRoute:
+    def on_get(self, req, resp):
+        # In worker mode, each worker parks its own sessions
+        processes = [worker["parked"] for worker in SessionState.get().worker_stats() if worker.get("parked")]
+        parked: detach.ParkedSessions = detach.ParkedSessions.get()
+        if parked:
+            processes.append(parked.stats())
+        if not processes:
+            resp.status = falcon.HTTP_NOT_FOUND
+            resp.media = {"success": False}
+            return
+        resp.media = {name: sum(stats[name] for stats in processes) for name in processes[0]}
+
+
+class ReplicaListRoute:
+    def on_get(self, req, resp):
+        state: SessionState = SessionState.get()
+        if not isinstance(state, ReplicaSessionState):
+            resp.status = falcon.HTTP_NOT_FOUND
+            resp.media = {"success": False}
+            return
+        resp.media = state.replicas()
+
+
+class RecordingRoute:
+    def on_get(self, req, resp):
+        # In worker mode, each worker records its own sessions
+        processes = [worker["recording"] for worker in SessionState.get().worker_stats() if worker.get("recording")]
+        recorder: recording.SessionRecorder = recording.SessionRecorder.get()
+        if recorder:
+            processes.append(recorder.stats())
+        if not processes:
+            resp.status = falcon.HTTP_NOT_FOUND
+            resp.media = {"success": False}
+            return
+        resp.media = {
+            "recording": sum(stats["recording"] for stats in processes),
+            "bytes_written": sum(stats["bytes_written"] for stats in processes),
+            "bytes_dropped": sum(stats["bytes_dropped"] for stats in processes),
+            "disk_full": any(stats["disk_full"] for stats in processes),
+        }
+
+
+class MetricsRoute:
+    def on_get(self, req, resp):
+        families = metrics.registry.collect()
+        # In worker mode, the SSH metrics come from the workers
+        for worker in SessionState.get().worker_stats():
+            families += metrics.with_labels(worker.get("metrics", []), {"worker": str(worker["worker"])})
+        resp.content_type = "text/plain; version=0.0.4"
+        resp.data = metrics.render(families).encode()
+
+
+class EventStreamRoute:
+    """
+    Server-sent events: every event published on the event bus, optionally only those listed in `types`.
+    Each stream holds one of the web server's threads, so only `max_streams` can be open at once.
+    """
+    KEEPALIVE_S = 15.0
+
+    def __init__(self, max_streams: int, max_queued: int = 1000):
+        self.max_streams = max_streams
+        self.max_queued = max_queued
+        self._streams = 0
+        self._lock = threading.Lock()
+
+    def on_get(self, req, resp):
+        # Browsers resume with Last-Event-ID when they reconnect
+        last_event_id = req.get_header("Last-Event-ID") or req.get_param("last_event_id")
+        try:
+            after_id = int(last_event_id) if last_event_id else None
+        except ValueError:
+            after_id = None
+
+        with self._lock:
+            if self._streams >= self.max_streams:
+                resp.status = falcon.HTTP_SERVICE_UNAVAILABLE
+                resp.media = {"success": False, "reason": "Too many event streams are open"}
+                return
+            self._streams += 1
+        subscription = event_bus.subscribe(self.max_queued, req.get_param_as_list("types"), after_id)
+        resp.content_type = "text/event-stream"
+        resp.cache_control = ["no-cache"]
+        resp.stream = self._stream(subscription)
+
+    def _stream(self, subscription: Subscription):
+        try:
+            yield b"retry: 3000\n\n"
+            while True:
+                event = subscription.get(self.KEEPALIVE_S)
+                if event:
+                    yield f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n".encode()
+                elif subscription.dropped:
+                    # The client reconnects, and resumes from the last event it received if it is still kept
+                    yield b"event: dropped\ndata: {}\n\n"
+                    return
+                else:
+                    # Also finds out that the client went away
+                    yield b": keepalive\n\n"
+        finally:
+            event_bus.unsubscribe(subscription)
+            with self._lock:
+                self._streams -= 1
+
+
+def matches(req, team: Optional[str], challenge: Optional[str]) -> bool:
+    """
+    Whether an item passes the request's team and challenge filters.
+    """
+    team_filter, challenge_filter = req.get_param("team"), req.get_param("challenge")
+    if team_filter and (team or "").lower() != team_filter.lower():
+        return False
+    if challenge_filter and (challenge or "").lower() != challenge_filter.lower():
+        return False
+    return True
+
+
+def paginate(req, items: list) -> Tuple[list, Dict[str, str]]:
+    """
+    The page of items selected by the request's `offset` and `limit`, and a header with the total count.
+    """
+    # Bounds are checked here, as falcon renamed the keywords of get_param_as_int after 1.4
+    offset = req.get_param_as_int("offset")
+    limit = req.get_param_as_int("limit")
+    if offset is None:
+        offset = 0
+    elif offset < 0:
+        raise falcon.HTTPInvalidParam("The value must be at least 0", "offset")
+    if limit is not None and limit < 1:
+        raise falcon.HTTPInvalidParam("The value must be at least 1", "limit")
+    page = items[offset:offset + limit] if limit else items[offset:]
+    return page, {"X-Total-Count": str(len(items))}
+
+
+def select_fields(req, items: List[dict]) -> List[dict]:
+    """
+    Keeps only the fields listed in the request's `fields` parameter, if any.
+    """
+    fields = req.get_param_as_list("fields")
+    if not fields:
+        return items
+    return [{field: item[field] for field in fields if field in item} for item in items]
+
+
 def get_auth(req) -> Optional[str]:
     """
     Checks login info from headers and returns the username if login succeeded
@@ -132,18 +393,30 @@ def get_auth(req) -> Optional[str]:
     if len(split) != 2:
         return None
     username, password = split
-    logger.debug("Checking password", username, password)
-    if ctf.CTF.check_password(username, password):
-        return ctf.CTF.capitalize_team_name(username)
+    logger.debug("Checking password for %s", username)
+    return ctf.CTF.teams.authenticate(username, password)
 
 
-def run_web_server(ip_address: str, port: int):
+def run_web_server(ip_address: str, port: int, threads: int = 4, cache_ttl_s: float = 1.0, event_streams: int = 2):
+    cache.responses.ttl_s = cache_ttl_s
+    cache.follow(event_bus)
     api = falcon.API()
     api.add_route("/", IndexRoute())
     api.add_route("/ssh/connections", SSHConnectionListRoute())
+    api.add_route("/ssh/connections/history", SSHConnectionHistoryRoute())
     api.add_route("/ssh/connections/{conn_id}", SSHConnectionRoute())
+    api.add_route("/ssh/connections/{conn_id}/trace", SSHConnectionTraceRoute())
     api.add_route("/ssh/pods", PodListRoute())
     api.add_route("/ssh/pods/{team}/{challenge}", PodRoute())
+    api.add_route("/ssh/pool", WarmPoolRoute())
+    api.add_route("/ssh/index", PodIndexRoute())
+    api.add_route("/ssh/reaper", ReaperRoute())
+    api.add_route("/ssh/provisioning", ProvisioningRoute())
+    api.add_route("/ssh/recording", RecordingRoute())
+    api.add_route("/ssh/replicas", ReplicaListRoute())
+    api.add_route("/ssh/parked", ParkedSessionsRoute())
+    api.add_route("/metrics", MetricsRoute())
+    api.add_route("/events", EventStreamRoute(event_streams))
 
     logger.info("Listening for connections on %s:%s", ip_address, port)
-    waitress.serve(api, host=ip_address, port=port, _quiet=True)
+    waitress.serve(api, host=ip_address, port=port, threads=threads, _quiet=True)
@@ -0,0 +1,251 @@
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from time import monotonic, sleep
+from typing import Callable, Dict, List
+
+import pytest
+
+from benchmarks.stubs import FakeKubeClient
+from gateway.ssh.provisioning import ProvisioningScheduler, SingleFlight
+
+
+def wait_until(condition: Callable[[], bool], timeout_s: float = 5.0):
+    deadline = monotonic() + timeout_s
+    while not condition():
+        assert monotonic() < deadline, "timed out"
+        sleep(0.005)
+
+
+class Provisioner:
+    """
+    Makes provisioning jobs that create pods on a FakeKubeClient, recording the order in which they start
+    and the queue positions they are told. Jobs given a gate wait for it before creating their pod.
+    """
+
+    def __init__(self):
+        self.kube_client = FakeKubeClient(time_scale=0.002)
+        self.started: List[str] = []
+        self.positions: Dict[str, List[int]] = {}
+
+    def team_pods(self, team: str) -> set:
+        return {pod.metadata.name for (pod_team, _), pod in self.kube_client.pods.items() if pod_team == team}
+
+    def submit(self, scheduler: ProvisioningScheduler, team: str, challenge: str, gate: threading.Event = None):
+        name = f"chal-{challenge}-{team}"
+
+        def work():
+            self.started.append(name)
+            if gate:
+                assert gate.wait(5)
+            pod = self.kube_client.create_pod(name, "image", team, challenge)
+            if not self.kube_client.wait_until_pod_port_available(pod, "10.0.0.1", 22, 30):
+                return None
+            return pod
+
+        self.positions[name] = []
+        return scheduler.submit(team, work, self.positions[name].append, name)
+
+
+@pytest.fixture
+def provisioner():
+    return Provisioner()
+
+
+def test_waiting_teams_are_served_round_robin(provisioner):
+    scheduler = ProvisioningScheduler(max_in_flight=1)
+    gate = threading.Event()
+    jobs = [provisioner.submit(scheduler, "team0", "a", gate)]
+    jobs += [provisioner.submit(scheduler, "team1", challenge) for challenge in "abc"]
+    jobs += [provisioner.submit(scheduler, "team2", challenge) for challenge in "ab"]
+
+    gate.set()
+
+    assert all(job.result(5) for job in jobs)
+    assert provisioner.started == ["chal-a-team0", "chal-a-team1", "chal-a-team2", "chal-b-team1", "chal-b-team2",
+                                   "chal-c-team1"]
+
+
+def test_teams_are_limited_in_the_provisioning_they_run_at_once(provisioner):
+    scheduler = ProvisioningScheduler(max_in_flight=4, max_in_flight_per_team=2)
+    gate = threading.Event()
+    jobs = [provisioner.submit(scheduler, "team1", challenge, gate) for challenge in "abcd"]
+    jobs.append(provisioner.submit(scheduler, "team2", "a", gate))
+
+    wait_until(lambda: len(provisioner.started) == 3)
+    assert sorted(provisioner.started) == ["chal-a-team1", "chal-a-team2", "chal-b-team1"]
+    assert scheduler.stats()["in_flight"] == 3
+    assert scheduler.stats()["waiting"] == 2
+
+    gate.set()
+
+    assert all(job.result(5) for job in jobs)
+    assert scheduler.stats()["completed"] == 5
+
+
+def test_teams_with_as_many_pods_as_they_may_have_wait_for_one_to_go(provisioner):
+    scheduler = ProvisioningScheduler(max_pods_per_team=1, team_pods=provisioner.team_pods)
+    assert provisioner.submit(scheduler, "team1", "a").result(5)
+
+    job = provisioner.submit(scheduler, "team1", "b")
+    # The team's own pod does not count against it twice
+    assert not scheduler.at_pod_limit("team1", "chal-a-team1")
+    assert scheduler.at_pod_limit("team1", "chal-b-team1")
+    sleep(0.05)
+    assert not job.done()
+    assert provisioner.positions["chal-b-team1"] == [1]
+
+    del provisioner.kube_client.pods[("team1", "a")]
+    scheduler.pod_released()
+
+    assert job.result(5)
+    assert provisioner.positions["chal-b-team1"] == [1, 0]
+
+
+def test_waiting_jobs_are_told_their_position_as_it_changes(provisioner):
+    scheduler = ProvisioningScheduler(max_in_flight=1)
+    gate = threading.Event()
+    running = provisioner.submit(scheduler, "team0", "a", gate)
+    jobs = [provisioner.submit(scheduler, f"team{team}", "a") for team in (1, 2, 3)]
+    assert [provisioner.positions[f"chal-a-team{team}"] for team in (1, 2, 3)] == [[1], [2], [3]]
+
+    gate.set()
+
+    assert running.result(5) and all(job.result(5) for job in jobs)
+    assert provisioner.positions == {
+        "chal-a-team0": [0],
+        "chal-a-team1": [1, 0],
+        "chal-a-team2": [2, 1, 0],
+        "chal-a-team3": [3, 2, 1, 0],
+    }
+
+
+def test_cancelled_jobs_are_not_run(provisioner):
+    scheduler = ProvisioningScheduler(max_in_flight=1)
+    gate = threading.Event()
+    running = provisioner.submit(scheduler, "team0", "a", gate)
+    cancelled = provisioner.submit(scheduler, "team1", "a")
+    waiting = provisioner.submit(scheduler, "team2", "a")
+
+    assert cancelled.cancel()
+    gate.set()
+
+    assert running.result(5) and waiting.result(5)
+    assert cancelled.cancelled()
+    assert "chal-a-team1" not in provisioner.started
+    assert provisioner.kube_client.creates == 2
+    assert scheduler.stats()["waiting"] == 0
+
+
+def test_cancelled_jobs_waiting_for_their_team_to_have_fewer_pods_leave_the_queue(provisioner):
+    scheduler = ProvisioningScheduler(max_in_flight=1, max_pods_per_team=1, team_pods=provisioner.team_pods)
+    assert provisioner.submit(scheduler, "team1", "a").result(5)
+    gate = threading.Event()
+    running = provisioner.submit(scheduler, "team0", "a", gate)
+    cancelled = provisioner.submit(scheduler, "team1", "b")
+    waiting = provisioner.submit(scheduler, "team2", "a")
+    assert scheduler.stats()["waiting"] == 2
+
+    assert cancelled.cancel()
+
+    assert scheduler.stats()["waiting"] == scheduler.stats()["teams_waiting"] == 1
+    assert provisioner.positions["chal-a-team2"] == [2, 1]
+    gate.set()
+    assert running.result(5) and waiting.result(5)
+    assert provisioner.positions["chal-b-team1"] == [1]
+
+
+def test_callers_of_the_same_key_share_one_call():
+    flight = SingleFlight()
+    gate = threading.Event()
+    calls = []
+
+    def work(report_position):
+        calls.append(threading.current_thread().name)
+        assert gate.wait(5)
+        return "pod"
+
+    with ThreadPoolExecutor(4) as executor:
+        results = [executor.submit(flight.do, "team1", work) for _ in range(4)]
+        wait_until(lambda: flight.stats()["joined_calls"] == 3)
+        gate.set()
+        assert [result.result(5) for result in results] == ["pod"] * 4
+
+    assert len(calls) == 1
+    assert flight.do("team1", lambda report_position: "new pod") == "new pod"
+    assert flight.stats() == {"flights": 0, "unique_calls": 2, "joined_calls": 3}
+
+
+def test_callers_that_joined_share_the_exception_of_the_call():
+    flight = SingleFlight()
+    gate = threading.Event()
+
+    def work(report_position):
+        assert gate.wait(5)
+        raise RuntimeError("no pod")
+
+    with ThreadPoolExecutor(2) as executor:
+        results = [executor.submit(flight.do, "team1", work) for _ in range(2)]
+        wait_until(lambda: flight.stats()["joined_calls"] == 1)
+        gate.set()
+        for result in results:
+            with pytest.raises(RuntimeError):
+                result.result(5)
+
+
+def test_positions_are_passed_on_to_every_caller():
+    flight = SingleFlight()
+    gate, reported = threading.Event(), threading.Event()
+    positions = {"leader": [], "early": [], "late": []}
+
+    def work(report_position):
+        report_position(2)
+        reported.set()
+        assert gate.wait(5)
+        report_position(0)
+        return "pod"
+
+    with ThreadPoolExecutor(3) as executor:
+        leader = executor.submit(flight.do, "team1", work, positions["leader"].append)
+        wait_until(lambda: flight.stats()["flights"] == 1)
+        early = executor.submit(flight.do, "team1", work, positions["early"].append)
+        wait_until(lambda: flight.stats()["joined_calls"] == 1)
+        assert reported.wait(5)
+        # Callers joining late are told the current position right away
+        late = executor.submit(flight.do, "team1", work, positions["late"].append)
+        wait_until(lambda: positions["late"] == [2])
+        gate.set()
+        assert leader.result(5) == early.result(5) == late.result(5) == "pod"
+
+    assert positions == {"leader": [2, 0], "early": [2, 0], "late": [2, 0]}
+
+
+def test_callers_that_joined_a_cancelled_call_run_it_again():
+    flight = SingleFlight()
+    gate, rerun_gate = threading.Event(), threading.Event()
+    calls = []
+
+    def work(report_position):
+        calls.append(report_position)
+        if len(calls) == 1:
+            # The leader's client went away and its queued provisioning was dropped
+            assert gate.wait(5)
+            raise CancelledError()
+        assert rerun_gate.wait(5)
+        return "pod"
+
+    with ThreadPoolExecutor(3) as executor:
+        leader = executor.submit(flight.do, "team1", work)
+        wait_until(lambda: flight.stats()["flights"] == 1)
+        joiners = [executor.submit(flight.do, "team1", work) for _ in range(2)]
+        wait_until(lambda: flight.stats()["joined_calls"] == 2)
+        gate.set()
+
+        with pytest.raises(CancelledError):
+            leader.result(5)
+        # One of the joiners runs the call again, and the other joins it
+        wait_until(lambda: flight.stats()["joined_calls"] == 3)
+        rerun_gate.set()
+        assert [joiner.result(5) for joiner in joiners] == ["pod", "pod"]
+
+    assert len(calls) == 2
+    assert flight.stats()["unique_calls"] == 2
@@ -0,0 +1,125 @@
+import threading
+from time import sleep
+from typing import List
+
+import pytest
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+from gateway.ssh.watch import PodTerminated, PodWatcher
+
+
+def pod(name: str, resource_version: str, ip: str = None, team: str = "Team1", challenge: str = "CATWALK",
+        phase: str = "Pending") -> client.V1Pod:
+    return client.V1Pod(
+        metadata=client.V1ObjectMeta(name=name, resource_version=resource_version,
+                                     labels={"ctf_team": team, "ctf_challenge": challenge}),
+        status=client.V1PodStatus(phase=phase, pod_ip=ip))
+
+
+class FakeCluster:
+    """
+    Serves scripted lists and watch streams to a PodWatcher. Each stream is a list of events, or an exception
+    raised when it is watched; once the script is exhausted, streams are empty, like watches timing out.
+    """
+
+    def __init__(self, lists: List[tuple], streams: list):
+        self.lists = lists
+        self.streams = streams
+        self.listed = 0
+        self.watched_from: List[str] = []
+        self.exhausted = threading.Event()
+
+    def list_pods(self):
+        pods, resource_version = self.lists[min(self.listed, len(self.lists) - 1)]
+        self.listed += 1
+        return pods, resource_version
+
+    def stream_pods(self, resource_version: str):
+        self.watched_from.append(resource_version)
+        if not self.streams:
+            self.exhausted.set()
+            sleep(0.01)
+            return iter(())
+        stream = self.streams.pop(0)
+        if isinstance(stream, Exception):
+            raise stream
+        return iter(stream)
+
+
+@pytest.fixture
+def watch():
+    watchers = []
+
+    def start(cluster: FakeCluster) -> PodWatcher:
+        watcher = PodWatcher(cluster.list_pods, cluster.stream_pods)
+        watchers.append(watcher)
+        watcher.start()
+        assert cluster.exhausted.wait(5)
+        return watcher
+
+    yield start
+    for watcher in watchers:
+        watcher.stop()
+
+
+def test_waiter_gets_the_ip_once_the_pod_has_one(watch):
+    cluster = FakeCluster([([pod("chal-a-p", "10")], "10")], [])
+    watcher = watch(cluster)
+    future = watcher.wait_for_ip("chal-a-p")
+    assert not future.done()
+
+    watcher.handle_event({"type": "MODIFIED", "object": pod("chal-a-p", "11", ip="10.0.0.7", phase="Running")})
+
+    assert future.result(1) == "10.0.0.7"
+    assert watcher.find("team1", "catwalk").status.pod_ip == "10.0.0.7"
+
+
+def test_ip_from_the_stream_and_bookmarks_advance_the_resource_version(watch):
+    cluster = FakeCluster([([pod("chal-a-p", "10")], "10")], [[
+        {"type": "MODIFIED", "object": pod("chal-a-p", "11", ip="10.0.0.7", phase="Running")},
+        {"type": "BOOKMARK", "object": client.V1Pod(metadata=client.V1ObjectMeta(resource_version="15"))},
+    ]])
+    watcher = watch(cluster)
+
+    assert watcher.wait_for_ip("chal-a-p").result(1) == "10.0.0.7"
+    assert cluster.watched_from[:2] == ["10", "15"]
+    assert cluster.listed == 1
+
+
+@pytest.mark.parametrize("expiry", [
+    ApiException(status=410, reason="Gone"),
+    [{"type": "ERROR", "object": client.V1Pod(metadata=client.V1ObjectMeta(resource_version="12"))}],
+], ids=["exception", "error-event"])
+def test_expired_resource_version_resyncs_from_a_fresh_list(expiry):
+    # While the watch was down, chal-a-p was deleted and chal-b-p got its IP
+    cluster = FakeCluster([
+        ([pod("chal-a-p", "10"), pod("chal-b-p", "10", challenge="SWEEP")], "10"),
+        ([pod("chal-b-p", "20", ip="10.0.0.8", challenge="SWEEP", phase="Running")], "20"),
+    ], [expiry])
+    watcher = PodWatcher(cluster.list_pods, cluster.stream_pods)
+    deleted, started = watcher.wait_for_ip("chal-a-p"), watcher.wait_for_ip("chal-b-p")
+    watcher.start()
+    try:
+        with pytest.raises(PodTerminated):
+            deleted.result(5)
+        assert started.result(5) == "10.0.0.8"
+        assert cluster.exhausted.wait(5)
+        assert cluster.listed == 2
+        assert cluster.watched_from[-1] == "20"
+        assert watcher.get("chal-a-p") is None
+        assert watcher.stats()["resyncs"] == 2
+    finally:
+        watcher.stop()
+
+
+def test_pods_stopping_are_reported_to_waiters(watch):
+    cluster = FakeCluster([([pod("chal-a-p", "10")], "10")], [])
+    watcher = watch(cluster)
+    future = watcher.wait_for_ip("chal-a-p")
+
+    watcher.handle_event({"type": "MODIFIED", "object": pod("chal-a-p", "11", phase="Failed")})
+
+    with pytest.raises(PodTerminated):
+        future.result(1)
+    assert watcher.team_pods("TEAM1") == set()